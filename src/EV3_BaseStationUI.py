@@ -9,8 +9,11 @@
 
 #  Call the line below to generate python code from the Qt ui file
 #  pyqt5-tools pyuic5 .\EV3_BaseStation.ui
+import asyncio
 import sys
+import time
 import EV3_Controller as ev3
+import metrics
 from PyQt5.QtCore import Qt
 from PyQt5.QtWidgets import QApplication
 from PyQt5.QtWidgets import QMainWindow
@@ -43,6 +46,8 @@ a=np.random.random(MAP_HEIGHT*MAP_WIDTH)*255
 a=np.reshape(a,(MAP_HEIGHT,MAP_WIDTH))
 a=np.require(a, np.uint8, 'C')
 
+RENDER_SECONDS = metrics.REGISTRY.histogram("ui_map_render_seconds", "time to redraw the map image")
+
 class MainWindow(QMainWindow):
 
     def __init__(self, *args, **kwargs):
@@ -167,9 +172,19 @@ class MainWindow(QMainWindow):
         self.LogLayout.addWidget(self.logEdit)
         self.LogBox.setLayout(self.LogLayout)
  
+        self.MetricsBox = QtWidgets.QGroupBox("Metrics")
+        self.MetricsBox.setMaximumWidth(int(self.num_button_columns*1.15*self.default_btn_width))
+        self.MetricsBox.setMinimumHeight(160)
+        self.MetricsLayout = QtWidgets.QVBoxLayout()
+        self.metricsEdit = QTextEdit()
+        self.metricsEdit.setReadOnly(True)
+        self.MetricsLayout.addWidget(self.metricsEdit)
+        self.MetricsBox.setLayout(self.MetricsLayout)
+
         self.left_column.addLayout(self.status)
         self.left_column.addWidget(self.ControlsBox)
         self.left_column.addWidget(self.LogBox)
+        self.left_column.addWidget(self.MetricsBox)
         
         self.spacerItem = QtWidgets.QSpacerItem(20, 40, QtWidgets.QSizePolicy.Minimum, QtWidgets.QSizePolicy.Expanding)
         self.left_column.addItem(self.spacerItem)
@@ -215,6 +230,13 @@ class MainWindow(QMainWindow):
         self.setCentralWidget(widget)
 
         self.counter = 0
+        # True once follow_robot() redraws on the robot's streams instead of polling flags
+        self.streaming = False
+        # map image kept between frames, only the regions changed since map_version are redrawn
+        self.map_version = -1
+        self.map_image = None
+        self.map_bounds = None
+        self.map_peak = 0
 
         self.timer = QTimer()
         self.timer.setInterval(50)
@@ -234,38 +256,105 @@ class MainWindow(QMainWindow):
 
     def update_data(self):
         self.counter +=1
-        if self.robot.new_ultra_message:
-            self.text_range.setText(str(self.robot.get_ultra_range()))
-            self.text_position.setText(str(self.robot.get_position()))
-            self.text_heading.setText(str(self.robot.get_heading()))
-            self.update_map()
-        elif self.robot.new_heading_message: 
-            self.text_heading.setText(str(self.robot.get_heading()))
+        # with follow_robot() running the streams drive the redraws, no flags are polled
+        if not self.streaming:
+            if self.robot.new_ultra_message:
+                self.show_reading()
+            elif self.robot.new_heading_message:
+                self.text_heading.setText(str(self.robot.get_heading()))
         
         if self.robot.is_connected_to_mqtt():
             self.btn_MQTT.setStyleSheet("background-color: green")
         else:
             self.btn_MQTT.setStyleSheet("background-color: red")
 
+        # refresh the metrics panel once a second
+        if self.counter % 20 == 0:
+            self.metricsEdit.setPlainText("\n".join(metrics.REGISTRY.summary()))
+
+
+    def show_reading(self):
+        self.text_range.setText(str(self.robot.get_ultra_range()))
+        self.text_position.setText(str(self.robot.get_position()))
+        self.text_heading.setText(str(self.robot.get_heading()))
+        self.update_map()
+
+    async def follow_robot(self):
+        """ redraw as the map and heading streams of an AsyncEV3Supervisor update, on the
+            qasync event loop. Each stream keeps only its latest item, a slow redraw
+            skips the updates it missed
+        """
+        self.streaming = True
+        await asyncio.gather(self.follow_map(), self.follow_heading())
+
+    async def follow_map(self):
+        async for _ in self.robot.subscribe("map", maxsize=1):
+            self.show_reading()
+
+    async def follow_heading(self):
+        async for _, hdg in self.robot.subscribe("hdg", maxsize=1):
+            self.text_heading.setText(str(hdg))
+
+    def log_ack(self, name, result):
+        """log the round trip of an awaitable command once it is acknowledged"""
+        if not asyncio.isfuture(result):
+            return
+
+        def done(future):
+            if future.cancelled() or future.exception() is not None:
+                self.log(f"{name} not acknowledged")
+            else:
+                self.log(f"{name} acknowledged in {future.result()*1e3:.0f} ms")
+        result.add_done_callback(done)
 
     def update_map(self):    
         # global a
         # a=np.roll(a,-5)
-        _grid_map = self.robot.get_map_grid()
-        maxVal = np.max(_grid_map)
-        norm_map= np.uint8(_grid_map*255/maxVal)
+        snapshot = self.robot.get_map_snapshot()
+        if self.map_image is not None and snapshot.version == self.map_version:
+            return
+        start = time.perf_counter()
+        # changes may run past the snapshot version, redrawing a little extra is harmless
+        _, changes = self.robot.map_changes_since(self.map_version)
+        _grid_map = snapshot.get_map()
+        if _grid_map.size == 0:
+            # a tiled map has no cells until the first reading
+            return
+        # changes are in map cells and the snapshot starts at map cell (x_min, y_min),
+        # which a tiled map moves as it grows
+        x_min, y_min, x_max, y_max = snapshot.bounds
+        regions = [(slice(max(x0, x_min) - x_min, min(x1, x_max) - x_min),
+                    slice(max(y0, y_min) - y_min, min(y1, y_max) - y_min))
+                   for x0, y0, x1, y1 in changes
+                   if max(x0, x_min) < min(x1, x_max) and max(y0, y_min) < min(y1, y_max)]
+        full_redraw = (self.map_image is None or self.map_bounds != snapshot.bounds or
+                       not regions)
+        if not full_redraw:
+            maxVal = max(np.max(_grid_map[region]) for region in regions)
+            # a new peak changes the scale of the whole image
+            full_redraw = maxVal > self.map_peak
+        if full_redraw:
+            self.map_peak = np.max(_grid_map)
+            self.map_image = np.uint8(_grid_map*255/self.map_peak)
+        else:
+            for region in regions:
+                self.map_image[region] = np.uint8(_grid_map[region]*255/self.map_peak)
+        self.map_version = snapshot.version
+        self.map_bounds = snapshot.bounds
+        norm_map = self.map_image
         self.graphicsView.setGeometry(QtCore.QRect(0,0,_grid_map.shape[0], _grid_map.shape[1]))
         QI = QImage(norm_map.data, _grid_map.shape[0], _grid_map.shape[1], QImage.Format_Grayscale8)
         pixmap = QPixmap.fromImage(QI)
         #QI.setColorTable(COLORTABLE)
         self.graphicsView.setPixmap(pixmap)
+        RENDER_SECONDS.observe(time.perf_counter() - start)
 
     def on_scan_btn_clicked(self):
-        self.robot.runUltraScan()
+        self.log_ack("Ultra Scan", self.robot.runUltraScan())
         self.log("Run Ultra Scan")
 
     def on_stop_btn_clicked(self):
-        self.robot.stop_robot()
+        self.log_ack("Stop", self.robot.stop_robot())
         self.log("Stop Robot")
 
     def on_connect_btn_clicked(self):
@@ -276,7 +365,7 @@ class MainWindow(QMainWindow):
             self.log("Error connectting to MQTT")
 
     def on_compass_cal_btn_clicked(self):
-        self.robot.calibrate_compass()
+        self.log_ack("Compass Cal", self.robot.calibrate_compass())
 
     def on_hdg_history_btn_clicked(self):
         self.btn_hdg_history.setStyleSheet("background-color: green")
@@ -300,7 +389,19 @@ class MainWindow(QMainWindow):
 if __name__ == "__main__":
     app = QApplication(sys.argv)
 
-    robot = ev3.EV3Supervisor()
+    # with --async the supervisor and the UI share a qasync event loop and the window
+    # redraws on the robot's streams, otherwise a timer polls the robot
+    use_async = "--async" in sys.argv
+    # with --tiled the map grows in tiles as the robot explores instead of a fixed square
+    map_mode = "tiled" if "--tiled" in sys.argv else "dense"
+    if use_async:
+        import qasync
+        import async_supervisor
+        loop = qasync.QEventLoop(app)
+        asyncio.set_event_loop(loop)
+        robot = async_supervisor.AsyncEV3Supervisor(map_mode=map_mode)
+    else:
+        robot = ev3.EV3Supervisor(map_mode=map_mode)
 
     # Force the style to be the same on all OSs:
     app.setStyle("Fusion")
@@ -332,4 +433,9 @@ if __name__ == "__main__":
     window.setRobot(robot)
     window.show()
     window.update_map()
-    app.exec_()
\ No newline at end of file
+    if use_async:
+        with loop:
+            loop.create_task(window.follow_robot())
+            loop.run_forever()
+    else:
+        app.exec_()
\ No newline at end of file
@@ -8,11 +8,31 @@
 #  pip install python-ev3dev2
 # pip install paho-mqtt
 
-import json
 import logging
-#import numpy as np
-import paho.mqtt.client as mqtt
+import time
+import commands
+import ingestion
+import metrics
 import occupancy_grid as grid
+import localization
+import log_pipeline
+import path_planner
+import session_log
+import sensor_codec
+import sensor_fusion
+import telemetry
+import tiled_grid
+import transport as transports
+
+
+ULTRA_MESSAGES = metrics.REGISTRY.counter("ev3_ultra_messages_total", "ultrasonic messages received")
+ULTRA_MESSAGE_SECONDS = metrics.REGISTRY.histogram(
+    "ev3_ultra_message_seconds", "time to decode and queue an ultrasonic message")
+HDG_MESSAGES = metrics.REGISTRY.counter("ev3_hdg_messages_total", "heading messages received")
+HDG_MESSAGE_SECONDS = metrics.REGISTRY.histogram(
+    "ev3_hdg_message_seconds", "time to decode and queue a heading message")
+BAD_MESSAGES = metrics.REGISTRY.counter("ev3_bad_messages_total",
+                                        "sensor messages dropped as malformed")
 
 
 # d88888b db    db d8888b.  .o88b.  .d88b.  d8b   db d888888b d8888b.  .d88b.  db      
@@ -27,32 +47,109 @@ class EV3Supervisor:
 
     # map_grid = np.random.random([1024, 1024])
 
-    def __init__(self):
+    def __init__(self, map_file=None, num_particles=0, num_workers=0, queue_size=1024,
+                 overflow="drop-oldest", telemetry_capacity=4096, record_file=None,
+                 transport=None, metrics_port=None, log_mode="queue", heading_wait=0.2,
+                 map_mode="dense"):
         
-        logging.basicConfig(filename='EV3Control.log', encoding='utf-8', level=logging.DEBUG, \
-                            format='%(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
+        # "queue" keeps log file writes off the MQTT thread, see log_pipeline.py
+        if log_mode == "queue":
+            log_pipeline.start_queue_logging('EV3Control.log')
+        else:
+            logging.basicConfig(filename='EV3Control.log', encoding='utf-8', level=logging.DEBUG, \
+                                format='%(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
+        # message debug lines are sampled and rate limited per topic
+        self.message_log = log_pipeline.MessageLogSampler()
         self.ultra_range = 0.0 # ultrasonic range sensor reading
         self.x = 256
         self.y = 256
         self.heading = 0.0
-        self.map_grid = grid.Occupancy_Grid(8,8,0.01)
+        # "dense" is an 8 m square map, with a map_file it is memory mapped and survives
+        # restarts; "tiled" has no bounds and allocates tiles as the robot explores
+        if map_mode == "dense":
+            self.map_grid = grid.Occupancy_Grid(8,8,0.01, map_file=map_file)
+        elif map_mode == "tiled":
+            if map_file is not None:
+                raise ValueError("a tiled map cannot be kept in a map_file")
+            self.map_grid = tiled_grid.Tiled_Occupancy_Grid(0.01)
+        else:
+            raise ValueError(f"unknown map mode {map_mode!r}")
+        # with particles the position is estimated against the map, otherwise it stays fixed
+        self.localizer = None
+        if num_particles > 0:
+            self.localizer = localization.ParticleFilter(self.map_grid, self.x, self.y,
+                                                         num_particles=num_particles,
+                                                         num_workers=num_workers)
+        # route to the goal of the last go_to command, repaired as the map changes
+        self.planner = None
+        self.waypoints = []
         self.connected = False
         self.heading_record = False
-        self.heading_history = []
+        # last telemetry_capacity samples of the heading, range and accel channels
+        self.telemetry = telemetry.TelemetryStore(telemetry_capacity)
+        # range readings wait up to heading_wait seconds for the heading at their
+        # timestamp, interpolated from the heading telemetry
+        self.fusion = sensor_fusion.HeadingAligner(self.telemetry.channels["hdg"], heading_wait)
 
-        # create and set up a MQTT client to communicate with the EV3
-        self.client = mqtt.Client()
+        # create and set up a MQTT client to communicate with the EV3, by default a paho
+        # client for the broker on localhost, see transport.py
+        self.client = transports.PahoTransport() if transport is None else transport
         self.client.on_connect = self.on_connect
+        # commands carry a correlation id and are acknowledged on ev3/ack, see commands.py
+        self.commands = self.make_command_tracker()
+        # called with the sample timestamps after each batch of readings reaches the map
+        self.map_listeners = []
+        # sensor topic -> message handler
+        self.topic_handlers = {"ev3/sensor/ultra": self.on_ultra_message,
+                               "ev3/sensor/accel": self.on_accel_message,
+                               "ev3/sensor/hdg": self.on_hdg_message}
+        # with record_file every received sensor message is appended to a session log
+        self.recorder = None
+        if record_file is not None:
+            self.start_recording(record_file)
         
         # client.on_message = on_message
 
         self.new_ultra_message = False
         self.new_heading_message = False
 
+        # the MQTT callbacks only decode and queue samples, the map update worker applies
+        # them in batches
+        self.samples, self.map_worker = self.make_ingestion(queue_size, overflow)
+
+        metrics.REGISTRY.gauge("ev3_ingest_queue_depth", "samples waiting for the map worker",
+                               lambda: len(self.samples))
+        metrics.REGISTRY.gauge("ev3_ingest_dropped", "samples dropped by the ingestion queue",
+                               lambda: self.samples.dropped)
+        metrics.REGISTRY.gauge("ev3_ingest_lag_seconds", "queue wait of the last applied batch",
+                               lambda: self.map_worker.last_lag)
+        metrics.REGISTRY.gauge("ev3_map_version", "map writes so far", lambda: self.map_grid.version)
+        metrics.REGISTRY.gauge("ev3_stop_worst_rtt_seconds", "slowest acknowledged stop command",
+                               lambda: self.commands.command_stats("stop", priority=True).worst)
+        # with metrics_port the metrics are served at http://127.0.0.1:<port>/metrics
+        self.metrics_server = None
+        if metrics_port is not None:
+            self.metrics_server = metrics.serve(port=metrics_port)
+
+    def make_command_tracker(self):
+        return commands.CommandTracker(self.client)
+
+    def make_ingestion(self, queue_size, overflow):
+        """return the sample queue and the started map update worker draining it"""
+        # under the merge overflow policy a heading replaces the queued one and a range
+        # reading replaces a queued reading at the same heading
+        merge = {"hdg": lambda queued, new: new,
+                 "ultra": lambda queued, new: new if abs(queued[1] - new[1]) < 0.5 else None}
+        samples = ingestion.SampleQueue(queue_size, overflow, merge)
+        # range readings still waiting for a heading are released while no samples arrive
+        map_worker = ingestion.MapUpdateWorker(samples, self.apply_samples,
+                                               on_idle=self.release_ranges)
+        map_worker.start()
+        return samples, map_worker
+
     def connect_mqtt(self):
         """Attempt connection to the MQTT server"""
-        self.client.connect("localhost", 1883, 60)
-        self.client.loop_start()
+        self.client.connect()
 
 
     # This is the Subscriber
@@ -65,40 +162,145 @@ class EV3Supervisor:
                       str(rc), str(client), str(userdata))
         client.connected_flag=True
         print("Connected to MQTT Broker!")
-        self.client.subscribe("ev3/sensor/ultra", 0)
-        self.client.subscribe("ev3/sensor/accel", 0)
-        self.client.subscribe("ev3/sensor/hdg", 0)
-
-        self.client.message_callback_add("ev3/sensor/ultra", self.on_ultra_message)
-        self.client.message_callback_add("ev3/sensor/accel", self.on_accel_message)
-        self.client.message_callback_add("ev3/sensor/hdg", self.on_hdg_message)
+        for topic in self.topic_handlers:
+            self.client.subscribe(topic, self.on_sensor_message)
+        # acks skip the session log and the sample queue
+        self.client.subscribe(commands.ACK_TOPIC, self.commands.on_ack_message)
         
         
         # client.subscribe("ev3/#")
 
     def disconnect_mqtt(self):
         """Terminate connection with the MQTT server"""
-        self.client.loop_stop()
+        self.client.disconnect()
         self.connected = False
 
-    def ultra_sample(self, hdg, data):
+    def close_comms(self):
+        """Disconnect and release the localizer worker processes"""
+        self.disconnect_mqtt()
+        self.commands.close()
+        self.map_worker.stop()
+        try:
+            self.release_ranges(flush=True)
+        finally:
+            self.release_resources()
+
+    def release_resources(self):
+        """stop recording, serving metrics and queue logging, release the localizer"""
+        self.stop_recording()
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+            self.metrics_server = None
+        log_pipeline.stop_queue_logging()
+        if self.localizer is not None:
+            self.localizer.close()
+
+    def start_recording(self, path):
+        """append every sensor message received from now on to the session log at path"""
+        self.stop_recording()
+        self.recorder = session_log.SessionRecorder(path)
+
+    def stop_recording(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def on_sensor_message(self, the_client, user_data, msg):
+        """Message handler for every sensor topic, records the message then dispatches it"""
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.record(msg.topic, msg.payload)
+        self.dispatch_message(msg, the_client, user_data)
+
+    def dispatch_message(self, msg, the_client=None, user_data=None):
+        """pass a received or replayed message to the handler for its topic"""
+        handler = self.topic_handlers.get(msg.topic)
+        if handler is None:
+            return
+        # a malformed message is dropped here, an exception would end the network thread
+        try:
+            handler(the_client, user_data, msg)
+        except ValueError as err:
+            BAD_MESSAGES.inc()
+            logging.warning("dropped %s message: %s", msg.topic, err)
+
+    def ultra_sample(self, hdg, data, t=None):
         """add a new range sample from the ultrasonic sensor"""
-        self.ultra_range = data/100
-        self.heading = hdg
-        #x_occ = math.floor(self.x + self.ultra_range*math.cos(hdg*math.pi/180))
-        #y_occ = math.floor(self.y + self.ultra_range*math.sin(hdg*math.pi/180))
-        #self.map_grid[x_occ, y_occ] = (self.map_grid[x_occ, y_occ] + 1)/2
-        self.map_grid.sensor_reading(256, 256, hdg, 10, 0.1, self.ultra_range, 2.55, 0.01)
-        #print("map grid update:", x_occ, y_occ, self.map_grid[x_occ, y_occ])
+        self.ultra_samples([(hdg, data)], None if t is None else [t])
+
+    def ultra_samples(self, samples, times=None):
+        """ add a batch of (hdg, range in cm) ultrasonic samples with a single map update,
+            times are the sample timestamps, by default the time they are applied
+        """
+        poses, headings, ranges = [], [], []
+        if times is None:
+            times = [time.time()]*len(samples)
+        self.telemetry.channels["range"].extend(times, [data/100 for _, data in samples])
+        for hdg, data in samples:
+            self.ultra_range = data/100
+            self.heading = hdg
+            if self.localizer is not None:
+                self.localizer.range_sample(hdg, self.ultra_range, 2.55)
+                self.x, self.y = self.localizer.estimate()
+            poses.append((round(self.x), round(self.y)))
+            headings.append(hdg)
+            ranges.append(self.ultra_range)
+        with self.map_grid.write_lock:
+            self.map_grid.sensor_readings(poses, headings, ranges, 10, 0.1, 2.55, 0.01)
+            self.map_grid.publish()
+            self.update_route()
+        for listener in self.map_listeners:
+            listener(times)
+
+    def apply_samples(self, batch):
+        """ apply a batch of queued (kind, sample). Headings are recorded first, then the
+            range readings whose heading is known go to the map together with the heading
+            interpolated at their timestamp. Called on the map update worker thread
+        """
+        times, headings, ranges = [], [], []
+        for kind, sample in batch:
+            if kind == "ultra":
+                times.append(sample[0])
+                headings.append(sample[1])
+                ranges.append(sample[2])
+            elif kind == "hdg":
+                self.heading_sample(sample[1], sample[0])
+                self.new_heading_message = True
+            elif kind == "accel":
+                self.telemetry.record("accel", sample[0], sample[1:4])
+        if times:
+            self.fusion.add(times, headings, ranges)
+        self.release_ranges()
+
+    def release_ranges(self, flush=False):
+        """map the range readings the heading aligner releases, all of them with flush"""
+        times, headings, ranges = self.fusion.release(flush)
+        if len(times):
+            self.ultra_samples(list(zip(headings.tolist(), ranges.tolist())), times.tolist())
+            self.new_ultra_message = True
+
+    def ingest_stats(self):
+        """ return the ingestion counters: queue depth and max_depth, samples enqueued,
+            dropped, merged and applied, batches, the last and max lag in seconds, and
+            the range readings waiting for a heading, mapped with an interpolated
+            heading (aligned) and with the heading of their own message (unaligned), and
+            those rejected as not finite
+        """
+        stats = self.map_worker.stats()
+        stats.update(pending_ranges=len(self.fusion), aligned=self.fusion.aligned,
+                     unaligned=self.fusion.unaligned, rejected_ranges=self.fusion.rejected)
+        return stats
 
     def get_ultra_range(self):
         """return the last report ultra sonic range in [cm]"""
         return self.ultra_range
 
-    def heading_sample(self, data):
-        """add a new heading sample from the compass sensor"""
+    def heading_sample(self, data, t=None):
+        """add a new heading sample from the compass sensor, t defaults to now"""
         self.heading = data
-        self.heading_history.append(data)
+        self.telemetry.record("hdg", time.time() if t is None else t, data)
+        if self.localizer is not None:
+            self.localizer.heading_sample(data)
 
     def get_heading(self):
         """return the last report ultra sonic range in [cm]"""
@@ -106,9 +308,29 @@ class EV3Supervisor:
             self.new_heading_message = False
         return self.heading
 
+    @property
+    def heading_history(self):
+        """the recorded headings, oldest first, as a view into the telemetry store"""
+        return self.telemetry.last("hdg")[1]
+
+    def get_telemetry(self, channel, seconds):
+        """ return (times, values) of a telemetry channel ("hdg", "range" or "accel") over
+            the last seconds before its newest sample, as views into the ring buffer
+        """
+        return self.telemetry.window(channel, seconds)
+
     def get_map_grid(self):
-        """return the robot map occupancy grid geerated from sensor data"""
-        return self.map_grid.get_map()
+        """return the robot map occupancy grid geerated from sensor data
+        This is the last published snapshot, safe to read while messages are processed"""
+        return self.map_grid.snapshot_view().get_map()
+
+    def get_map_snapshot(self):
+        """return the last published map snapshot with its version"""
+        return self.map_grid.snapshot_view()
+
+    def map_changes_since(self, version):
+        """return (map version, rectangles of map cells changed since version)"""
+        return self.map_grid.changes_since(version)
 
     def get_position(self):
         """Retrieve the world coordnates of the Robot"""
@@ -119,39 +341,96 @@ class EV3Supervisor:
         return self.connected
 
     def on_ultra_message(self, the_client, user_data, msg):
-        """Message handler for a ultrasonic message from the robot"""
-        logging.debug(msg.topic, msg.payload.decode("utf-8"), the_client, user_data)
+        """Message handler for a ultrasonic message from the robot
+        The payload is one JSON sample or a batch of binary records, see sensor_codec"""
+        start = time.perf_counter()
+        if self.message_log.allow(msg.topic):
+            logging.debug("%s %d bytes", msg.topic, len(msg.payload))
 
         if msg.topic == "ev3/sensor/ultra":
-            decode_msg = msg.payload.decode("utf-8")
-            u_msg = json.loads(decode_msg)
-            self.ultra_sample(u_msg[1],u_msg[2])
-            self.new_ultra_message = True
+            for u_msg in sensor_codec.decode(msg.payload, "ultra"):
+                self.samples.put("ultra", u_msg)
             # indicate update of data for GUI
             #draw_figure(window['-IMAGE-'], your_matplotlib_code(robot.get_map_grid()))
+        ULTRA_MESSAGES.inc()
+        ULTRA_MESSAGE_SECONDS.observe(time.perf_counter() - start)
 
     def on_hdg_message(self, theClient, userdata, msg):
-        print(msg.topic, msg.payload.decode())
+        start = time.perf_counter()
         if msg.topic == "ev3/sensor/hdg":
-            decode_msg = msg.payload.decode("utf-8")
-            u_msg = json.loads(decode_msg)
-            self.heading_sample(u_msg[1])
-            self.new_heading_message = True
+            samples = sensor_codec.decode(msg.payload, "hdg")
+            if self.message_log.allow(msg.topic):
+                logging.debug("%s %s", msg.topic, samples)
+            for u_msg in samples:
+                self.samples.put("hdg", u_msg)
+        HDG_MESSAGES.inc()
+        HDG_MESSAGE_SECONDS.observe(time.perf_counter() - start)
 
     def on_accel_message(self, theClient, userdata, msg):
-        print(msg.topic, msg.payload.decode())
+        samples = sensor_codec.decode(msg.payload, "accel")
+        if self.message_log.allow(msg.topic):
+            logging.debug("%s %s", msg.topic, samples)
+        for u_msg in samples:
+            self.samples.put("accel", u_msg)
 
     def runAccelTest(self, duration=0):
-        self.client.publish("ev3/control/accel_test", str(duration))
+        return self.commands.send("accel_test", duration)
     
     def runUltraScan(self, duration=0):
-        self.client.publish("ev3/control/ultra_test", str(duration))
+        return self.commands.send("ultra_test", duration)
     
     def stop_robot(self):
-        self.client.publish("ev3/control/stop",str(0))
+        """ stop on the priority path: published before anything else is done, at QoS 1
+            and repeated until acknowledged, its round trip is tracked apart from the
+            other commands
+        """
+        command_id = self.commands.send_priority("stop", 0)
+        self.cancel_route()
+        return command_id
+
+    def cancel_route(self):
+        """drop the planner, under the map write lock as the worker replans under it"""
+        with self.map_grid.write_lock:
+            self.planner = None
+            self.waypoints = []
+
+    def go_to(self, x, y):
+        """plan a path to map cell (x, y) and stream its waypoints to the robot"""
+        planner = path_planner.DStarLite(self.map_grid, (x, y))
+        with self.map_grid.write_lock:
+            self.planner = planner
+            self.waypoints = []
+            self.update_route()
+
+    def update_route(self):
+        """ replan from the current position and publish the waypoints on ev3/control/goto
+            when the route has changed. The command value is a list of [x, y] waypoints in
+            meters, an empty list when the goal is reached or cannot be reached, or when the
+            robot is off the map. Called with the map write lock held
+        """
+        planner = self.planner
+        if planner is None:
+            return
+        try:
+            path = planner.plan((round(self.x), round(self.y)))
+        except ValueError as err:
+            logging.warning("route cleared: %s", err)
+            path = []
+        waypoints = path_planner.path_waypoints(path[1:])
+        if len(path) <= 1:
+            self.planner = planner = None
+        if waypoints == self.waypoints and planner is not None:
+            return
+        self.waypoints = waypoints
+        res = self.map_grid.resolution
+        self.commands.send("goto", [[x*res, y*res] for x, y in waypoints])
 
     def calibrate_compass(self):
-        self.client.publish("ev3/control/cal_compass",str(0))
+        return self.commands.send("cal_compass", 0)
+
+    def command_stats(self):
+        """return the round trip statistics per command type, see CommandTracker.stats"""
+        return self.commands.stats()
 
         
 
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# EV3Supervisor on an asyncio event loop
+#
+# Receiving messages, updating the map, commands and the UI share one event loop, so
+# nothing polls and no flags are shared between threads:
+#
+#  async def main():
+#      robot = AsyncEV3Supervisor()
+#      robot.connect_mqtt()
+#      async for t, hdg in robot.subscribe("hdg"):
+#          ...
+#      rtt = await robot.stop_robot()
+#
+# Backpressure: when the ingestion queue is full the transport stops reading messages
+# until the map update task has caught up. A subscriber that falls behind loses its
+# oldest items instead of holding up the map updates.
+
+import asyncio
+from collections import deque
+import commands
+import ingestion
+import transport as transports
+from EV3_Controller import EV3Supervisor
+
+
+class Subscription():
+    """ async iterator over the items published to one subscriber
+
+        At most maxsize items wait, a new item then replaces the oldest and counts in
+        dropped; with maxsize 1 the reader always gets the latest item.
+    """
+
+    def __init__(self, maxsize=256):
+        self.items = deque(maxlen=maxsize)
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.dropped = 0
+
+    def put(self, item):
+        if len(self.items) == self.items.maxlen:
+            self.dropped += 1
+        self.items.append(item)
+        self.ready.set()
+
+    def close(self):
+        """end the iteration once the waiting items are read"""
+        self.closed = True
+        self.ready.set()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self.items:
+            if self.closed:
+                raise StopAsyncIteration
+            self.ready.clear()
+            await self.ready.wait()
+        return self.items.popleft()
+
+
+class AsyncEV3Supervisor(EV3Supervisor):
+    """ EV3Supervisor whose transport, map updates and commands run on an asyncio loop
+
+        The transport is an AsyncPahoTransport by default. Sensor samples are queued in an
+        AsyncSampleQueue that pauses the transport when queue_size samples wait, and an
+        AsyncMapUpdateWorker task applies them, on the loop or with offload in an
+        executor thread, whose route commands the transport hands to the loop to publish.
+        subscribe() iterates over the samples of a sensor topic once
+        they are applied, or over the map version after each map update. The commands
+        return futures of their round trip time in seconds.
+
+        connect_mqtt() starts the tasks; it and every other method must be called on the
+        event loop thread. close() replaces close_comms().
+    """
+
+    STREAMS = ("ultra", "hdg", "accel", "map")
+
+    def __init__(self, map_file=None, num_particles=0, num_workers=0, queue_size=1024,
+                 telemetry_capacity=4096, record_file=None, transport=None, metrics_port=None,
+                 log_mode="queue", heading_wait=0.2, offload=False, map_mode="dense"):
+        self.offload = offload
+        self.subscriptions = {kind: [] for kind in self.STREAMS}
+        self.started = False
+        super().__init__(map_file=map_file, num_particles=num_particles, num_workers=num_workers,
+                         queue_size=queue_size, telemetry_capacity=telemetry_capacity,
+                         record_file=record_file,
+                         transport=transports.AsyncPahoTransport() if transport is None else transport,
+                         metrics_port=metrics_port, log_mode=log_mode, heading_wait=heading_wait,
+                         map_mode=map_mode)
+        self.map_version = self.map_grid.version
+        self.map_worker.batch_listeners.append(self.publish_batch)
+
+    def make_command_tracker(self):
+        return commands.AsyncCommandTracker(self.client)
+
+    def make_ingestion(self, queue_size, overflow):
+        """return the sample queue and the map update worker, started by start()"""
+        samples = ingestion.AsyncSampleQueue(queue_size, on_pause=self.client.pause_reading,
+                                             on_resume=self.client.resume_reading)
+        # range readings still waiting for a heading are released while no samples arrive
+        return samples, ingestion.AsyncMapUpdateWorker(samples, self.apply_samples,
+                                                       offload=self.offload,
+                                                       on_idle=self.release_ranges)
+
+    def start(self):
+        """start the map update and command tasks on the running loop"""
+        if not self.started:
+            self.map_worker.start()
+            self.commands.start()
+            self.started = True
+
+    def connect_mqtt(self):
+        self.start()
+        self.client.connect()
+
+    async def drain(self):
+        """wait until every sample received so far has been applied"""
+        await self.map_worker.drain()
+
+    async def close(self):
+        """disconnect, apply the queued samples and end the subscriptions"""
+        self.disconnect_mqtt()
+        self.commands.close()
+        if self.started:
+            await self.map_worker.stop()
+        try:
+            self.release_ranges(flush=True)
+            self.publish_batch([])
+        finally:
+            self.release_resources()
+        for subscriptions in self.subscriptions.values():
+            for subscription in subscriptions:
+                subscription.close()
+
+    def close_comms(self):
+        """schedule close() on the running loop and return its task"""
+        return asyncio.get_running_loop().create_task(self.close())
+
+    def subscribe(self, kind, maxsize=256):
+        """ return a Subscription to the applied samples of kind "ultra", "hdg" or "accel",
+            or to the map version after each map update for kind "map"
+        """
+        subscription = Subscription(maxsize)
+        self.subscriptions[kind].append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        for subscriptions in self.subscriptions.values():
+            if subscription in subscriptions:
+                subscriptions.remove(subscription)
+        subscription.close()
+
+    def publish_batch(self, samples):
+        """hand an applied batch and a new map version to the subscribers"""
+        for kind, sample in samples:
+            for subscription in self.subscriptions[kind]:
+                subscription.put(sample)
+        if self.map_grid.version != self.map_version:
+            self.map_version = self.map_grid.version
+            for subscription in self.subscriptions["map"]:
+                subscription.put(self.map_version)
+
+    def runAccelTest(self, duration=0):
+        return self.commands.request("accel_test", duration)
+
+    def runUltraScan(self, duration=0):
+        return self.commands.request("ultra_test", duration)
+
+    def stop_robot(self):
+        """publish stop on the priority path, see EV3Supervisor.stop_robot"""
+        waiter = self.commands.request("stop", 0, priority=True)
+        self.cancel_route()
+        return waiter
+
+    def calibrate_compass(self):
+        return self.commands.request("cal_compass", 0)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# robot commands with correlation ids, acknowledgements and round trip statistics
+#
+# A command is published on ev3/control/<command> as {"id": <id>, "value": <value>} and the
+# robot acknowledges it by publishing {"id": <id>} on ev3/ack.
+
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections import deque
+import numpy as np
+import metrics
+
+ACK_TOPIC = "ev3/ack"
+
+BAD_ACKS = metrics.REGISTRY.counter("ev3_bad_acks_total", "malformed command acks dropped")
+
+
+class RoundTripStats():
+    """rolling round trip times of one command type, plus its worst case and timeouts"""
+
+    def __init__(self, command, window=100):
+        self.rtts = deque(maxlen=window)
+        self.worst = 0.0
+        self.sent = 0
+        self.acked = 0
+        self.timeouts = 0
+        self.histogram = metrics.REGISTRY.histogram(f"ev3_command_{command}_rtt_seconds",
+                                                    f"round trip time of {command} commands")
+
+    def add(self, rtt):
+        self.rtts.append(rtt)
+        self.worst = max(self.worst, rtt)
+        self.acked += 1
+        self.histogram.observe(rtt)
+
+    def summary(self):
+        rtts = np.array(self.rtts)
+        p50, p99 = np.percentile(rtts, [50, 99]) if len(rtts) else (np.nan, np.nan)
+        return {"sent": self.sent, "acked": self.acked, "timeouts": self.timeouts,
+                "mean": float(rtts.mean()) if len(rtts) else np.nan, "p50": float(p50),
+                "p99": float(p99), "worst": self.worst}
+
+
+class CommandTracker():
+    """ publish commands through client and match the acks coming back
+
+        A command not acknowledged within timeout seconds counts as a timeout. Priority
+        commands (stop) are published with QoS 1 and published again every
+        retry_interval until the ack arrives, their round trip runs from the first
+        publish and their statistics are kept apart from the normal commands.
+        Timeouts and resends are checked on a thread, unless threaded is False and
+        check() is called by the owner every retry_interval.
+    """
+
+    def __init__(self, client, timeout=2.0, retry_interval=0.1, window=100, threaded=True):
+        self.client = client
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.window = window
+        self.next_id = 1
+        # id -> (command, payload, first send time, priority)
+        self.outstanding = {}
+        self.stats_by_command = {}
+        self.priority_stats = {}
+        self.lock = threading.Lock()
+        self.running = True
+        self.thread = None
+        if threaded:
+            self.thread = threading.Thread(target=self.watch, name="commands", daemon=True)
+            self.thread.start()
+
+    def command_stats(self, command, priority=False):
+        table = self.priority_stats if priority else self.stats_by_command
+        stats = table.get(command)
+        if stats is None:
+            name = f"{command}_priority" if priority else command
+            stats = table[command] = RoundTripStats(name, self.window)
+        return stats
+
+    def send(self, command, value=0, priority=False):
+        """publish a command and return its correlation id"""
+        with self.lock:
+            command_id = self.next_id
+            self.next_id += 1
+            payload = json.dumps({"id": command_id, "value": value})
+            self.outstanding[command_id] = (command, payload, time.perf_counter(), priority)
+            self.command_stats(command, priority).sent += 1
+        self.client.publish(f"ev3/control/{command}", payload, qos=1 if priority else 0)
+        return command_id
+
+    def send_priority(self, command, value=0):
+        return self.send(command, value, priority=True)
+
+    def ack(self, command_id):
+        """record the ack of command_id, return its round trip in seconds or None if unknown"""
+        now = time.perf_counter()
+        with self.lock:
+            entry = self.outstanding.pop(command_id, None)
+            if entry is None:
+                return None
+            command, _, sent, priority = entry
+            rtt = now - sent
+            self.command_stats(command, priority).add(rtt)
+        return rtt
+
+    def on_ack_message(self, the_client, user_data, msg):
+        """message handler for ev3/ack, a malformed ack is logged, counted and dropped"""
+        # an exception here would end the transport's network thread
+        try:
+            self.ack(json.loads(msg.payload.decode("utf-8"))["id"])
+        except (ValueError, KeyError, TypeError) as err:
+            BAD_ACKS.inc()
+            logging.warning("dropped %s message: %r", msg.topic, err)
+
+    def watch(self):
+        while self.running:
+            time.sleep(self.retry_interval)
+            self.check()
+
+    def check(self):
+        """ expire commands past their timeout and resend unacknowledged priority commands,
+            return the ids of the expired commands
+        """
+        now = time.perf_counter()
+        expired = []
+        resend = []
+        with self.lock:
+            for command_id, (command, payload, sent, priority) in list(self.outstanding.items()):
+                if now - sent > self.timeout:
+                    del self.outstanding[command_id]
+                    self.command_stats(command, priority).timeouts += 1
+                    expired.append(command_id)
+                elif priority:
+                    resend.append((command, payload))
+        for command, payload in resend:
+            self.client.publish(f"ev3/control/{command}", payload, qos=1)
+        return expired
+
+    def close(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+    def stats(self):
+        """return {command: rtt summary}, priority commands under "<command> (priority)" """
+        with self.lock:
+            summary = {command: stats.summary() for command, stats in self.stats_by_command.items()}
+            summary.update({f"{command} (priority)": stats.summary()
+                            for command, stats in self.priority_stats.items()})
+            return summary
+
+
+class AsyncCommandTracker(CommandTracker):
+    """ CommandTracker on an asyncio event loop whose commands can be awaited
+
+        request() publishes at once and returns a future resolving to the round trip
+        time in seconds when the ack arrives, or failing with TimeoutError. Acks must be
+        delivered on the loop, as the asyncio transports do.
+    """
+
+    def __init__(self, client, timeout=2.0, retry_interval=0.1, window=100):
+        super().__init__(client, timeout, retry_interval, window, threaded=False)
+        self.waiters = {}
+        self.task = None
+
+    def start(self):
+        """start checking timeouts and resends on the running event loop"""
+        self.task = asyncio.get_running_loop().create_task(self.watch_async())
+
+    async def watch_async(self):
+        while self.running:
+            await asyncio.sleep(self.retry_interval)
+            for command_id in self.check():
+                waiter = self.waiters.pop(command_id, None)
+                if waiter is not None and not waiter.done():
+                    waiter.set_exception(TimeoutError(f"command {command_id} not acknowledged"))
+
+    def request(self, command, value=0, priority=False):
+        """publish a command and return a future of its round trip time"""
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters[self.send(command, value, priority)] = waiter
+        return waiter
+
+    def ack(self, command_id):
+        rtt = super().ack(command_id)
+        waiter = self.waiters.pop(command_id, None)
+        if rtt is not None and waiter is not None and not waiter.done():
+            waiter.set_result(rtt)
+        return rtt
+
+    def close(self):
+        self.running = False
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        for waiter in self.waiters.values():
+            waiter.cancel()
+        self.waiters = {}
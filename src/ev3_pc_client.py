@@ -18,19 +18,32 @@ import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasAgg
 import EV3_Controller as ev3
+import metrics
 
+RENDER_SECONDS = metrics.REGISTRY.histogram("ui_figure_render_seconds",
+                                            "time to render the map figure")
 
 
-def the_thread(window: sg.Window, map_data):
+
+def the_thread(window: sg.Window, robot):
     """
     The thread that communicates with the application through the window's events.
 
     Because the figure creation time is greater than the GUI drawing time, it's safe
     to send a non-regulated stream of events without fear of overrunning the communication queue
+
+    A figure is only rendered when the map has changed since the last one.
     """
+    map_version = -1
     while True:
-        fig = your_matplotlib_code(map_data)
+        map_version, changes = robot.map_changes_since(map_version)
+        if not changes:
+            time.sleep(0.05)
+            continue
+        start = time.perf_counter()
+        fig = your_matplotlib_code(robot.get_map_grid())
         buf = draw_figure(fig)
+        RENDER_SECONDS.observe(time.perf_counter() - start)
         window.write_event_value("-THREAD-", buf)  # Data sent is a tuple of thread name and counter
 
 def your_matplotlib_code(map_data):
@@ -245,7 +258,7 @@ def main():
     # Event Loop to process "events" and get the "values" of the inputs 
     window["-IMAGE-"].update(visible=True)
     start_time = time.time()
-    window.start_thread(lambda: the_thread(window, robot.get_map_grid()), "-THEAD FINISHED-")
+    window.start_thread(lambda: the_thread(window, robot), "-THEAD FINISHED-")
 
     while True:  # Event Loop
         event, values = window.read()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# supervise several EV3s sharing one occupancy grid
+
+import json
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import ingestion
+import localization
+import occupancy_grid as grid
+import sensor_codec
+import telemetry
+import transport as transports
+
+# sensor model of the EV3 ultrasonic sensor, as used by EV3Supervisor.ultra_samples
+BEAMWIDTH = 10
+BEAM_RES = 0.1
+RANGE_MAX = 2.55
+RANGE_RES = 0.01
+
+# sensor model grid of a worker process
+_worker_grid = None
+
+
+def _init_worker(resolution, storage, log_odds_min, log_odds_max):
+    global _worker_grid
+    _worker_grid = grid.Occupancy_Grid(0, 0, resolution, storage=storage,
+                                       log_odds_min=log_odds_min, log_odds_max=log_odds_max)
+
+
+def _log_odds_contributions(poses, headings, ranges):
+    """worker side of Occupancy_Grid.log_odds_contributions for one robot's readings"""
+    return _worker_grid.log_odds_contributions(poses, headings, ranges, BEAMWIDTH, BEAM_RES,
+                                               RANGE_MAX, RANGE_RES)
+
+
+class RobotState():
+    """position, last readings, telemetry and ingestion lag of one robot of the fleet"""
+
+    def __init__(self, robot_id, x, y, telemetry_capacity=4096):
+        self.robot_id = robot_id
+        self.x = x
+        self.y = y
+        self.heading = 0.0
+        self.ultra_range = 0.0
+        self.telemetry = telemetry.TelemetryStore(telemetry_capacity)
+        self.readings = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.over_budget = 0
+
+    def stats(self):
+        return {"readings": self.readings, "last_lag": self.last_lag, "max_lag": self.max_lag,
+                "over_budget": self.over_budget}
+
+
+class FleetSupervisor():
+    """ supervise every robot publishing on ev3/<robot id>/sensor/<hdg|ultra|accel>
+
+        One wildcard subscription receives all the robots, messages are routed by the
+        robot id in the topic to a RobotState created on first contact, at its pose in
+        start_poses or the middle of the map.
+
+        All robots map into one shared grid kept as log-odds (storage "int16" or "int8").
+        Log-odds updates add, so the readings of each robot in a batch are turned into
+        per-cell increments independently, in a process pool of num_workers when
+        num_workers > 0, and then added to the shared grid one robot at a time. The float
+        storage mode halves free cells, which does not add, and is not supported.
+
+        A reading is late when it reaches the map more than latency_budget seconds after
+        it was taken; per robot lag and late counts are returned by robot_stats().
+    """
+
+    SENSOR_TOPIC = "ev3/+/sensor/#"
+
+    def __init__(self, map_size=8, resolution=0.01, storage="int16", map_file=None,
+                 num_workers=0, queue_size=4096, overflow="drop-oldest", latency_budget=0.1,
+                 start_poses=None, transport=None):
+        self.map_grid = grid.Occupancy_Grid(map_size, map_size, resolution, storage=storage,
+                                            map_file=map_file)
+        if not self.map_grid.fixed_point:
+            raise ValueError("the fleet map needs a log-odds storage mode, int16 or int8")
+        self.latency_budget = latency_budget
+        self.start_poses = start_poses or {}
+        self.robots = {}
+        self.pool = None
+        if num_workers > 0:
+            # the workers start once the map worker thread runs, so they are not forked
+            self.pool = ProcessPoolExecutor(num_workers, mp_context=localization.worker_context(),
+                                            initializer=_init_worker,
+                                            initargs=(self.map_grid.resolution, self.map_grid.storage,
+                                                      self.map_grid.log_odds_min,
+                                                      self.map_grid.log_odds_max))
+        # called with (robot id, sample timestamps) after a robot's readings reach the map
+        self.map_listeners = []
+        self.connected = False
+
+        # a robot's heading replaces its queued heading, a range reading replaces a queued
+        # reading of the same robot at the same heading
+        merge = {"hdg": lambda queued, new: new if queued[0] == new[0] else None,
+                 "ultra": lambda queued, new: new if queued[0] == new[0] and
+                 abs(queued[1][1] - new[1][1]) < 0.5 else None}
+        self.samples = ingestion.SampleQueue(queue_size, overflow, merge)
+        self.map_worker = ingestion.MapUpdateWorker(self.samples, self.apply_samples,
+                                                    max_batch=1024)
+        self.map_worker.start()
+
+        self.client = transports.PahoTransport() if transport is None else transport
+        self.client.on_connect = self.on_connect
+
+    def connect(self):
+        self.client.connect()
+
+    def on_connect(self, client, userdata, flags, rc):
+        self.connected = True
+        logging.info("Fleet connected flags %s result code %s", str(flags), str(rc))
+        self.client.subscribe(self.SENSOR_TOPIC, self.on_sensor_message)
+
+    def close(self):
+        """disconnect, apply the queued samples and stop the worker processes"""
+        self.client.disconnect()
+        self.connected = False
+        self.map_worker.stop()
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def robot(self, robot_id):
+        """return the state of robot_id, creating it on first contact"""
+        state = self.robots.get(robot_id)
+        if state is None:
+            shape = self.map_grid.log_odds_prob.shape
+            x, y = self.start_poses.get(robot_id, (shape[0]//2, shape[1]//2))
+            state = self.robots.setdefault(robot_id, RobotState(robot_id, x, y))
+        return state
+
+    def on_sensor_message(self, the_client, user_data, msg):
+        """route a sensor message by the robot id in its topic to the ingestion queue"""
+        levels = msg.topic.split("/")
+        if len(levels) != 4 or levels[2] != "sensor" or levels[3] not in sensor_codec.RECORDS:
+            logging.debug("ignored fleet message on %s", msg.topic)
+            return
+        robot_id, kind = levels[1], levels[3]
+        try:
+            samples = sensor_codec.decode(msg.payload, kind)
+        except ValueError as err:
+            logging.warning("dropped %s message: %s", msg.topic, err)
+            return
+        for sample in samples:
+            self.samples.put(kind, (robot_id, sample))
+
+    def apply_samples(self, batch):
+        """ apply a batch of queued (kind, (robot id, sample)) on the map update worker,
+            all the range readings of the batch reach the map together
+        """
+        readings = {}
+        for kind, (robot_id, sample) in batch:
+            state = self.robot(robot_id)
+            if kind == "ultra":
+                state.heading = sample[1]
+                state.ultra_range = sample[2]/100
+                state.telemetry.record("range", sample[0], state.ultra_range)
+                poses, headings, ranges, times = readings.setdefault(robot_id, ([], [], [], []))
+                poses.append((round(state.x), round(state.y)))
+                headings.append(sample[1])
+                ranges.append(state.ultra_range)
+                times.append(sample[0])
+            elif kind == "hdg":
+                state.heading = sample[1]
+                state.telemetry.record("hdg", sample[0], sample[1])
+            elif kind == "accel":
+                state.telemetry.record("accel", sample[0], sample[1:4])
+        if not readings:
+            return
+
+        if self.pool is not None:
+            futures = {robot_id: self.pool.submit(_log_odds_contributions, *reading[:3])
+                       for robot_id, reading in readings.items()}
+            results = {robot_id: future.result() for robot_id, future in futures.items()}
+        else:
+            results = {robot_id: self.map_grid.log_odds_contributions(
+                           *reading[:3], BEAMWIDTH, BEAM_RES, RANGE_MAX, RANGE_RES)
+                       for robot_id, reading in readings.items()}
+        with self.map_grid.write_lock:
+            for cell_x, cell_y, increments in results.values():
+                self.map_grid.add_log_odds(cell_x, cell_y, increments)
+            self.map_grid.publish()
+
+        now = time.time()
+        for robot_id, (_, _, _, times) in readings.items():
+            state = self.robots[robot_id]
+            lag = now - np.array(times)
+            state.readings += len(times)
+            state.last_lag = float(lag[-1])
+            state.max_lag = max(state.max_lag, float(lag.max()))
+            state.over_budget += int(np.count_nonzero(lag > self.latency_budget))
+            for listener in self.map_listeners:
+                listener(robot_id, times)
+
+    def set_pose(self, robot_id, x, y):
+        """place a robot at map cell (x, y)"""
+        state = self.robot(robot_id)
+        state.x, state.y = x, y
+
+    def publish_command(self, robot_id, command, payload=0):
+        """publish a control command to one robot on ev3/<robot id>/control/<command>"""
+        self.client.publish(f"ev3/{robot_id}/control/{command}", json.dumps(payload))
+
+    def get_map_snapshot(self):
+        return self.map_grid.snapshot_view()
+
+    def robot_stats(self):
+        """return {robot id: readings, last and max lag in seconds, readings over budget}"""
+        return {robot_id: state.stats() for robot_id, state in list(self.robots.items())}
+
+    def ingest_stats(self):
+        return self.map_worker.stats()
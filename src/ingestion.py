@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+# bounded queue between the MQTT callbacks and the thread applying map updates, and its
+# asyncio counterpart where both sides run on one event loop
+
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+
+OVERFLOW_POLICIES = ("block", "drop-oldest", "merge")
+
+
+class SampleQueue():
+    """ bounded FIFO of (kind, sample) pairs with an overflow policy
+
+        When the queue holds maxsize samples put either
+        "block"       - waits for the consumer to make room
+        "drop-oldest" - discards the oldest queued sample
+        "merge"       - combines the new sample with the newest queued sample of the same
+                        kind using merge[kind](queued, new), which returns the combined
+                        sample or None when they cannot be combined; then it drops the
+                        oldest sample instead
+        Counters of what happened to the samples are returned by stats().
+    """
+
+    def __init__(self, maxsize=1024, overflow="drop-oldest", merge=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"unknown overflow policy {overflow!r}")
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.merge = merge or {}
+        self.items = deque()
+        self.ready = threading.Condition()
+        self.closed = False
+        # samples handed to the consumer and not yet marked done
+        self.in_flight = 0
+        self.enqueued = 0
+        self.dropped = 0
+        self.merged = 0
+        self.max_depth = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, kind, sample):
+        """queue a sample, stamped with its arrival time for the lag counters"""
+        with self.ready:
+            if len(self.items) >= self.maxsize:
+                if self.merge_tail(kind, sample):
+                    return
+                if self.overflow == "block":
+                    while len(self.items) >= self.maxsize and not self.closed:
+                        self.ready.wait()
+                else:
+                    self.items.popleft()
+                    self.dropped += 1
+            self.items.append((kind, sample, time.monotonic()))
+            self.enqueued += 1
+            self.max_depth = max(self.max_depth, len(self.items))
+            self.ready.notify_all()
+
+    def merge_tail(self, kind, sample):
+        """with the merge policy fold sample into the newest queued one of its kind"""
+        if self.overflow != "merge" or kind not in self.merge:
+            return False
+        for i in range(len(self.items) - 1, -1, -1):
+            queued_kind, queued, stamp = self.items[i]
+            if queued_kind == kind:
+                combined = self.merge[kind](queued, sample)
+                if combined is None:
+                    return False
+                # the merged sample keeps the arrival time of the older one
+                self.items[i] = (kind, combined, stamp)
+                self.merged += 1
+                return True
+        return False
+
+    def get_batch(self, max_items=256, timeout=None):
+        """ wait for samples and return up to max_items of them as [(kind, sample, arrival)],
+            an empty list on timeout or once the queue is closed and empty
+        """
+        with self.ready:
+            if not self.items and not self.closed:
+                self.ready.wait(timeout)
+            batch = [self.items.popleft() for _ in range(min(max_items, len(self.items)))]
+            self.in_flight += len(batch)
+            if batch:
+                self.ready.notify_all()
+            return batch
+
+    def batch_done(self, batch):
+        """mark a batch from get_batch as applied"""
+        with self.ready:
+            self.in_flight -= len(batch)
+            self.ready.notify_all()
+
+    def join(self):
+        """wait until every queued sample has been taken and applied"""
+        with self.ready:
+            while self.items or self.in_flight:
+                self.ready.wait()
+
+    def close(self):
+        """wake up every waiting producer and consumer"""
+        with self.ready:
+            self.closed = True
+            self.ready.notify_all()
+
+    def stats(self):
+        """return the queue depth and sample counters"""
+        with self.ready:
+            return {"depth": len(self.items), "max_depth": self.max_depth,
+                    "enqueued": self.enqueued, "dropped": self.dropped, "merged": self.merged}
+
+
+class MapUpdateWorker(threading.Thread):
+    """ daemon thread draining a SampleQueue in batches
+
+        apply is called with each batch as a list of (kind, sample) in arrival order, so
+        a burst of readings is applied together. Lag is the time a sample waited in the
+        queue before its batch was applied. A batch whose apply raises is logged, counted
+        in failed_batches and skipped. on_idle, when given, is called whenever no sample
+        arrived for idle_interval seconds, e.g. to flush work held back for later samples.
+    """
+
+    def __init__(self, queue, apply, max_batch=256, on_idle=None, idle_interval=0.1):
+        super().__init__(name="map-update", daemon=True)
+        self.queue = queue
+        self.apply = apply
+        self.max_batch = max_batch
+        self.on_idle = on_idle
+        self.idle_interval = idle_interval
+        self.applied = 0
+        self.batches = 0
+        self.failed_batches = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def run(self):
+        while True:
+            batch = self.queue.get_batch(self.max_batch, timeout=self.idle_interval)
+            if not batch:
+                if self.queue.closed:
+                    return
+                if self.on_idle is not None:
+                    try:
+                        self.on_idle()
+                    except Exception:
+                        logging.exception("map update idle hook failed")
+                continue
+            try:
+                self.apply([(kind, sample) for kind, sample, _ in batch])
+            except Exception:
+                self.failed_batches += 1
+                logging.exception("map update of a batch of %d samples failed", len(batch))
+            else:
+                self.last_lag = time.monotonic() - batch[0][2]
+                self.max_lag = max(self.max_lag, self.last_lag)
+                self.applied += len(batch)
+                self.batches += 1
+            finally:
+                self.queue.batch_done(batch)
+
+    def drain(self):
+        """wait until every sample queued so far has been applied"""
+        self.queue.join()
+
+    def stop(self):
+        """finish the queued samples and wait for the thread to exit"""
+        self.queue.close()
+        self.join()
+
+    def stats(self):
+        """queue counters plus applied samples, batches, failed batches and lag in seconds"""
+        stats = self.queue.stats()
+        stats.update(applied=self.applied, batches=self.batches,
+                     failed_batches=self.failed_batches, last_lag=self.last_lag,
+                     max_lag=self.max_lag)
+        return stats
+
+
+class AsyncSampleQueue():
+    """ FIFO of (kind, sample) pairs between message callbacks and an AsyncMapUpdateWorker
+        running on the same event loop
+
+        Nothing is dropped: once maxsize samples are queued on_pause() is called, e.g. the
+        transport's pause_reading, and on_resume() once the worker has taken the queue
+        down to resume_at, by default half of maxsize. Samples of a message already being
+        delivered are still queued, so the depth may briefly pass maxsize.
+    """
+
+    def __init__(self, maxsize=1024, resume_at=None, on_pause=None, on_resume=None):
+        self.maxsize = maxsize
+        self.resume_at = maxsize//2 if resume_at is None else resume_at
+        self.on_pause = on_pause
+        self.on_resume = on_resume
+        self.items = deque()
+        self.ready = asyncio.Event()
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.closed = False
+        self.paused = False
+        self.in_flight = 0
+        self.enqueued = 0
+        self.pauses = 0
+        self.max_depth = 0
+        # kept for the counters shared with SampleQueue
+        self.dropped = 0
+        self.merged = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, kind, sample):
+        """queue a sample, pausing the producer when the queue is full"""
+        self.items.append((kind, sample, time.monotonic()))
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, len(self.items))
+        self.idle.clear()
+        self.ready.set()
+        if len(self.items) >= self.maxsize and not self.paused:
+            self.paused = True
+            self.pauses += 1
+            if self.on_pause is not None:
+                self.on_pause()
+
+    async def get_batch(self, max_items=256, timeout=None):
+        """ wait for samples and return up to max_items of them as [(kind, sample, arrival)],
+            an empty list on timeout or once the queue is closed and empty
+        """
+        while not self.items and not self.closed:
+            self.ready.clear()
+            try:
+                await asyncio.wait_for(self.ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return []
+        batch = [self.items.popleft() for _ in range(min(max_items, len(self.items)))]
+        self.in_flight += len(batch)
+        if self.paused and len(self.items) <= self.resume_at:
+            self.paused = False
+            if self.on_resume is not None:
+                self.on_resume()
+        return batch
+
+    def batch_done(self, batch):
+        """mark a batch from get_batch as applied"""
+        self.in_flight -= len(batch)
+        if not self.items and not self.in_flight:
+            self.idle.set()
+
+    async def join(self):
+        """wait until every queued sample has been taken and applied"""
+        await self.idle.wait()
+
+    def close(self):
+        """wake up the waiting consumer"""
+        self.closed = True
+        self.ready.set()
+
+    def stats(self):
+        """return the queue depth and sample counters"""
+        return {"depth": len(self.items), "max_depth": self.max_depth, "enqueued": self.enqueued,
+                "dropped": self.dropped, "merged": self.merged, "pauses": self.pauses}
+
+
+class AsyncMapUpdateWorker():
+    """ task draining an AsyncSampleQueue in batches, the asyncio MapUpdateWorker
+
+        apply runs on the event loop between batches, or in the loop's default executor
+        with offload so a long map update does not hold up the other tasks. After each
+        batch every batch listener is called on the loop with the applied batch. A batch
+        whose apply raises is logged, counted in failed_batches and skipped. on_idle,
+        when given, runs like apply whenever no sample arrived for idle_interval seconds,
+        and the listeners are then called with an empty batch.
+    """
+
+    def __init__(self, queue, apply, max_batch=256, offload=False, on_idle=None,
+                 idle_interval=0.1):
+        self.queue = queue
+        self.apply = apply
+        self.max_batch = max_batch
+        self.offload = offload
+        self.on_idle = on_idle
+        self.idle_interval = idle_interval
+        self.batch_listeners = []
+        self.task = None
+        self.applied = 0
+        self.batches = 0
+        self.failed_batches = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def start(self):
+        """start the worker task on the running event loop"""
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def call(self, func, *args):
+        """run func on the loop, or in the default executor with offload"""
+        if self.offload:
+            await asyncio.get_running_loop().run_in_executor(None, func, *args)
+        else:
+            func(*args)
+
+    async def run(self):
+        timeout = None if self.on_idle is None else self.idle_interval
+        while True:
+            batch = await self.queue.get_batch(self.max_batch, timeout)
+            if batch:
+                samples = await self.apply_batch(batch)
+            elif self.queue.closed:
+                return
+            else:
+                samples = await self.idle()
+            if samples is not None:
+                for listener in self.batch_listeners:
+                    listener(samples)
+            # let the transport and the UI run between batches
+            await asyncio.sleep(0)
+
+    async def apply_batch(self, batch):
+        """apply a batch, return its (kind, sample) list or None when apply failed"""
+        samples = [(kind, sample) for kind, sample, _ in batch]
+        try:
+            await self.call(self.apply, samples)
+        except Exception:
+            self.failed_batches += 1
+            logging.exception("map update of a batch of %d samples failed", len(batch))
+            return None
+        finally:
+            self.queue.batch_done(batch)
+        self.last_lag = time.monotonic() - batch[0][2]
+        self.max_lag = max(self.max_lag, self.last_lag)
+        self.applied += len(batch)
+        self.batches += 1
+        return samples
+
+    async def idle(self):
+        """run on_idle, return an empty batch for the listeners or None when it failed"""
+        try:
+            await self.call(self.on_idle)
+        except Exception:
+            logging.exception("map update idle hook failed")
+            return None
+        return []
+
+    async def drain(self):
+        """wait until every sample queued so far has been applied"""
+        await self.queue.join()
+
+    async def stop(self):
+        """finish the queued samples and wait for the task to exit"""
+        self.queue.close()
+        if self.task is not None:
+            await self.task
+            self.task = None
+
+    def stats(self):
+        """queue counters plus applied samples, batches, failed batches and lag in seconds"""
+        stats = self.queue.stats()
+        stats.update(applied=self.applied, batches=self.batches,
+                     failed_batches=self.failed_batches, last_lag=self.last_lag,
+                     max_lag=self.max_lag)
+        return stats
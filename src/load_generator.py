@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# synthetic sensor traffic through an in-process broker to load test EV3Supervisor
+#
+#  python load_generator.py --rates 50,200,800 --duration 5
+#  python load_generator.py --rates 400 --batch 10 --format binary
+#  python load_generator.py --rates 20,40 --robots 12 --workers 4
+#
+# For each ultra rate the generator publishes ev3/sensor/ultra, hdg and accel traffic for
+# duration seconds, then reports the throughput achieved and the latency from publish to
+# map update. With --robots the traffic of that many robots goes to a FleetSupervisor
+# at the given rate per robot and the latency is reported for the worst robot. The
+# saturation point is the rate where achieved throughput stops following
+# the offered rate and the latency percentiles climb.
+
+import argparse
+import threading
+import time
+import numpy as np
+import EV3_Controller
+import fleet
+import sensor_codec
+import transport
+
+
+def encode(kind, samples, binary):
+    return sensor_codec.encode(kind, samples) if binary else sensor_codec.encode_json(samples)
+
+
+def publish_traffic(client, rate, duration, batch, hdg_rate, accel_rate, binary, seed=0,
+                    prefixes=("ev3",)):
+    """ publish ultra samples at rate per second in messages of batch samples, with hdg and
+        accel messages at their own rates; the sample time is the publish time. Every
+        topic prefix, e.g. ev3/<robot id>, gets its own streams
+    """
+    rand = np.random.default_rng(seed)
+    streams = [(prefix, kind, msg_rate) for prefix in prefixes
+               for kind, msg_rate in (("ultra", rate/batch), ("hdg", hdg_rate), ("accel", accel_rate))]
+    # stagger the robots so their messages do not all fall due together
+    due = {(prefix, kind): i/max(rate/batch, 1)/len(prefixes)
+           for i, prefix in enumerate(prefixes) for kind in ("ultra", "hdg", "accel")}
+    start = time.perf_counter()
+    published = 0
+    while True:
+        elapsed = time.perf_counter() - start
+        if elapsed >= duration:
+            return published
+        for prefix, kind, msg_rate in streams:
+            if msg_rate <= 0 or elapsed < due[(prefix, kind)]:
+                continue
+            due[(prefix, kind)] += 1/msg_rate
+            now = time.time()
+            if kind == "ultra":
+                samples = [[now, float(rand.uniform(0, 360)), float(rand.integers(5, 255))]
+                           for _ in range(batch)]
+                published += batch
+            elif kind == "hdg":
+                samples = [[now, float(rand.uniform(0, 360))]]
+            else:
+                samples = [[now, *rand.normal(0, 0.1, 3).tolist()]]
+            client.publish(f"{prefix}/sensor/{kind}", encode(kind, samples, binary))
+        next_due = min(due[(prefix, kind)] for prefix, kind, msg_rate in streams if msg_rate > 0)
+        time.sleep(max(0.0, min(next_due - (time.perf_counter() - start), 0.001)))
+
+
+def run_step(rate, args):
+    """run one load step at rate ultra samples per second and return its report"""
+    client = transport.LoopbackTransport()
+    robot = EV3_Controller.EV3Supervisor(queue_size=args.queue_size, overflow=args.overflow,
+                                         transport=client)
+    latencies = []
+    lock = threading.Lock()
+
+    def on_map_update(times):
+        now = time.time()
+        with lock:
+            latencies.extend(now - t for t in times)
+
+    robot.map_listeners.append(on_map_update)
+    robot.connect_mqtt()
+    start = time.perf_counter()
+    published = publish_traffic(client, rate, args.duration, args.batch, args.hdg_rate,
+                                args.accel_rate, args.format == "binary")
+    offered = time.perf_counter() - start
+    client.disconnect()
+    robot.map_worker.drain()
+    robot.release_ranges(flush=True)
+    elapsed = time.perf_counter() - start
+    stats = robot.ingest_stats()
+    robot.close_comms()
+    latency = np.array(latencies)*1e3
+    p50, p99 = np.percentile(latency, [50, 99]) if len(latency) else (np.nan, np.nan)
+    return (f"ultra {rate:7.0f}/s offered {published/offered:7.0f}/s "
+            f"mapped {len(latency)/elapsed:7.0f}/s  latency p50 {p50:7.1f} ms p99 {p99:7.1f} ms  "
+            f"dropped {stats['dropped']} merged {stats['merged']} max depth {stats['max_depth']}")
+
+
+def run_fleet_step(rate, args):
+    """run one load step of args.robots robots at rate ultra samples per second each"""
+    client = transport.LoopbackTransport()
+    supervisor = fleet.FleetSupervisor(num_workers=args.workers, queue_size=args.queue_size,
+                                       overflow=args.overflow, transport=client)
+    latencies = {}
+    lock = threading.Lock()
+
+    def on_map_update(robot_id, times):
+        now = time.time()
+        with lock:
+            latencies.setdefault(robot_id, []).extend(now - t for t in times)
+
+    supervisor.map_listeners.append(on_map_update)
+    supervisor.connect()
+    prefixes = [f"ev3/robot{i}" for i in range(args.robots)]
+    start = time.perf_counter()
+    published = publish_traffic(client, rate, args.duration, args.batch, args.hdg_rate,
+                                args.accel_rate, args.format == "binary", prefixes=prefixes)
+    offered = time.perf_counter() - start
+    client.disconnect()
+    supervisor.map_worker.drain()
+    elapsed = time.perf_counter() - start
+    stats = supervisor.ingest_stats()
+    supervisor.close()
+    mapped = sum(len(lags) for lags in latencies.values())
+    p50, p99 = np.nan, np.nan
+    if latencies:
+        p50 = max(np.percentile(lags, 50) for lags in latencies.values())*1e3
+        p99 = max(np.percentile(lags, 99) for lags in latencies.values())*1e3
+    return (f"{args.robots} robots x ultra {rate:5.0f}/s offered {published/offered:7.0f}/s "
+            f"mapped {mapped/elapsed:7.0f}/s  worst robot latency p50 {p50:7.1f} ms "
+            f"p99 {p99:7.1f} ms  dropped {stats['dropped']} max depth {stats['max_depth']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="load test the EV3Supervisor ingestion path")
+    parser.add_argument("--rates", default="50,100,200,400,800",
+                        help="comma separated ultra samples per second, one step each")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per step")
+    parser.add_argument("--batch", type=int, default=1, help="ultra samples per message")
+    parser.add_argument("--hdg-rate", type=float, default=20.0, help="hdg messages per second")
+    parser.add_argument("--accel-rate", type=float, default=20.0, help="accel messages per second")
+    parser.add_argument("--robots", type=int, default=0,
+                        help="robots of a FleetSupervisor, rates are then per robot")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="fleet sensor model worker processes")
+    parser.add_argument("--format", choices=("json", "binary"), default="json")
+    parser.add_argument("--queue-size", type=int, default=1024)
+    parser.add_argument("--overflow", choices=("block", "drop-oldest", "merge"), default="drop-oldest")
+    args = parser.parse_args()
+    for rate in args.rates.split(","):
+        step = run_fleet_step if args.robots > 0 else run_step
+        print(step(float(rate), args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# Monte Carlo localization of the EV3 against its occupancy grid
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+
+# shared memory blocks attached by a worker process, by name
+_worker_blocks = {}
+
+
+def worker_context():
+    """ return the multiprocessing context of worker pools: forkserver, or spawn where
+        the platform has no forkserver
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+def likelihood_weights(distance, x_min, y_min, particles, hdg, rng_cells, sigma_cells):
+    """ return the log-likelihood of a range reading for each particle
+
+        The reading end point of each particle is looked up in the distance field, the
+        distance in cells to the nearest occupied cell, and scored with a gaussian of
+        sigma_cells. End points off the map or on a map with no obstacles score as if
+        they were 3 sigma from an obstacle.
+    """
+    angle = np.radians(hdg)
+    end_x = np.rint(particles[:, 0] + rng_cells*np.cos(angle)).astype(int) - x_min
+    end_y = np.rint(particles[:, 1] + rng_cells*np.sin(angle)).astype(int) - y_min
+    inside = (end_x >= 0) & (end_x < distance.shape[0]) & (end_y >= 0) & (end_y < distance.shape[1])
+    miss = 3*sigma_cells
+    clearance = np.full(len(particles), miss, dtype=float)
+    clearance[inside] = np.minimum(distance[end_x[inside], end_y[inside]], miss)
+    return -0.5*(clearance/sigma_cells)**2
+
+
+def _attach(name):
+    """return the shared memory block called name, attaching it on first use"""
+    block = _worker_blocks.get(name)
+    if block is None:
+        block = shared_memory.SharedMemory(name=name)
+        _worker_blocks[name] = block
+    return block
+
+
+def _shared_weights(blocks, shape, x_min, y_min, num_particles, start, stop, hdg, rng_cells,
+                    sigma_cells):
+    """ worker side of likelihood_weights, the distance field, the particles and the
+        log weights all live in the shared memory blocks named by blocks; the worker
+        scores particles [start, stop)
+    """
+    field_name, particles_name, weights_name = blocks
+    distance = np.ndarray(shape, dtype=np.float32, buffer=_attach(field_name).buf)
+    particles = np.ndarray((num_particles, 2), buffer=_attach(particles_name).buf)
+    log_weights = np.ndarray(num_particles, buffer=_attach(weights_name).buf)
+    log_weights[start:stop] = likelihood_weights(distance, x_min, y_min, particles[start:stop],
+                                                 hdg, rng_cells, sigma_cells)
+
+
+class ParticleFilter:
+    """ particle filter estimating the robot position in map cells
+
+        The compass heading is trusted so particles only carry a position. Each range
+        reading diffuses the particles by motion_noise cells, weights them against the
+        grid distance field and resamples when the effective sample size drops below
+        half the particles. With num_workers > 0 the weighting is sharded across a
+        process pool. The distance field, the particles and the weights are kept in
+        shared memory so only slice bounds travel to the workers.
+    """
+
+    def __init__(self, grid, x, y, num_particles=10000, spread=10.0, motion_noise=1.0,
+                 sigma=0.05, num_workers=0, seed=None):
+        self.grid = grid
+        self.num_particles = num_particles
+        self.motion_noise = motion_noise
+        self.sigma_cells = sigma/grid.resolution
+        self.rng = np.random.default_rng(seed)
+        self.weights = np.full(num_particles, 1/num_particles)
+        self.heading = 0.0
+        self.num_workers = num_workers
+        self.pool = None
+        self._shared = None
+        self._shared_version = None
+        self._particle_block = None
+        self._weight_block = None
+        if num_workers > 0:
+            # the supervisor runs threads by now and forking them is unsafe, the workers
+            # only need this module and the shared memory names so they start fresh
+            self.pool = ProcessPoolExecutor(num_workers, mp_context=worker_context())
+            self._particle_block = shared_memory.SharedMemory(create=True, size=num_particles*16)
+            self._weight_block = shared_memory.SharedMemory(create=True, size=num_particles*8)
+            self.particles = np.ndarray((num_particles, 2), buffer=self._particle_block.buf)
+            self._log_weights = np.ndarray(num_particles, buffer=self._weight_block.buf)
+        else:
+            self.particles = np.empty((num_particles, 2))
+        self.particles[...] = np.array([x, y], dtype=float) + self.rng.normal(0, spread, (num_particles, 2))
+
+    def close(self):
+        """stop the worker pool and release the shared memory"""
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        for block in (self._shared, self._particle_block, self._weight_block):
+            if block is not None:
+                block.close()
+                block.unlink()
+        self._shared = self._particle_block = self._weight_block = None
+
+    def heading_sample(self, hdg):
+        """record a compass heading in degrees"""
+        self.heading = hdg
+
+    def range_sample(self, hdg, rng, rng_max):
+        """ update the particles with a range reading in meters taken at hdg degrees,
+            readings at or past rng_max are treated as no return and only diffuse
+        """
+        self.heading = hdg
+        self.particles += self.rng.normal(0, self.motion_noise, self.particles.shape)
+        if rng >= rng_max:
+            return
+        log_weights = self.log_likelihood(hdg, rng/self.grid.resolution)
+        log_weights += np.log(self.weights)
+        log_weights -= log_weights.max()
+        weights = np.exp(log_weights)
+        self.weights = weights/weights.sum()
+        if 1/np.sum(self.weights**2) < self.num_particles/2:
+            self.resample()
+
+    def log_likelihood(self, hdg, rng_cells):
+        """score every particle against the map, in the worker pool when there is one"""
+        distance, x_min, y_min = self.grid.distance_field()
+        if self.pool is None:
+            return likelihood_weights(distance, x_min, y_min, self.particles, hdg, rng_cells,
+                                      self.sigma_cells)
+        blocks = (self.share_distance_field(distance), self._particle_block.name,
+                  self._weight_block.name)
+        bounds = np.linspace(0, self.num_particles, self.num_workers + 1).astype(int)
+        futures = [self.pool.submit(_shared_weights, blocks, distance.shape, x_min, y_min,
+                                    self.num_particles, start, stop, hdg, rng_cells,
+                                    self.sigma_cells)
+                   for start, stop in zip(bounds[:-1], bounds[1:])]
+        for future in futures:
+            future.result()
+        return self._log_weights.copy()
+
+    def share_distance_field(self, distance):
+        """copy the distance field to shared memory when the map has changed, return its name"""
+        nbytes = distance.size * np.dtype(np.float32).itemsize
+        if self._shared is not None and self._shared.size < nbytes:
+            self._shared.close()
+            self._shared.unlink()
+            self._shared = None
+        if self._shared is None:
+            self._shared = shared_memory.SharedMemory(create=True, size=nbytes)
+            self._shared_version = None
+        key = (self.grid.distance_field_version, distance.shape)
+        if self._shared_version != key:
+            shared = np.ndarray(distance.shape, dtype=np.float32, buffer=self._shared.buf)
+            np.minimum(distance, np.finfo(np.float32).max, out=shared, casting="unsafe")
+            self._shared_version = key
+        return self._shared.name
+
+    def resample(self):
+        """systematic resampling of the particles by weight"""
+        positions = (self.rng.random() + np.arange(self.num_particles))/self.num_particles
+        index = np.searchsorted(np.cumsum(self.weights), positions)
+        self.particles[...] = self.particles[np.minimum(index, self.num_particles - 1)]
+        self.weights = np.full(self.num_particles, 1/self.num_particles)
+
+    def estimate(self):
+        """return the weighted mean position [x, y] in map cells"""
+        return [float(v) for v in np.average(self.particles, axis=0, weights=self.weights)]
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# logging that keeps file writes off the MQTT network thread
+#
+# start_queue_logging() routes the root logger through a bounded queue: the calling thread
+# only appends the record, a listener thread writes them to the log file in batches.
+# MessageLogSampler decides per topic whether a message is worth a debug line at all.
+
+import logging
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler
+
+LOG_FORMAT = '%(asctime)s %(message)s'
+LOG_DATEFMT = '%m/%d/%Y %I:%M:%S %p'
+
+
+class CompactQueueHandler(QueueHandler):
+    """ QueueHandler that leaves formatting to the listener and never blocks
+
+        The record is queued as is, so the message arguments must not be changed after
+        the call. When the queue is full the record is dropped and counted.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BatchingListener(threading.Thread):
+    """ daemon thread writing queued records to handler, flushing once per batch
+
+        A batch is whatever is queued when the thread wakes, up to batch_size records;
+        an idle listener still flushes within interval seconds.
+    """
+
+    def __init__(self, log_queue, handler, batch_size=256, interval=0.5):
+        super().__init__(name="log-writer", daemon=True)
+        self.queue = log_queue
+        self.handler = handler
+        self.batch_size = batch_size
+        self.interval = interval
+        self.batches = 0
+
+    def run(self):
+        while True:
+            try:
+                record = self.queue.get(timeout=self.interval)
+            except queue.Empty:
+                continue
+            batch = [record]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            for record in batch:
+                if record is not None:
+                    self.handler.handle(record)
+            self.handler.flush()
+            self.batches += 1
+            if stop:
+                return
+
+    def stop(self):
+        """write the queued records and wait for the thread to exit"""
+        self.queue.put(None)
+        self.join()
+
+
+class BufferedFileHandler(logging.FileHandler):
+    """file handler that only writes when flushed, so a batch costs a single write"""
+
+    def __init__(self, filename, encoding='utf-8'):
+        super().__init__(filename, encoding=encoding)
+        self.lines = []
+
+    def emit(self, record):
+        try:
+            self.lines.append(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.lines and self.stream is not None:
+                self.stream.write("".join(self.lines))
+                self.lines = []
+            super().flush()
+        finally:
+            self.release()
+
+
+_listener = None
+# level of the root logger before start_queue_logging lowered it, restored on stop
+_root_level = None
+
+
+def start_queue_logging(filename='EV3Control.log', level=logging.DEBUG, max_queue=10000,
+                        batch_size=256, interval=0.5):
+    """ send the root logger through a CompactQueueHandler to a BatchingListener writing
+        filename; return the listener. Calling it again returns the running listener
+
+        level applies to the queue handler. The root logger is only lowered to level when
+        it has no handlers yet, so logging set up by the application, including the
+        stderr handler logging adds on the first unconfigured call, keeps its level.
+    """
+    global _listener, _root_level
+    if _listener is not None:
+        return _listener
+    log_queue = queue.Queue(max_queue)
+    handler = BufferedFileHandler(filename)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT, LOG_DATEFMT))
+    queue_handler = CompactQueueHandler(log_queue)
+    queue_handler.setLevel(level)
+    root = logging.getLogger()
+    if not root.handlers:
+        _root_level = root.level
+        root.setLevel(level)
+    root.addHandler(queue_handler)
+    _listener = BatchingListener(log_queue, handler, batch_size, interval)
+    _listener.start()
+    return _listener
+
+
+def stop_queue_logging():
+    """write the queued records, then detach the queue handler and close the file"""
+    global _listener, _root_level
+    if _listener is None:
+        return
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, CompactQueueHandler):
+            root.removeHandler(handler)
+    if _root_level is not None:
+        root.setLevel(_root_level)
+        _root_level = None
+    _listener.stop()
+    _listener.handler.close()
+    _listener = None
+
+
+class MessageLogSampler():
+    """ per topic sampling and rate limit for message debug logging
+
+        allow(topic) is True for one message in sample_every of a topic, and at most
+        max_per_second of them per topic; a token bucket refills at max_per_second.
+        suppressed counts the messages allow() turned down per topic.
+    """
+
+    def __init__(self, sample_every=1, max_per_second=20.0):
+        self.sample_every = sample_every
+        self.max_per_second = max_per_second
+        self.seen = {}
+        self.tokens = {}
+        self.suppressed = {}
+
+    def allow(self, topic):
+        seen = self.seen.get(topic, 0)
+        self.seen[topic] = seen + 1
+        if seen % self.sample_every == 0:
+            now = time.monotonic()
+            tokens, last = self.tokens.get(topic, (self.max_per_second, now))
+            tokens = min(self.max_per_second, tokens + (now - last)*self.max_per_second)
+            if tokens >= 1:
+                self.tokens[topic] = (tokens - 1, now)
+                return True
+            self.tokens[topic] = (tokens, now)
+        self.suppressed[topic] = self.suppressed.get(topic, 0) + 1
+        return False
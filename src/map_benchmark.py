@@ -0,0 +1,765 @@
+#!/usr/bin/env python3
+# parity checks and timing for the occupancy grid sensor model
+#
+#  python map_benchmark.py
+
+import asyncio
+import json
+import logging
+import os
+import platform
+import tempfile
+import time
+from math import floor
+import numpy as np
+from scipy import ndimage
+import async_supervisor
+import occupancy_grid as og
+import localization
+import metrics
+import commands
+import fleet
+import ingestion
+import path_planner
+import sensor_codec
+import sensor_fusion
+import telemetry
+import tiled_grid as tg
+import transport
+
+# production sensor parameters used by EV3Supervisor.ultra_sample
+BEAMWIDTH = 10
+BEAM_RES = 0.1
+RANGE_MAX = 2.55
+RANGE_RES = 0.01
+
+
+def time_call(func, *args, repeat=20):
+    """return the mean wall time of func(*args) in seconds"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(*args)
+    return (time.perf_counter() - start)/repeat
+
+
+def range_bearing_sample_loop(hdg, bw, bw_res, rng, rng_max, rng_res):
+    """the original range_bearing_sample, one bresenham line and one python loop per ray"""
+    deg2rad = np.pi/180
+    range_cells_max = floor(rng_max/rng_res)
+    range_cells = floor(rng/rng_res)
+    center_angle = hdg*deg2rad
+    extent_angles = [center_angle + bw*deg2rad/2, center_angle, center_angle - bw*deg2rad/2]
+    beam = np.array([[0, 0]] + [[range_cells_max*np.cos(a), range_cells_max*np.sin(a)]
+                                for a in extent_angles])
+    num_x_pixels = int(np.ceil(beam[:, 0].max() - beam[:, 0].min()))
+    num_y_pixels = int(np.ceil(beam[:, 1].max() - beam[:, 1].min()))
+    sensor_reading = np.full((num_x_pixels, num_y_pixels), 0.5)
+    x_offset = int(np.abs(beam[:, 0].min()))
+    y_offset = int(np.abs(beam[:, 1].min()))
+    beam_origin = [x_offset, y_offset]
+
+    band = range_cells-36
+    for theta in np.arange(-bw/2*deg2rad, bw/2*deg2rad, deg2rad*bw_res) + center_angle:
+        edge = og.bresenham(beam_origin, [range_cells_max*np.cos(theta) + x_offset,
+                                          range_cells_max*np.sin(theta) + y_offset])
+        edge[0][edge[0] >= num_x_pixels] = num_x_pixels-1
+        edge[1][edge[1] >= num_y_pixels] = num_y_pixels-1
+        sensor_reading[tuple(edge)] = 0
+        for ind in range(edge.shape[1]):
+            cell = (edge[0, ind]-x_offset)**2 + (edge[1, ind]-y_offset)**2 - range_cells**2
+            if abs(cell) <= range_cells*2:
+                sensor_reading[tuple(edge[:, ind])] = 1.0
+            elif cell >= range_cells*2:
+                sensor_reading[tuple(edge[:, ind])] = 0.5
+            elif abs(cell) <= (range_cells-band)**2:
+                sensor_reading[tuple(edge[:, ind])] = 0.75
+    return sensor_reading, beam_origin, hdg
+
+
+def check_sensor_model_parity():
+    """ compare range_bearing_sample with the ray traced models over the sensor's range
+
+        The ray traced model must reproduce the original loop exactly. The cone
+        evaluator must match it on every cell inside the patch border; on the border
+        the rays fold the ends that leave the bounding box, so a few cells may differ.
+    """
+    grid = og.Occupancy_Grid(8, 8, RANGE_RES)
+    for hdg in np.arange(0, 360, 22.5) + 3.3:
+        for rng in (0.03, 0.3, 2.2, RANGE_MAX):
+            args = (hdg, BEAMWIDTH, BEAM_RES, rng, RANGE_MAX, RANGE_RES)
+            ref, ref_origin, _ = grid.range_bearing_sample_raycast(*args)
+            loop, loop_origin, _ = range_bearing_sample_loop(*args)
+            assert ref_origin == loop_origin and np.array_equal(ref, loop), (hdg, rng)
+
+    worst = 1.0
+    ranges = np.r_[0.03, 0.05, 0.1, 0.2, 0.3, np.arange(0.5, RANGE_MAX, 0.25), RANGE_MAX]
+    for hdg in np.arange(0, 360, 5) + 0.7:
+        for rng in ranges:
+            args = (hdg, BEAMWIDTH, BEAM_RES, rng, RANGE_MAX, RANGE_RES)
+            fast, fast_origin, _ = grid.range_bearing_sample(*args)
+            ref, ref_origin, _ = grid.range_bearing_sample_raycast(*args)
+            assert fast.shape == ref.shape, (hdg, rng, fast.shape, ref.shape)
+            assert fast_origin == ref_origin, (hdg, rng, fast_origin, ref_origin)
+            assert np.array_equal(fast[1:-1, 1:-1], ref[1:-1, 1:-1]), (hdg, rng)
+            marked = (fast != 0.5) | (ref != 0.5)
+            worst = min(worst, np.mean(fast[marked] == ref[marked]))
+    assert worst >= 0.99, worst
+    print(f"sensor model parity: interior exact, worst cell agreement {worst:.4f} "
+          f"over {ranges[0]}-{ranges[-1]} m")
+
+
+def bench_sensor_model():
+    """time the cone evaluator against the original loop and the ray traced model"""
+    grid = og.Occupancy_Grid(8, 8, RANGE_RES)
+    args = (45, BEAMWIDTH, BEAM_RES, 1.25, RANGE_MAX, RANGE_RES)
+    # best of several calls, so a busy machine does not skew the speedups
+    t_loop = min(time_call(range_bearing_sample_loop, *args, repeat=1) for _ in range(5))
+    t_ref = min(time_call(grid.range_bearing_sample_raycast, *args, repeat=1) for _ in range(10))
+    t_fast = min(time_call(grid.range_bearing_sample, *args, repeat=1) for _ in range(50))
+    print(f"range_bearing_sample: loop {t_loop*1e3:.1f} ms, raycast {t_ref*1e3:.2f} ms, "
+          f"vectorized {t_fast*1e3:.3f} ms, speedup {t_loop/t_fast:.0f}x over the loop, "
+          f"{t_ref/t_fast:.1f}x over the raycast")
+    assert t_loop/t_fast >= 20, t_loop/t_fast
+    return t_loop/t_fast
+
+
+def update_grid_per_cell(grid, data, x, y, x_offset=0, y_offset=0):
+    """reference update applying update_log_odds to one cell at a time"""
+    it = np.nditer(data, flags=['multi_index'])
+    for cell in it:
+        grid.update_log_odds(x-x_offset+it.multi_index[0], y-y_offset+it.multi_index[1], cell)
+
+
+def bench_update_grid():
+    """check the windowed update_grid against the per cell reference and time both"""
+    fast = og.Occupancy_Grid(5, 5, RANGE_RES)
+    ref = og.Occupancy_Grid(5, 5, RANGE_RES)
+    data, origin, _ = fast.range_bearing_sample(45, BEAMWIDTH, BEAM_RES, 1.25, RANGE_MAX, RANGE_RES)
+    args = (data, 250, 250, origin[0], origin[1])
+    fast.update_grid(*args)
+    update_grid_per_cell(ref, *args)
+    assert np.array_equal(fast.get_map(), ref.get_map())
+    t_ref = time_call(update_grid_per_cell, ref, *args, repeat=3)
+    t_fast = time_call(fast.update_grid, *args, repeat=50)
+    print(f"update_grid: per cell {t_ref*1e3:.2f} ms, "
+          f"windowed {t_fast*1e3:.3f} ms, speedup {t_ref/t_fast:.1f}x")
+
+
+def replay_scan(grid, headings, ranges):
+    """apply one ultra scan to the grid through sensor_reading"""
+    for hdg, rng in zip(headings, ranges):
+        grid.sensor_reading(400, 400, hdg, BEAMWIDTH, BEAM_RES, rng, RANGE_MAX, RANGE_RES)
+
+
+def bench_beam_cache(replays=5):
+    """replay the same 360 degree scan several times with and without the beam cache"""
+    headings = np.arange(0, 360, 1.0)
+    ranges = np.round(1.0 + 0.5*np.abs(np.sin(np.radians(headings))), 2)
+    cached = og.Occupancy_Grid(8, 8, RANGE_RES)
+    uncached = og.Occupancy_Grid(8, 8, RANGE_RES)
+    uncached.beam_cache = None
+    t_cold = time_call(replay_scan, cached, headings, ranges, repeat=1)
+    t_warm = time_call(replay_scan, cached, headings, ranges, repeat=replays)
+    t_none = time_call(replay_scan, uncached, headings, ranges, repeat=1)
+    print(f"360 deg scan: uncached {t_none*1e3:.1f} ms, cold cache {t_cold*1e3:.1f} ms, "
+          f"warm cache {t_warm*1e3:.1f} ms, {cached.beam_cache.stats()}")
+
+
+def bench_batch_readings(rounds=5):
+    """ check sensor_readings against sequential sensor_reading calls and time both, for
+        a scan from several poses and a burst of 10 readings from one pose, the best of
+        interleaved rounds. The scan must beat the sequential calls.
+    """
+    rand = np.random.default_rng(1)
+    for count, poses_every in ((360, 3), (10, 0)):
+        poses = np.tile([400, 400], (count, 1))
+        if poses_every:
+            poses[::poses_every] = rand.integers(0, 800, (len(poses[::poses_every]), 2))
+        headings = rand.uniform(0, 360, count)
+        ranges = np.round(rand.uniform(0.1, 2.5, count), 2)
+        cache = og.BeamCache()
+        batch = og.Occupancy_Grid(8, 8, RANGE_RES, beam_cache=cache)
+        sequential = og.Occupancy_Grid(8, 8, RANGE_RES, beam_cache=cache)
+
+        def apply_sequential():
+            for pose, hdg, rng in zip(poses, headings, ranges):
+                sequential.sensor_reading(pose[0], pose[1], hdg, BEAMWIDTH, BEAM_RES, rng,
+                                          RANGE_MAX, RANGE_RES)
+
+        apply_sequential()
+        batch.sensor_readings(poses, headings, ranges, BEAMWIDTH, BEAM_RES, RANGE_MAX, RANGE_RES)
+        assert np.allclose(batch.get_map(), sequential.get_map())
+
+        # the log-odds modes sum the increments, like log_odds_contributions
+        log_odds = og.Occupancy_Grid(8, 8, RANGE_RES, beam_cache=cache, storage="int16")
+        summed = og.Occupancy_Grid(8, 8, RANGE_RES, beam_cache=cache, storage="int16")
+        log_odds.sensor_readings(poses, headings, ranges, BEAMWIDTH, BEAM_RES, RANGE_MAX,
+                                 RANGE_RES)
+        summed.add_log_odds(*summed.log_odds_contributions(poses, headings, ranges, BEAMWIDTH,
+                                                           BEAM_RES, RANGE_MAX, RANGE_RES))
+        assert np.array_equal(log_odds.log_odds_prob, summed.log_odds_prob)
+
+        t_seq, t_batch = np.inf, np.inf
+        for _ in range(rounds):
+            t_seq = min(t_seq, time_call(apply_sequential, repeat=3))
+            t_batch = min(t_batch, time_call(batch.sensor_readings, poses, headings, ranges,
+                                             BEAMWIDTH, BEAM_RES, RANGE_MAX, RANGE_RES,
+                                             repeat=3))
+        print(f"{count} readings: sequential {t_seq*1e3:.1f} ms, batch {t_batch*1e3:.1f} ms "
+              f"({t_batch/t_seq:.2f}x the sequential time)")
+        if count == 360:
+            assert t_batch < t_seq, (t_batch, t_seq)
+
+
+def bench_storage_modes():
+    """compare map memory and scan replay time for each storage mode"""
+    headings = np.arange(0, 360, 1.0)
+    ranges = np.round(1.0 + 0.5*np.abs(np.sin(np.radians(headings))), 2)
+    cache = og.BeamCache()
+    for storage in ("float", "int16", "int8"):
+        grid = og.Occupancy_Grid(8, 8, RANGE_RES, beam_cache=cache, storage=storage)
+        replay_scan(grid, headings, ranges)
+        t_scan = time_call(replay_scan, grid, headings, ranges, repeat=3)
+        print(f"{storage:>5} storage: {grid.log_odds_prob.nbytes/1e6:.2f} MB, "
+              f"360 deg scan {t_scan*1e3:.1f} ms")
+
+
+def bench_tiled_map():
+    """ check that log-odds increments reach a tiled map like a dense one, and compare the
+        memory of a tiled map against the dense map covering the same corridor
+    """
+    rand = np.random.default_rng(4)
+    poses = rand.integers(100, 700, (50, 2))
+    headings = rand.uniform(0, 360, 50)
+    ranges = np.round(rand.uniform(0.1, 2.5, 50), 2)
+    dense = og.Occupancy_Grid(8, 8, RANGE_RES, storage="int16")
+    tiled = tg.Tiled_Occupancy_Grid(RANGE_RES, storage="int16", beam_cache=dense.beam_cache)
+    contributions = dense.log_odds_contributions(poses, headings, ranges, BEAMWIDTH, BEAM_RES,
+                                                 RANGE_MAX, RANGE_RES)
+    dense.add_log_odds(*contributions)
+    tiled.add_log_odds(*contributions)
+    assert np.array_equal(tiled.get_region(dense.bounds()), dense.log_odds_prob)
+    assert np.array_equal(tiled.get_map(dense.bounds()), dense.get_map())
+
+    tiled = tg.Tiled_Occupancy_Grid(RANGE_RES)
+    # drive 30 m north east scanning left and right
+    for step in range(0, 3000, 50):
+        for hdg in (125, 145, 305, 325):
+            tiled.sensor_reading(step, step, hdg, BEAMWIDTH, BEAM_RES, 1.5, RANGE_MAX, RANGE_RES)
+    x_min, y_min, x_max, y_max = tiled.bounds()
+    dense_bytes = (x_max - x_min)*(y_max - y_min)*tiled.log_odds_prob.itemsize
+    print(f"tiled map: {len(tiled.tiles)} tiles {tiled.nbytes/1e6:.1f} MB, "
+          f"dense bounding box {dense_bytes/1e6:.1f} MB")
+
+
+def rasterize_one_by_one(p0, p1):
+    """reference rasterizer calling bresenham once per ray"""
+    return [og.bresenham(start, end) for start, end in zip(p0, p1)]
+
+
+def bench_rasterizer(rounds=5):
+    """ compare bresenham_rays with one bresenham call per ray at 10, 100 and 1000 rays,
+        the best of interleaved rounds so a busy machine slows both alike
+    """
+    rand = np.random.default_rng(2)
+    for num_rays in (10, 100, 1000):
+        p0 = np.tile([300, 300], (num_rays, 1))
+        angles = rand.uniform(0, 2*np.pi, num_rays)
+        p1 = p0 + 255*np.stack([np.cos(angles), np.sin(angles)], axis=1)
+        cells, offsets = og.bresenham_rays(p0, p1)
+        for i, line in enumerate(rasterize_one_by_one(p0, p1)):
+            assert np.array_equal(cells[:, offsets[i]:offsets[i+1]], line)
+        t_ref, t_fast = np.inf, np.inf
+        for _ in range(rounds):
+            t_ref = min(t_ref, time_call(rasterize_one_by_one, p0, p1, repeat=3))
+            t_fast = min(t_fast, time_call(og.bresenham_rays, p0, p1, repeat=5))
+        print(f"{num_rays:>5} rays: bresenham {t_ref*1e3:.2f} ms, "
+              f"bresenham_rays {t_fast*1e3:.3f} ms, speedup {t_ref/t_fast:.1f}x")
+    assert t_ref/t_fast >= 1.2, t_ref/t_fast
+
+
+def march_ray(occupied, x, y, hdg, rng_max, step=0.25):
+    """reference ray cast walking a quarter cell at a time"""
+    for travel in np.arange(0, rng_max/RANGE_RES, step):
+        cell_x = int(np.rint(x + travel*np.cos(np.radians(hdg))))
+        cell_y = int(np.rint(y + travel*np.sin(np.radians(hdg))))
+        if not (0 <= cell_x < occupied.shape[0] and 0 <= cell_y < occupied.shape[1]):
+            return rng_max
+        if occupied[cell_x, cell_y]:
+            return min(np.hypot(cell_x - x, cell_y - y)*RANGE_RES, rng_max)
+    return rng_max
+
+
+def bench_expected_range():
+    """check expected_range against a fine ray march and time batches of queries"""
+    grid = og.Occupancy_Grid(8, 8, RANGE_RES, storage="int16")
+    headings = np.arange(0, 360, 2.0)
+    replay_scan(grid, headings, 1.0 + 0.5*np.abs(np.sin(np.radians(headings))))
+    rand = np.random.default_rng(3)
+    count = 10000
+    x, y = rand.uniform(300, 500, count), rand.uniform(300, 500, count)
+    hdg = rand.uniform(0, 360, count)
+
+    ranges = grid.expected_range(x, y, hdg, RANGE_MAX)
+    occupied = grid.get_map() > 0.7
+    reference = np.array([march_ray(occupied, *query, RANGE_MAX)
+                          for query in zip(x[:200], y[:200], hdg[:200])])
+    agreement = np.mean(np.abs(reference - ranges[:200]) <= 2*RANGE_RES)
+    assert agreement >= 0.95, agreement
+
+    t_ray = time_call(grid.expected_range, x, y, hdg, RANGE_MAX, repeat=3)
+    t_cone = time_call(grid.expected_range, x[:1000], y[:1000], hdg[:1000], RANGE_MAX,
+                       BEAMWIDTH, 1.0, repeat=3)
+    print(f"expected_range: {count} rays {t_ray*1e3:.1f} ms, 1000 {BEAMWIDTH} deg cones "
+          f"{t_cone*1e3:.1f} ms, {agreement:.1%} within 2 cells of a ray march")
+
+
+def bench_particle_filter(updates=100):
+    """localize in a synthetic room, in process and sharded over a process pool"""
+    grid = og.Occupancy_Grid(8, 8, RANGE_RES, storage="int16")
+    wall = grid.fixed_max
+    grid.log_odds_prob[200:600, [200, 600]] = wall
+    grid.log_odds_prob[[200, 600], 200:600] = wall
+    grid.log_odds_prob[350:360, 380:470] = wall
+    grid.mark_changed(*grid.bounds())
+    truth = (330.0, 420.0)
+    rand = np.random.default_rng(5)
+    headings = rand.uniform(0, 360, updates)
+    ranges = grid.expected_range(truth[0], truth[1], headings, RANGE_MAX)
+    ranges += rand.normal(0, RANGE_RES, updates)
+    for num_particles in (10000, 100000):
+        for workers in (0, 4):
+            pf = localization.ParticleFilter(grid, 400, 400, num_particles=num_particles,
+                                             spread=40, motion_noise=0.5, num_workers=workers,
+                                             seed=1)
+            # the first reading starts the pool workers and is not timed
+            pf.range_sample(headings[0], ranges[0], RANGE_MAX)
+            start = time.perf_counter()
+            for hdg, rng in zip(headings[1:], ranges[1:]):
+                pf.range_sample(hdg, rng, RANGE_MAX)
+            elapsed = (time.perf_counter() - start)/(updates - 1)
+            error = np.hypot(*(np.array(pf.estimate()) - truth))*RANGE_RES
+            pf.close()
+            print(f"particle filter: {num_particles} particles, {workers} workers, "
+                  f"{elapsed*1e3:.2f} ms/reading, error {error*100:.1f} cm")
+
+
+def bench_distance_field(readings=50):
+    """incremental distance field upkeep per reading against a full recompute"""
+    grid = og.Occupancy_Grid(10, 10, RANGE_RES, storage="int16")
+    rand = np.random.default_rng(4)
+    grid.distance_field()
+    start = time.perf_counter()
+    for _ in range(readings):
+        x, y = rand.integers(300, 700, 2)
+        grid.sensor_reading(x, y, rand.uniform(0, 360), BEAMWIDTH, BEAM_RES,
+                            rand.uniform(0.3, 2.0), RANGE_MAX, RANGE_RES)
+        grid.distance_field()
+    t_incremental = (time.perf_counter() - start)/readings
+    distance, _, _ = grid.distance_field()
+    full = np.minimum(ndimage.distance_transform_edt(~grid.occupied(grid.bounds())),
+                      grid.distance_limit)
+    assert np.allclose(distance, full)
+    grid.invalidate_distance_field()
+    t_full = time_call(grid.distance_field, repeat=1)
+    print(f"distance field: reading + incremental update {t_incremental*1e3:.1f} ms, "
+          f"full recompute {t_full*1e3:.1f} ms")
+
+
+def bench_snapshots(readings=50):
+    """publishing a snapshot per reading by dirty region copy against a full map copy"""
+    grid = og.Occupancy_Grid(10, 10, RANGE_RES, storage="int16")
+    rand = np.random.default_rng(5)
+    grid.publish()
+    t_publish = t_copy = 0.0
+    for _ in range(readings):
+        x, y = rand.integers(300, 700, 2)
+        grid.sensor_reading(x, y, rand.uniform(0, 360), BEAMWIDTH, BEAM_RES,
+                            rand.uniform(0.3, 2.0), RANGE_MAX, RANGE_RES)
+        start = time.perf_counter()
+        snapshot = grid.publish()
+        t_publish += time.perf_counter() - start
+        start = time.perf_counter()
+        full = grid.get_region(grid.bounds()).copy()
+        t_copy += time.perf_counter() - start
+        assert np.array_equal(snapshot.cells, full)
+        del snapshot
+    print(f"map snapshots: publish {t_publish/readings*1e3:.2f} ms, "
+          f"full copy {t_copy/readings*1e3:.2f} ms")
+
+
+def check_map_snapshots():
+    """ snapshots of a map file taken back to back, and after the map is reopened with its
+        version back at 0, all land in new files; an existing path is never overwritten
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        map_file = os.path.join(folder, "map.ev3grid")
+        grid = og.Occupancy_Grid(2, 2, RANGE_RES, storage="int16", map_file=map_file)
+        grid.sensor_reading(100, 100, 45, BEAMWIDTH, BEAM_RES, 1.0, RANGE_MAX, RANGE_RES)
+        paths = {grid.checkpoint(), grid.checkpoint()}
+        del grid
+        reopened = og.Occupancy_Grid(2, 2, RANGE_RES, storage="int16", map_file=map_file)
+        assert reopened.version == 0
+        paths.add(reopened.checkpoint())
+        with open(map_file, "rb") as cells:
+            content = cells.read()
+        for path in paths:
+            with open(path, "rb") as copy:
+                assert copy.read() == content
+        assert len(paths) == 3
+        try:
+            reopened.snapshot(paths.pop())
+        except FileExistsError:
+            pass
+        else:
+            raise AssertionError("snapshot overwrote an existing file")
+    print("map snapshots: checkpoints across a reopen land in new files")
+
+
+def bench_path_planner(sizes=(500, 2000), obstacles=200):
+    """ first plan and incremental replan latency after a reading lands on the path and
+        after a blocked square on it is cleared, the replans must cost what a fresh plan does
+    """
+    for size in sizes:
+        grid = og.Occupancy_Grid(size*RANGE_RES, size*RANGE_RES, RANGE_RES, storage="int16")
+        rand = np.random.default_rng(6)
+        wall = grid.fixed_point_increment(np.ones(1))[0]*8
+        for x, y in rand.integers(0, size - size//25, (obstacles, 2)):
+            w, h = rand.integers(size//100 + 1, size//25, 2)
+            grid.log_odds_prob[x:x + w, y:y + h] = wall
+        grid.mark_changed(*grid.bounds())
+        start, goal = (5, 5), (size - 5, size - 5)
+        grid.log_odds_prob[:10, :10] = grid.log_odds_prob[-10:, -10:] = 0
+
+        planner = path_planner.DStarLite(grid, goal)
+        begin = time.perf_counter()
+        path = planner.plan(start)
+        t_first = time.perf_counter() - begin
+
+        # halfway along the path a reading finds an obstacle across it 60 cells ahead
+        start, ahead = path[len(path)//2], path[len(path)//2 + 60]
+        hdg = np.degrees(np.arctan2(ahead[1] - start[1], ahead[0] - start[0]))
+        rng = np.hypot(ahead[0] - start[0], ahead[1] - start[1])*RANGE_RES
+        for _ in range(3):
+            grid.sensor_reading(*start, hdg, BEAMWIDTH, BEAM_RES, rng, RANGE_MAX, RANGE_RES)
+        begin = time.perf_counter()
+        replan = planner.plan(start)
+        t_replan = time.perf_counter() - begin
+        scratch = path_planner.DStarLite(grid, goal)
+        begin = time.perf_counter()
+        scratch_path = scratch.plan(start)
+        t_scratch = time.perf_counter() - begin
+        assert replan != path[len(path)//2:] and replan[-1] == scratch_path[-1] == goal
+        assert abs(planner.path_cost() - scratch.path_cost()) < 1e-6
+
+        # a square across the path, blocked when a planner starts and later found to be
+        # free: its replan must route back through the freed cells
+        x, y = ahead
+        square = (x - 10, y - 10, x + 10, y + 10)
+        grid.log_odds_prob[square[0]:square[2], square[1]:square[3]] = wall
+        grid.mark_changed(*square)
+        planner = path_planner.DStarLite(grid, goal)
+        planner.plan(start)
+        blocked_cost = planner.path_cost()
+        grid.log_odds_prob[square[0]:square[2], square[1]:square[3]] = grid.fixed_min
+        grid.mark_changed(*square)
+        begin = time.perf_counter()
+        planner.plan(start)
+        t_cleared = time.perf_counter() - begin
+        scratch = path_planner.DStarLite(grid, goal)
+        scratch.plan(start)
+        assert planner.path_cost() < blocked_cost
+        assert abs(planner.path_cost() - scratch.path_cost()) < 1e-6
+        print(f"path planner {size}x{size}: first plan {t_first*1e3:.0f} ms, "
+              f"replan {t_replan*1e3:.0f} ms, plan from scratch {t_scratch*1e3:.0f} ms, "
+              f"replan after clearing {t_cleared*1e3:.0f} ms")
+
+
+def bench_sensor_codec(batches=(1, 10, 100)):
+    """decode time per sample of JSON and binary ultrasonic payloads"""
+    rand = np.random.default_rng(7)
+    for count in batches:
+        samples = [[1700000000.0 + i*0.01, float(rand.uniform(0, 360)), float(rand.integers(3, 255))]
+                   for i in range(count)]
+        json_payload = sensor_codec.encode_json(samples)
+        binary_payload = sensor_codec.encode("ultra", samples)
+        decoded = sensor_codec.decode(binary_payload, "ultra")
+        assert np.allclose(decoded, sensor_codec.decode(json_payload, "ultra"), rtol=1e-6)
+        repeat = 20000//count
+        t_json = time_call(sensor_codec.decode, json_payload, "ultra", repeat=repeat)/count
+        t_binary = time_call(sensor_codec.decode, binary_payload, "ultra", repeat=repeat)/count
+        print(f"sensor codec {count:3d} samples/message: JSON {len(json_payload):5d} bytes "
+              f"{t_json*1e6:.2f} us/sample, binary {len(binary_payload):5d} bytes "
+              f"{t_binary*1e6:.2f} us/sample")
+
+    # a future codec version is told apart from JSON and rejected, not parsed as JSON
+    newer = bytes([sensor_codec.CODEC_VERSION + 1]) + binary_payload[1:]
+    assert sensor_codec.is_binary(newer) and not sensor_codec.is_binary(b" " + json_payload)
+    try:
+        sensor_codec.decode(newer, "ultra")
+    except ValueError as err:
+        assert str(err) == "unsupported codec version", err
+    else:
+        raise AssertionError("a payload of another codec version was decoded")
+
+
+def check_ingestion(maxsize=4, samples=10):
+    """ the overflow policies of SampleQueue, and map update workers that outlive a batch
+        whose apply raises
+    """
+    queue = ingestion.SampleQueue(maxsize, "drop-oldest")
+    for i in range(samples):
+        queue.put("hdg", (i, float(i)))
+    batch = queue.get_batch(samples)
+    assert [sample for _, sample, _ in batch] == [(i, float(i)) for i in range(samples - maxsize, samples)]
+    assert queue.stats()["dropped"] == samples - maxsize
+
+    # headings fold into the newest queued one, a reading that cannot merge drops the oldest
+    queue = ingestion.SampleQueue(maxsize, "merge", {"hdg": lambda queued, new: new})
+    queue.put("ultra", (0, 0.0, 50))
+    for i in range(samples):
+        queue.put("hdg", (i, float(i)))
+    queue.put("ultra", (1, 90.0, 50))
+    stats = queue.stats()
+    assert stats["merged"] == samples - (maxsize - 1) and stats["dropped"] == 1
+    batch = [(kind, sample) for kind, sample, _ in queue.get_batch(samples)]
+    assert batch[-2:] == [("hdg", (samples - 1, float(samples - 1))), ("ultra", (1, 90.0, 50))]
+
+    # a blocked producer waits for the consumer, nothing is lost or reordered
+    queue = ingestion.SampleQueue(maxsize, "block")
+    applied = []
+    worker = ingestion.MapUpdateWorker(queue, lambda batch: (time.sleep(0.001), applied.extend(batch)))
+    worker.start()
+    for i in range(samples*10):
+        queue.put("hdg", (i, float(i)))
+    worker.stop()
+    assert [sample for _, sample in applied] == [(i, float(i)) for i in range(samples*10)]
+    assert queue.stats()["max_depth"] <= maxsize and queue.stats()["dropped"] == 0
+
+    def apply(batch):
+        if any(len(sample) < 2 for _, sample in batch):
+            raise IndexError("short sample")
+        applied.extend(batch)
+
+    applied = []
+    queue = ingestion.SampleQueue(maxsize, "block")
+    worker = ingestion.MapUpdateWorker(queue, apply)
+    worker.start()
+    # the failed batch is logged with its traceback, keep that out of the benchmark output
+    logging.disable(logging.ERROR)
+    queue.put("hdg", (0,))
+    worker.drain()
+    logging.disable(logging.NOTSET)
+    for i in range(samples):
+        queue.put("hdg", (i, float(i)))
+    worker.stop()
+    stats = worker.stats()
+    assert stats["failed_batches"] == 1 and stats["applied"] == len(applied) == samples
+
+    # the asyncio worker outlives a failed batch too, and runs its idle hook between samples
+    async def run_async():
+        queue = ingestion.AsyncSampleQueue(maxsize)
+        idle = []
+        worker = ingestion.AsyncMapUpdateWorker(queue, apply, on_idle=lambda: idle.append(1),
+                                                idle_interval=0.01)
+        worker.start()
+        logging.disable(logging.ERROR)
+        queue.put("hdg", (0,))
+        await worker.drain()
+        logging.disable(logging.NOTSET)
+        for i in range(samples):
+            queue.put("hdg", (i, float(i)))
+        await worker.drain()
+        await asyncio.sleep(0.05)
+        await worker.stop()
+        return worker.stats(), len(idle)
+
+    applied = []
+    stats, idle_calls = asyncio.run(run_async())
+    assert stats["failed_batches"] == 1 and stats["applied"] == len(applied) == samples
+    assert idle_calls > 0
+    print("ingestion: drop-oldest, merge and block policies, failed batches and idle hooks check out")
+
+
+def check_fleet_parity(robots=4, readings=50):
+    """log-odds increments summed per robot match the readings applied one by one"""
+    rand = np.random.default_rng(8)
+    poses = rand.integers(200, 600, (robots, 2))
+    # limits wide enough that no cell saturates, saturation is where the two may differ
+    shared = og.Occupancy_Grid(8, 8, RANGE_RES, storage="int16", log_odds_min=-30, log_odds_max=30)
+    reference = og.Occupancy_Grid(8, 8, RANGE_RES, storage="int16", log_odds_min=-30,
+                                  log_odds_max=30)
+    for pose in poses:
+        headings = rand.uniform(0, 360, readings)
+        ranges = rand.uniform(0.2, 2.0, readings)
+        for hdg, rng in zip(headings, ranges):
+            reference.sensor_reading(*pose, hdg, BEAMWIDTH, BEAM_RES, rng, RANGE_MAX, RANGE_RES)
+        shared.add_log_odds(*shared.log_odds_contributions(
+            np.tile(pose, (readings, 1)), headings, ranges, BEAMWIDTH, BEAM_RES, RANGE_MAX,
+            RANGE_RES))
+    assert fleet.BEAMWIDTH == BEAMWIDTH and fleet.RANGE_MAX == RANGE_MAX
+    assert np.array_equal(shared.log_odds_prob, reference.log_odds_prob)
+    print(f"fleet map parity: {robots} robots x {readings} readings match")
+
+
+def bench_metrics(samples=50000, rounds=5):
+    """ cost per sample of timing a call into a histogram and counting it, the best of
+        several rounds as the figure depends on the machine and its load
+    """
+    registry = metrics.Registry()
+    histogram = registry.histogram("bench_seconds")
+    counter = registry.counter("bench_total")
+    costs = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(samples):
+            begin = time.perf_counter()
+            histogram.observe(time.perf_counter() - begin)
+            counter.inc()
+        t_metrics = (time.perf_counter() - start)/samples
+        start = time.perf_counter()
+        for _ in range(samples):
+            pass
+        costs.append(t_metrics - (time.perf_counter() - start)/samples)
+    assert histogram.count == counter.value == samples*rounds
+    machine = platform.processor() or platform.machine()
+    print(f"metrics: timed observe + count {min(costs)*1e6:.2f} us/sample "
+          f"(median {np.median(costs)*1e6:.2f}) on {machine}, {os.cpu_count()} cpus, "
+          f"{platform.python_implementation()} {platform.python_version()}")
+
+
+def bench_command_rtt(count=200, backlog=2000):
+    """ round trip of commands acked by a loopback robot, stop commands sent behind a
+        backlog of sensor messages still waiting for delivery
+    """
+    loopback = transport.LoopbackTransport()
+
+    def robot(the_client, user_data, msg):
+        loopback.publish(commands.ACK_TOPIC, json.dumps({"id": json.loads(msg.payload)["id"]}))
+
+    loopback.subscribe("ev3/control/#", robot)
+    tracker = commands.CommandTracker(loopback, timeout=5.0)
+    loopback.subscribe(commands.ACK_TOPIC, tracker.on_ack_message)
+    loopback.connect()
+    # malformed acks are dropped without ending the delivery thread, keep their warnings quiet
+    bad_acks = commands.BAD_ACKS.value
+    logging.disable(logging.WARNING)
+    for payload in (b"not json", b"{}", b'{"id": [1]}', b"[1]"):
+        loopback.publish(commands.ACK_TOPIC, payload)
+    for i in range(count):
+        tracker.send("ultra_test", 0)
+        if i % 20 == 0:
+            for _ in range(backlog):
+                loopback.publish("ev3/sensor/ultra", b"{}")
+            tracker.send_priority("stop", 0)
+        time.sleep(0.001)
+    while tracker.outstanding:
+        time.sleep(0.01)
+    logging.disable(logging.NOTSET)
+    tracker.close()
+    loopback.disconnect()
+    assert commands.BAD_ACKS.value - bad_acks == 4
+    stats = tracker.stats()
+    for name in ("ultra_test", "stop (priority)"):
+        rtt = stats[name]
+        assert rtt["acked"] == rtt["sent"] and rtt["timeouts"] == 0
+        print(f"command rtt {name}: {rtt['acked']} acked, p50 {rtt['p50']*1e3:.3f} ms, "
+              f"p99 {rtt['p99']*1e3:.3f} ms, worst {rtt['worst']*1e3:.3f} ms")
+
+
+def check_heading_alignment(readings=2000, hdg_rate=50.0, turn_rate=180.0):
+    """ heading error of range readings taken while turning at turn_rate deg/s, with the
+        last heading received and with the heading interpolated at the reading time
+    """
+    rand = np.random.default_rng(0)
+    duration = readings/200
+    hdg_times = np.arange(0, duration, 1/hdg_rate)
+    headings = telemetry.RingBuffer(4096)
+    headings.extend(hdg_times, (turn_rate*hdg_times) % 360)
+    times = np.sort(rand.uniform(hdg_times[0], hdg_times[-1], readings))
+    truth = (turn_rate*times) % 360
+    held = (turn_rate*hdg_times[np.searchsorted(hdg_times, times, side="right") - 1]) % 360
+    aligner = sensor_fusion.HeadingAligner(headings)
+    aligner.add(times.tolist(), held.tolist(), [100.0]*readings)
+    start = time.perf_counter()
+    _, fused, _ = aligner.release()
+    t_fused = (time.perf_counter() - start)/readings
+    assert len(fused) == readings and aligner.aligned == readings
+
+    def error(hdg):
+        return np.abs((hdg - truth + 180) % 360 - 180).max()
+
+    assert error(fused) < 1e-6
+
+    # a reading without a usable timestamp is rejected and never holds up later readings
+    aligner.add([None, times[-1]], [0.0, 0.0], [100.0, 100.0])
+    released, _, _ = aligner.release(flush=True)
+    assert aligner.rejected == 1 and released.tolist() == [times[-1]] and len(aligner) == 0
+    print(f"heading alignment at {turn_rate:.0f} deg/s, {hdg_rate:.0f} Hz compass: max error "
+          f"last heading {error(held):.2f} deg, interpolated {error(fused):.1e} deg, "
+          f"{t_fused*1e6:.2f} us/reading")
+
+
+def bench_async_supervisor(readings=2000, queue_size=64):
+    """ range readings published in bursts of 200 through AsyncEV3Supervisor on one event
+        loop: publish to map latency, transport pauses with a small ingestion queue and
+        the map versions reaching a subscriber
+    """
+    async def run():
+        loopback = transport.AsyncLoopbackTransport()
+        robot = async_supervisor.AsyncEV3Supervisor(transport=loopback, queue_size=queue_size,
+                                                    heading_wait=0.0)
+        updates = robot.subscribe("map", maxsize=1)
+        latencies = []
+        robot.map_listeners.append(lambda times: latencies.extend(time.time() - t for t in times))
+        robot.connect_mqtt()
+        start = time.perf_counter()
+        for i in range(readings):
+            loopback.publish("ev3/sensor/ultra", json.dumps([time.time(), i % 360, 100]))
+            # bursts longer than the queue make the queue pause the transport
+            if i % 200 == 0:
+                await asyncio.sleep(0)
+        while loopback.delivered < loopback.published:
+            await asyncio.sleep(0.001)
+        await robot.drain()
+        elapsed = time.perf_counter() - start
+        stats = robot.ingest_stats()
+        await robot.close()
+        seen = len([version async for version in updates])
+        return elapsed, np.array(latencies)*1e3, stats, seen
+
+    elapsed, latency, stats, seen = asyncio.run(run())
+    assert stats["applied"] == readings and stats["dropped"] == 0
+    p50, p99 = np.percentile(latency, [50, 99])
+    print(f"async supervisor: {readings/elapsed:.0f} readings/s, latency p50 {p50:.1f} ms "
+          f"p99 {p99:.1f} ms, {stats['pauses']} transport pauses, max depth {stats['max_depth']}, "
+          f"subscriber kept {seen} of {stats['batches']} map versions")
+
+
+def main():
+    """main"""
+    check_sensor_model_parity()
+    bench_sensor_model()
+    bench_update_grid()
+    bench_beam_cache()
+    bench_batch_readings()
+    bench_storage_modes()
+    bench_tiled_map()
+    bench_rasterizer()
+    bench_expected_range()
+    bench_particle_filter()
+    bench_distance_field()
+    bench_snapshots()
+    check_map_snapshots()
+    bench_path_planner()
+    bench_sensor_codec()
+    check_ingestion()
+    check_fleet_parity()
+    bench_metrics()
+    check_heading_alignment()
+    bench_command_rtt()
+    bench_async_supervisor()
+
+
+if __name__ == "__main__":
+    main()
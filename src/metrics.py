@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# counters, gauges and latency histograms for the supervisor and map pipeline
+#
+# Instruments live in a Registry, by default the module REGISTRY, and are exported in the
+# Prometheus text format by render() or over HTTP with serve():
+#
+#  curl http://127.0.0.1:9108/metrics
+#
+# Updates take no lock, a sample recorded by two threads at once may be lost.
+
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from math import frexp
+from math import ldexp
+
+# histogram buckets: SUB_BUCKETS per power of two from 2**EXP_MIN to 2**EXP_MAX
+SUB_BUCKETS = 8
+EXP_MIN = -24   # ~60 ns
+EXP_MAX = 10    # ~17 minutes
+BUCKETS = (EXP_MAX - EXP_MIN)*SUB_BUCKETS
+# constants of the bucket arithmetic in Histogram.observe
+MANTISSA_SCALE = 2*SUB_BUCKETS
+INDEX_OFFSET = (EXP_MIN + 2)*SUB_BUCKETS
+
+
+class Counter():
+    """monotonic count of events"""
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def render(self):
+        return [f"{self.name} {self.value}"]
+
+
+class Gauge():
+    """a value that goes up and down, either set or read from fn at export time"""
+
+    def __init__(self, name, help_text, fn=None):
+        self.name = name
+        self.help = help_text
+        self.fn = fn
+        self.value = 0.0
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.fn() if self.fn is not None else self.value
+
+    def render(self):
+        return [f"{self.name} {self.get()}"]
+
+
+class Histogram():
+    """ HDR style histogram of positive values, e.g. latencies in seconds
+
+        Each power of two is split into SUB_BUCKETS linear buckets so a quantile is
+        known to 1/SUB_BUCKETS of its value at any scale. The bucket of a value comes
+        from its float exponent and mantissa, no search is needed. Values outside
+        [2**EXP_MIN, 2**EXP_MAX) count in the first or last bucket. observe only bumps
+        a bucket and the sum, count adds up the buckets when it is read.
+    """
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.counts = [0]*BUCKETS
+        self.sum = 0.0
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def observe(self, value):
+        # value = mantissa*2**exponent with mantissa in [0.5, 1), so the bucket is
+        # (exponent - 1 - EXP_MIN)*SUB_BUCKETS + int((mantissa - 0.5)*2*SUB_BUCKETS)
+        mantissa, exponent = frexp(value)
+        index = exponent*SUB_BUCKETS + int(mantissa*MANTISSA_SCALE) - INDEX_OFFSET
+        if value <= 0 or index < 0:
+            index = 0
+        elif index >= BUCKETS:
+            index = BUCKETS - 1
+        self.counts[index] += 1
+        self.sum += value
+
+    def upper_bound(self, index):
+        """the upper edge of bucket index"""
+        octave, sub = divmod(index + 1, SUB_BUCKETS)
+        return ldexp(1 + sub/SUB_BUCKETS, octave + EXP_MIN)
+
+    def quantile(self, q):
+        """return the upper edge of the bucket holding quantile q, 0 when empty"""
+        counts = list(self.counts)
+        total = sum(counts)
+        if total == 0:
+            return 0.0
+        rank = q*total
+        seen = 0
+        for index, count in enumerate(counts):
+            seen += count
+            if seen >= rank and count:
+                return self.upper_bound(index)
+        return self.upper_bound(len(counts) - 1)
+
+    def render(self):
+        """cumulative buckets at every power of two, the Prometheus histogram layout"""
+        counts = list(self.counts)
+        lines = []
+        seen = 0
+        for octave in range(EXP_MAX - EXP_MIN):
+            seen += sum(counts[octave*SUB_BUCKETS:(octave + 1)*SUB_BUCKETS])
+            lines.append(f'{self.name}_bucket{{le="{ldexp(1.0, octave + 1 + EXP_MIN):.6g}"}} {seen}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {seen}')
+        lines.append(f"{self.name}_sum {self.sum}")
+        lines.append(f"{self.name}_count {seen}")
+        return lines
+
+
+class Registry():
+    """named instruments, asking for an existing name returns the existing instrument"""
+
+    TYPES = {Counter: "counter", Gauge: "gauge", Histogram: "histogram"}
+
+    def __init__(self):
+        self.instruments = {}
+        self.lock = threading.Lock()
+
+    def get(self, cls, name, help_text, *args):
+        with self.lock:
+            instrument = self.instruments.get(name)
+            if instrument is None:
+                instrument = self.instruments[name] = cls(name, help_text, *args)
+            elif not isinstance(instrument, cls):
+                raise ValueError(f"metric {name} is a {self.TYPES[type(instrument)]}")
+            return instrument
+
+    def counter(self, name, help_text=""):
+        return self.get(Counter, name, help_text)
+
+    def gauge(self, name, help_text="", fn=None):
+        gauge = self.get(Gauge, name, help_text)
+        if fn is not None:
+            gauge.fn = fn
+        return gauge
+
+    def histogram(self, name, help_text=""):
+        return self.get(Histogram, name, help_text)
+
+    def render(self):
+        """return every instrument in the Prometheus text exposition format"""
+        with self.lock:
+            instruments = sorted(self.instruments.items())
+        lines = []
+        for name, instrument in instruments:
+            lines.append(f"# HELP {name} {instrument.help}")
+            lines.append(f"# TYPE {name} {self.TYPES[type(instrument)]}")
+            lines.extend(instrument.render())
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """return one human readable line per instrument, histograms as count p50 p99"""
+        with self.lock:
+            instruments = sorted(self.instruments.items())
+        lines = []
+        for name, instrument in instruments:
+            if isinstance(instrument, Histogram):
+                lines.append(f"{name}: {instrument.count} "
+                             f"p50 {instrument.quantile(0.5)*1e3:.3f} ms "
+                             f"p99 {instrument.quantile(0.99)*1e3:.3f} ms")
+            elif isinstance(instrument, Gauge):
+                lines.append(f"{name}: {instrument.get():.6g}")
+            else:
+                lines.append(f"{name}: {instrument.value}")
+        return lines
+
+
+REGISTRY = Registry()
+
+
+def serve(registry=REGISTRY, port=9108, host="127.0.0.1"):
+    """serve registry.render() at http://host:port/metrics on a daemon thread, return the server"""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
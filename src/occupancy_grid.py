@@ -1,10 +1,28 @@
 #!/usr/bin/env python3
 # experiemnts and tests with occupancy grids
 
+import os
+import shutil
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict
+from collections import deque
 import numpy as np
 import matplotlib.pyplot as plt
+from scipy import ndimage
 from math import pi
 from math import floor
+import metrics
+
+SENSOR_READING_SECONDS = metrics.REGISTRY.histogram(
+    "map_sensor_reading_seconds", "time to apply one range reading to the grid")
+SENSOR_READINGS_SECONDS = metrics.REGISTRY.histogram(
+    "map_sensor_readings_seconds", "time to apply a batch of range readings to the grid")
+UPDATE_GRID_SECONDS = metrics.REGISTRY.histogram(
+    "map_update_grid_seconds", "time to fuse one sensor patch into the grid")
+READINGS_TOTAL = metrics.REGISTRY.counter("map_readings_total", "range readings applied to grids")
 
     # copied from https://github.com/bdaiinstitute/spatialmath-python/blob/07c6f62460030fd2c4f45112611e783abfbd8e4f/spatialmath/base/numeric.py#L229
 def bresenham(p0, p1):
@@ -68,23 +86,497 @@ def bresenham(p0, p1):
     return np.asarray([x.astype(int), y.astype(int)])
 
 
+def bresenham_rays(p0, p1):
+    """
+    Draw many lines in a grid in one pass
+
+    :param p0: initial points
+    :type p0: array_like(N, 2)
+    :param p1: end points
+    :type p1: array_like(N, 2)
+    :return: x and y coordinates of the cells of every line, and ray offsets
+    :rtype: ndarray(2, M) of int, ndarray(N+1) of int
+
+    The cells of line ``i`` are ``cells[:, offsets[i]:offsets[i+1]]`` and are the same,
+    in the same order, as ``bresenham(p0[i], p1[i])``.
+    """
+    p0 = np.asarray(p0, dtype=float).reshape(-1, 2)
+    p1 = np.asarray(p1, dtype=float).reshape(-1, 2)
+    delta = p1 - p0
+
+    # step along the major axis of each line, x for shallow lines and y for steep ones
+    steep = np.abs(delta[:, 0]) < np.abs(delta[:, 1])
+    rays = np.arange(len(p0))
+    major = np.where(steep, 1, 0)
+    major0, minor0 = p0[rays, major], p0[rays, 1 - major]
+    major_delta, minor_delta = delta[rays, major], delta[rays, 1 - major]
+
+    # a line of length d has ceil(|d| + 1) cells, or a single cell when p0 == p1
+    point = major_delta == 0
+    counts = np.where(point, 1, np.ceil(np.abs(major_delta) + 1)).astype(int)
+    offsets = np.r_[0, np.cumsum(counts)]
+
+    # every line is laid out on a row of a (lines, longest line) block with the per line
+    # constants broadcast along the row, the cells past the end of a line are dropped
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.where(point, 0, minor_delta / major_delta)[:, np.newaxis]
+    step = np.arange(counts.max() if len(counts) else 0, dtype=float)
+    block = np.empty((2, len(p0), len(step)))
+    major_cells, minor_cells = block
+    np.multiply(np.sign(major_delta)[:, np.newaxis], step, out=major_cells)
+    major_cells += major0[:, np.newaxis]
+    np.multiply(major_cells, slope, out=minor_cells)
+    minor_cells += minor0[:, np.newaxis] - slope * major0[:, np.newaxis]
+    np.round(minor_cells, out=minor_cells)
+    minor_cells[point, 0] = minor0[point]
+    # steep lines hold (y, x) rows, swap them to (x, y)
+    block[:, steep] = block[::-1, steep]
+    block = block.reshape(2, -1)
+    if len(counts) and counts.min() != len(step):
+        block = np.take(block, np.flatnonzero(step < counts[:, np.newaxis]), axis=1)
+    cells = block.astype(int)
+    return cells, offsets
+
+
+def bounding_rect(rects):
+    """return the bounding rectangle (x_start, y_start, x_stop, y_stop) of rectangles"""
+    rects = np.asarray(rects)
+    return (int(rects[:, 0].min()), int(rects[:, 1].min()),
+            int(rects[:, 2].max()), int(rects[:, 3].max()))
+
+
+def merge_rects(rects, margin=0):
+    """ merge rectangles (x_start, y_start, x_stop, y_stop) that overlap, touch or lie
+        within margin cells of each other, return the merged list
+    """
+    merged = []
+    for rect in rects:
+        rect = tuple(int(v) for v in rect)
+        overlapping = True
+        while overlapping:
+            overlapping = False
+            for other in merged:
+                if (rect[0] <= other[2] + margin and other[0] <= rect[2] + margin and
+                        rect[1] <= other[3] + margin and other[1] <= rect[3] + margin):
+                    merged.remove(other)
+                    rect = bounding_rect([rect, other])
+                    overlapping = True
+                    break
+        merged.append(rect)
+    return merged
+
+
+# log-odds value of one integer step for the fixed point storage modes
+FIXED_POINT_SCALES = {"int16": 1/1024, "int8": 1/32}
+
+# map file layout: a fixed header followed by the cells in C order at GRID_FILE_OFFSET
+# header = magic, storage, x cells, y cells, resolution, origin x, origin y,
+#          log_odds_min, log_odds_max
+GRID_FILE_MAGIC = b"EV3GRID1"
+GRID_FILE_HEADER = struct.Struct("<8s8sQQddddd")
+GRID_FILE_OFFSET = 128
+
+
+def copy_to_new_file(source_path, target_path):
+    """ copy a file to target_path, which is created and must not exist yet. On Linux the
+        kernel copies it with sendfile so no cells pass through Python
+    """
+    with open(source_path, "rb") as source, open(target_path, "xb") as target:
+        if not sys.platform.startswith("linux"):
+            shutil.copyfileobj(source, target)
+            return
+        size, offset = os.fstat(source.fileno()).st_size, 0
+        while offset < size:
+            sent = os.sendfile(target.fileno(), source.fileno(), offset, size - offset)
+            if sent == 0:
+                break
+            offset += sent
+
+
+def read_grid_header(path):
+    """return the header of a map file written by Occupancy_Grid as a dict"""
+    with open(path, "rb") as map_file:
+        raw = map_file.read(GRID_FILE_HEADER.size)
+    if len(raw) < GRID_FILE_HEADER.size or raw[:8] != GRID_FILE_MAGIC:
+        raise ValueError(f"{path} is not an occupancy grid map file")
+    _, storage, x_cells, y_cells, resolution, origin_x, origin_y, log_odds_min, log_odds_max = \
+        GRID_FILE_HEADER.unpack(raw)
+    return {"storage": storage.rstrip(b"\0").decode("ascii"), "shape": (x_cells, y_cells),
+            "resolution": resolution, "origin": (origin_x, origin_y),
+            "log_odds_min": log_odds_min, "log_odds_max": log_odds_max}
+
+
+def reading_arrays(poses, headings, ranges):
+    """return a batch of readings as (N, 2) int poses, N headings and N ranges"""
+    poses = np.asarray(poses, dtype=int).reshape(-1, 2)
+    headings = np.asarray(headings, dtype=float).ravel()
+    ranges = np.asarray(ranges, dtype=float).ravel()
+    if not len(poses) == len(headings) == len(ranges):
+        raise ValueError("poses, headings and ranges must have the same length")
+    return poses, headings, ranges
+
+
+def patch_cells(data):
+    """ return (free, hits, values) of a beam patch: the (x, y) cells of the patch that
+        are free (0) and that have a value to add (neither 0 nor 0.5), and those values
+    """
+    hits = np.nonzero((data != 0) & (data != 0.5))
+    return np.nonzero(data == 0), hits, data[hits].astype(float)
+
+
+def cells_nbytes(cells):
+    """return the bytes held by the (free, hits, values) of patch_cells, 0 for none"""
+    if not cells:
+        return 0
+    free, hits, values = cells
+    return sum(part.nbytes for part in free + hits) + values.nbytes
+
+
+class BeamCache():
+    """ LRU cache of beam patches produced by Occupancy_Grid.range_bearing_sample
+
+        Patches are keyed by (heading bucket, beamwidth, beam resolution, range cell,
+        max range, resolution). Headings are snapped to multiples of heading_step degrees
+        so readings taken on the same heading share a patch. The least recently used
+        patches are evicted once the cached arrays exceed max_bytes. Patches only hold
+        0, 0.5, 0.75 and 1.0 so they are stored as float32 without loss.
+    """
+
+    def __init__(self, heading_step=0.5, max_bytes=128*1024*1024):
+        self.heading_step = heading_step
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._patches = OrderedDict()
+
+    def __len__(self):
+        return len(self._patches)
+
+    def heading_bucket(self, hdg):
+        """return the bucket index of a heading in degrees"""
+        num_buckets = round(360/self.heading_step)
+        return round((hdg % 360)/self.heading_step) % num_buckets
+
+    def get(self, grid, hdg, bw, bw_res, rng, rng_max, rng_res):
+        """ return (sensor_reading, beam_origin, hdg) for a reading, computing the patch with
+            grid.range_bearing_sample on a miss. The returned patch is read only and is
+            computed at the bucket heading rather than hdg.
+        """
+        data, origin, _ = self.entry(grid, hdg, bw, bw_res, rng, rng_max, rng_res)
+        return data, origin, hdg
+
+    def cells(self, grid, hdg, bw, bw_res, rng, rng_max, rng_res):
+        """ return (sensor_reading, beam_origin, free, hits, values) for a reading, with
+            the patch_cells of the patch kept alongside it
+        """
+        data, origin, cells = self.entry(grid, hdg, bw, bw_res, rng, rng_max, rng_res)
+        if not cells:
+            cells.extend(patch_cells(data))
+            self.nbytes += cells_nbytes(cells)
+            self.evict()
+        return (data, origin) + tuple(cells)
+
+    def entry(self, grid, hdg, bw, bw_res, rng, rng_max, rng_res):
+        """return the cached (patch, origin, patch_cells list, empty until computed) of a reading"""
+        bucket = self.heading_bucket(hdg)
+        key = (bucket, bw, bw_res, floor(rng/rng_res), rng_max, rng_res)
+        entry = self._patches.get(key)
+        if entry is not None:
+            self.hits += 1
+            self._patches.move_to_end(key)
+            return entry
+
+        self.misses += 1
+        data, origin, _ = grid.range_bearing_sample(bucket*self.heading_step, bw, bw_res,
+                                                    rng, rng_max, rng_res)
+        data = data.astype(np.float32)
+        data.setflags(write=False)
+        entry = self._patches[key] = (data, tuple(origin), [])
+        self.nbytes += data.nbytes
+        self.evict()
+        return entry
+
+    def evict(self):
+        """drop the least recently used patches until the cache fits in max_bytes"""
+        while self.nbytes > self.max_bytes and len(self._patches) > 1:
+            _, (evicted, _, cells) = self._patches.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+            self.nbytes -= cells_nbytes(cells)
+            self.evictions += 1
+
+    def clear(self):
+        """drop every cached patch, the counters are kept"""
+        self._patches.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        """return the cache counters as a dict"""
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "entries": len(self._patches), "bytes": self.nbytes}
+
+
+class MapSnapshot():
+    """ immutable view of an Occupancy_Grid published by Occupancy_Grid.publish
+
+        cells holds the raw cells inside bounds = (x_min, y_min, x_max, y_max) as they were
+        at version, and is read only. get_map converts them like Occupancy_Grid.get_map.
+    """
+
+    def __init__(self, version, bounds, cells, log_odds_scale=None):
+        self.version = version
+        self.bounds = bounds
+        self.cells = cells
+        self.log_odds_scale = log_odds_scale
+        self._probability = None
+
+    def get_map(self):
+        """return the snapshot map, as probability for the fixed point storage modes"""
+        if self.log_odds_scale is None:
+            return self.cells
+        if self._probability is None:
+            log_odds = self.cells.astype(np.float32) * np.float32(self.log_odds_scale)
+            probability = 1 - 1/(1 + np.exp(log_odds))
+            probability.setflags(write=False)
+            self._probability = probability
+        return self._probability
+
 
 class Occupancy_Grid():
-    
-    def __init__(self, x_size, y_size, resolution=0.1):
+    """ occupancy grid map built from range-bearing sensor readings
+
+        storage selects how cells are kept:
+        "float" - float64 cells starting at 0.5, sensor values are added and free cells halved
+        "int16" / "int8" - true log-odds in fixed point (FIXED_POINT_SCALES), saturating at
+                           log_odds_min and log_odds_max, converted to probability in get_map
+
+        With map_file set the cells are an np.memmap of that file so every update persists.
+        An existing file is reopened and its header replaces the size, resolution, storage
+        and origin arguments. origin is the world position in meters of cell (0, 0).
+    """
+
+    def __init__(self, x_size, y_size, resolution=0.1, beam_cache=None, storage="float",
+                 log_odds_min=-2.0, log_odds_max=3.5, map_file=None, origin=(0.0, 0.0)):
+        header = None
+        if map_file is not None and os.path.exists(map_file):
+            header = read_grid_header(map_file)
+            resolution = header["resolution"]
+            x_size = header["shape"][0] * resolution
+            y_size = header["shape"][1] * resolution
+            storage = header["storage"]
+            log_odds_min, log_odds_max = header["log_odds_min"], header["log_odds_max"]
+            origin = header["origin"]
+        self.map_file = map_file
+        self.origin = tuple(origin)
         self.x_size = x_size
         self.y_size = y_size
         self.resolution = resolution
         self.grid_size = x_size * y_size
-        self.log_odds_prob = np.full((int(self.x_size / resolution), int(self.y_size / resolution)), 0.5,order='C')
-        #np.zeros((int(self.x_size / resolution), int(self.y_size / resolution)),order='C')
+        self.storage = storage
         self.log_occupied = 0.84
         self.log_free = 0.4
+        self.log_odds_min = log_odds_min
+        self.log_odds_max = log_odds_max
+        shape = (int(self.x_size / resolution), int(self.y_size / resolution))
+        if header is not None:
+            shape = header["shape"]
+        if storage == "float":
+            self.fixed_point = False
+            dtype, fill = np.float64, 0.5
+        elif storage in FIXED_POINT_SCALES:
+            self.fixed_point = True
+            self.log_odds_scale = FIXED_POINT_SCALES[storage]
+            limits = np.iinfo(storage)
+            self.fixed_min = round(log_odds_min / self.log_odds_scale)
+            self.fixed_max = round(log_odds_max / self.log_odds_scale)
+            if self.fixed_min < limits.min or self.fixed_max > limits.max:
+                raise ValueError(f"log-odds range [{log_odds_min}, {log_odds_max}] does not fit {storage}")
+            dtype, fill = np.dtype(storage), 0
+        else:
+            raise ValueError(f"unknown storage mode {storage!r}")
+        if map_file is None:
+            self.log_odds_prob = np.full(shape, fill, dtype=dtype, order='C')
+        elif header is None:
+            self.log_odds_prob = self.create_map_file(shape, dtype, fill)
+        else:
+            self.log_odds_prob = np.memmap(map_file, dtype=dtype, mode="r+",
+                                           offset=GRID_FILE_OFFSET, shape=shape, order='C')
+        #np.zeros((int(self.x_size / resolution), int(self.y_size / resolution)),order='C')
+        # bumped on every write, get_map uses it to reuse the probability map
+        self.version = 0
+        self._probability = None
+        self._probability_version = -1
+        # (version, rectangle) of the latest writes, read through changes_since
+        self.change_log = deque(maxlen=1024)
+        # writers hold write_lock, readers take published snapshots and never lock
+        self.write_lock = threading.RLock()
+        self._snapshot = None
+        self._spare = None
+        # truncated distance transform kept up to date from the change log
+        self.distance_limit = 64
+        self.distance_field_version = 0
+        self._distance_field = None
+        self._distance_key = None
+        self._distance_version = -1
+        # set to None to regenerate the beam patch for every reading
+        self.beam_cache = BeamCache() if beam_cache is None else beam_cache
  
     
+    def create_map_file(self, shape, dtype, fill):
+        """write a new map file with its header and return the memory mapped cells"""
+        header = GRID_FILE_HEADER.pack(GRID_FILE_MAGIC, self.storage.encode("ascii"),
+                                       shape[0], shape[1], self.resolution,
+                                       self.origin[0], self.origin[1],
+                                       self.log_odds_min, self.log_odds_max)
+        with open(self.map_file, "wb") as map_file:
+            map_file.write(header.ljust(GRID_FILE_OFFSET, b"\0"))
+        cells = np.memmap(self.map_file, dtype=dtype, mode="r+", offset=GRID_FILE_OFFSET,
+                          shape=shape, order='C')
+        if fill != 0:
+            cells.fill(fill)
+        return cells
+
+    def flush(self):
+        """write pending changes of a memory mapped map to its file"""
+        if isinstance(self.log_odds_prob, np.memmap):
+            self.log_odds_prob.flush()
+
+    def snapshot(self, path=None):
+        """ flush the map and copy its file to path, by default a file next to the map
+            file stamped with the UTC time to the microsecond and the map version, as the
+            version restarts at 0 when the map is reopened. An existing path is never
+            overwritten, FileExistsError is raised instead. Returns the snapshot path.
+        """
+        if self.map_file is None:
+            raise RuntimeError("snapshot needs a map created with map_file")
+        if path is None:
+            stem, ext = os.path.splitext(self.map_file)
+            seconds, micros = divmod(time.time_ns()//1000, 1000000)
+            stamp = time.strftime('%Y%m%d-%H%M%S', time.gmtime(seconds))
+            path = f"{stem}-{stamp}-{micros:06d}-v{self.version}{ext}"
+        self.flush()
+        copy_to_new_file(self.map_file, path)
+        return path
+
+    def checkpoint(self):
+        """flush the map to disk and take a versioned snapshot of it"""
+        return self.snapshot()
+
     #def sensor_reading(self,pose,beamwidth,range):
     def get_map(self):
-        return self.log_odds_prob
+        """ return the map, in the fixed point modes this is the occupancy probability
+            computed from the log-odds when the map has changed since the last call
+        """
+        if not self.fixed_point:
+            return self.log_odds_prob
+        if self._probability_version != self.version:
+            self._probability = 1 - 1/(1 + np.exp(self.get_log_odds()))
+            self._probability_version = self.version
+        return self._probability
+
+    def bounds(self):
+        """return (x_min, y_min, x_max, y_max) map cells of the grid, max exclusive"""
+        return (0, 0, self.log_odds_prob.shape[0], self.log_odds_prob.shape[1])
+
+    def get_region(self, bounds=None):
+        """ return the raw cells inside bounds = (x_min, y_min, x_max, y_max), cells off the
+            map read as no information. A view when bounds lie inside the map
+        """
+        if bounds is None:
+            return self.log_odds_prob
+        x_min, y_min, x_max, y_max = bounds
+        window = self.clip_window((x_max - x_min, y_max - y_min), x_min, y_min)
+        if window is not None and window[1] == (slice(0, x_max - x_min), slice(0, y_max - y_min)):
+            return self.log_odds_prob[window[0]]
+        region = np.full((x_max - x_min, y_max - y_min), 0 if self.fixed_point else 0.5,
+                         dtype=self.log_odds_prob.dtype)
+        if window is not None:
+            region[window[1]] = self.log_odds_prob[window[0]]
+        return region
+
+    def mark_changed(self, x_start, y_start, x_stop, y_stop):
+        """record that the map cells in [x_start, x_stop) x [y_start, y_stop) were written"""
+        self.version += 1
+        self.change_log.append((self.version, (int(x_start), int(y_start), int(x_stop), int(y_stop))))
+
+    def changes_since(self, version):
+        """ return (current version, rectangles) where the rectangles (x_start, y_start,
+            x_stop, y_stop) cover every cell written after version, merged where they
+            overlap. Pass the returned version back in on the next call. When version is
+            older than the change log the whole map is returned.
+        """
+        current = self.version
+        if version >= current:
+            return current, []
+        log = list(self.change_log)
+        if not log or version < log[0][0] - 1:
+            return current, [self.bounds()]
+        return current, merge_rects(rect for rect_version, rect in log
+                                    if version < rect_version <= current)
+
+    def publish(self):
+        """ publish the current cells as a new MapSnapshot and return it
+
+            Two buffers are swapped: the cells are copied into the buffer retired by the
+            previous publish, and only the regions changed since that buffer's version are
+            copied. If a reader still holds the retired buffer a fresh copy is made instead,
+            so a published snapshot never changes under a reader.
+        """
+        with self.write_lock:
+            front = self._snapshot
+            bounds = self.bounds()
+            if front is not None and front.version == self.version and front.bounds == bounds:
+                return front
+            spare, self._spare = self._spare, None
+            # reusable when only the spare tuple refers to the buffer (getrefcount counts
+            # its own argument too), i.e. no reader kept the snapshot or a view of it
+            reusable = (spare is not None and spare[1] == bounds and
+                        sys.getrefcount(spare[0]) <= 2)
+            if reusable:
+                cells = spare[0]
+                cells.setflags(write=True)
+                _, changes = self.changes_since(spare[2])
+                for x0, y0, x1, y1 in changes:
+                    x0, y0 = max(x0, bounds[0]), max(y0, bounds[1])
+                    x1, y1 = min(x1, bounds[2]), min(y1, bounds[3])
+                    if x0 < x1 and y0 < y1:
+                        cells[x0 - bounds[0]:x1 - bounds[0], y0 - bounds[1]:y1 - bounds[1]] = \
+                            self.get_region((x0, y0, x1, y1))
+            else:
+                cells = np.array(self.get_region(bounds), copy=True)
+            del spare
+            cells.setflags(write=False)
+            snapshot = MapSnapshot(self.version, bounds, cells,
+                                   self.log_odds_scale if self.fixed_point else None)
+            if front is not None:
+                self._spare = (front.cells, front.bounds, front.version)
+            self._snapshot = snapshot
+            return snapshot
+
+    def snapshot_view(self):
+        """return the last published MapSnapshot, publishing the first one if needed"""
+        snapshot = self._snapshot
+        if snapshot is None:
+            snapshot = self.publish()
+        return snapshot
+
+    def get_log_odds(self):
+        """return the log-odds of every cell as floats (the raw cells in float mode)"""
+        if not self.fixed_point:
+            return self.log_odds_prob
+        return self.log_odds_prob.astype(np.float32) * np.float32(self.log_odds_scale)
+
+    def log_odds_increment(self, data):
+        """ map sensor patch values to log-odds increments for the fixed point modes
+            0.5 adds nothing, 1.0 adds log_occupied and 0 removes log_free, values in
+            between are scaled linearly
+        """
+        return np.where(data >= 0.5, (data - 0.5)*2*self.log_occupied, (data - 0.5)*2*self.log_free)
+
+    def fixed_point_increment(self, data):
+        """return the log-odds increments of a patch in fixed point units"""
+        return np.rint(self.log_odds_increment(data) / self.log_odds_scale).astype(np.int32)
 
     def visualize(self):
         print("The map \n" + str(self.log_odds_prob))
@@ -97,6 +589,11 @@ class Occupancy_Grid():
         #print(loc_present)
         #[int(x/self.resolution),int(y/self.resolution)]
         x,y = loc_present
+        self.mark_changed(x, y, x + 1, y + 1)
+        if self.fixed_point:
+            cell = int(self.log_odds_prob[x, y]) + int(self.fixed_point_increment(value))
+            self.log_odds_prob[x, y] = min(max(cell, self.fixed_min), self.fixed_max)
+            return
         if value != 0.5:
             self.log_odds_prob[x,y]  = self.log_odds_prob[x, y] + value
         
@@ -112,17 +609,322 @@ class Occupancy_Grid():
         #         self.log_odds_prob[x, y] = -2
 
     def update_grid(self, data, x, y, x_offset=0, y_offset=0):
-        print(x,y,x_offset, y_offset)
-        it = np.nditer(data, flags=['multi_index'])
-        for cell in it:
-            self.update_log_odds(x-x_offset+it.multi_index[0], y-y_offset+it.multi_index[1], cell)
+        """ fuse a sensor patch into the map with the same rules as update_log_odds
+            cell (i, j) of data lands on map cell (x-x_offset+i, y-y_offset+j); the parts
+            of the patch that fall outside the map are dropped
+        """
+        start = time.perf_counter()
+        window = self.clip_window(data.shape, x-x_offset, y-y_offset)
+        if window is None:
+            return
+        map_window, patch_window = window
+        self.mark_changed(map_window[0].start, map_window[1].start,
+                          map_window[0].stop, map_window[1].stop)
+        self.fuse_patch(self.log_odds_prob[map_window], data[patch_window])
+        UPDATE_GRID_SECONDS.observe(time.perf_counter() - start)
+
+    def fuse_patch(self, cells, patch):
+        """update a window of map cells in place from a sensor patch of the same shape"""
+        if self.fixed_point:
+            updated = cells + self.fixed_point_increment(patch)
+            cells[...] = np.clip(updated, self.fixed_min, self.fixed_max)
+            return
+
+        # 0.5 carries no information, 0 halves the cell and anything else is added
+        cells += np.where(patch == 0.5, 0, patch)
+        cells[patch == 0] /= 2
+
+    def clip_window(self, shape, x0, y0):
+        """ return the (map, patch) slices of a patch with the given shape placed with its
+            first cell at map cell (x0, y0), or None if it does not overlap the map
+        """
+        x_start, y_start = max(x0, 0), max(y0, 0)
+        x_stop = min(x0 + shape[0], self.log_odds_prob.shape[0])
+        y_stop = min(y0 + shape[1], self.log_odds_prob.shape[1])
+        if x_start >= x_stop or y_start >= y_stop:
+            return None
+        map_window = (slice(x_start, x_stop), slice(y_start, y_stop))
+        patch_window = (slice(x_start - x0, x_stop - x0), slice(y_start - y0, y_stop - y0))
+        return map_window, patch_window
+
+    def beam_patch(self, hdg, bw, bw_res, rng, rng_max, rng_res):
+        """return (sensor_reading, beam_origin, hdg) from the beam cache when one is set"""
+        if self.beam_cache is None:
+            return self.range_bearing_sample(hdg, bw, bw_res, rng, rng_max, rng_res)
+        return self.beam_cache.get(self, hdg, bw, bw_res, rng, rng_max, rng_res)
 
     def sensor_reading(self, x, y, hdg, bw, bw_res, rng, rng_max, rng_res ):
-        data, center, angle  = self.range_bearing_sample(hdg, bw, bw_res, rng, rng_max, rng_res )
+        start = time.perf_counter()
+        data, center, angle  = self.beam_patch(hdg, bw, bw_res, rng, rng_max, rng_res )
         self.update_grid(data, x, y, center[0], center[1])
+        READINGS_TOTAL.inc()
+        SENSOR_READING_SECONDS.observe(time.perf_counter() - start)
+
+    def beam_cells(self, hdg, bw, bw_res, rng, rng_max, rng_res):
+        """ return (sensor_reading, beam_origin, free, hits, values) with the patch_cells of
+            the patch, from the beam cache when one is set
+        """
+        if self.beam_cache is not None:
+            return self.beam_cache.cells(self, hdg, bw, bw_res, rng, rng_max, rng_res)
+        data, origin, _ = self.range_bearing_sample(hdg, bw, bw_res, rng, rng_max, rng_res)
+        return (data, origin) + patch_cells(data)
+
+    def sensor_readings(self, poses, headings, ranges, bw, bw_res, rng_max, rng_res):
+        """ apply a batch of readings, e.g. a whole ultra scan, with a single grid write
+            poses = (N, 2) map cells of the sensor, headings in degrees, ranges in meters
+
+            The result matches calling sensor_reading for each reading in order: every cell
+            ends up as v*0.5**h + sum(b_i*0.5**h_i) where h counts the free hits on the
+            cell and h_i the free hits that come after the i-th additive hit. The readings
+            are gathered last to first, so h_i is the free hit count of the cell when its
+            hit is gathered, and only the cone cells of each patch are touched. In the fixed
+            point modes the increments are summed and the cell is clamped once, so it only
+            differs from the sequential result where a cell saturates part way through.
+        """
+        start = time.perf_counter()
+        shape = self.log_odds_prob.shape
+        poses, headings, ranges = reading_arrays(poses, headings, ranges)
+        READINGS_TOTAL.inc(len(headings))
+        # (free, hits, values, first patch cell) of each reading, last first
+        readings, touched = [], []
+        for pose, hdg, rng in zip(poses[::-1].tolist(), headings[::-1].tolist(),
+                                  ranges[::-1].tolist()):
+            data, center, free, hits, values = self.beam_cells(hdg, bw, bw_res, rng, rng_max,
+                                                               rng_res)
+            x0, y0 = pose[0] - center[0], pose[1] - center[1]
+            window = self.clip_window(data.shape, x0, y0)
+            if window is None:
+                continue
+            map_window, patch_window = window
+            if data[patch_window].shape != data.shape:
+                # the patch runs off the map, keep its cells on the map
+                x0, y0 = map_window[0].start, map_window[1].start
+                free, hits, values = patch_cells(data[patch_window])
+            readings.append((free, hits, values, x0, y0))
+            touched.append((map_window[0].start, map_window[1].start,
+                            map_window[0].stop, map_window[1].stop))
+        if not touched:
+            return
+
+        # free hits and additive values, or log-odds increments, over the touched box
+        x_min, y_min, _, _ = np.min(touched, axis=0)
+        _, _, x_max, y_max = np.max(touched, axis=0)
+        free_hits = np.zeros((x_max - x_min, y_max - y_min), dtype=np.int32)
+        added = np.zeros(free_hits.shape, dtype=np.int32 if self.fixed_point else float)
+        free_increment = self.fixed_point_increment(0) if self.fixed_point else 1
+        for free, hits, values, x0, y0 in readings:
+            hits = (hits[0] + (x0 - x_min), hits[1] + (y0 - y_min))
+            if self.fixed_point:
+                added[hits] += self.fixed_point_increment(values)
+            else:
+                added[hits] += np.ldexp(values, -free_hits[hits])
+            free_hits[free[0] + (x0 - x_min), free[1] + (y0 - y_min)] += free_increment
+
+        self.mark_changed(x_min, y_min, x_max, y_max)
+        cells = self.log_odds_prob[x_min:x_max, y_min:y_max]
+        if self.fixed_point:
+            cells[...] = np.clip(cells + free_hits + added, self.fixed_min, self.fixed_max)
+        else:
+            cells[...] = np.ldexp(cells, -free_hits) + added
+        SENSOR_READINGS_SECONDS.observe(time.perf_counter() - start)
+
+    def beam_contributions(self, poses, headings, ranges, bw, bw_res, rng_max, rng_res):
+        """ return the (x, y, value) map cells of every informative patch cell of a batch
+            of readings, in reading order
+        """
+        poses, headings, ranges = reading_arrays(poses, headings, ranges)
+        cell_x, cell_y, values = [np.empty(0, int)], [np.empty(0, int)], [np.empty(0)]
+        for pose, hdg, rng in zip(poses, headings, ranges):
+            data, center, _ = self.beam_patch(hdg, bw, bw_res, rng, rng_max, rng_res)
+            # cells holding 0.5 carry no information and are skipped
+            informative = np.flatnonzero(data != 0.5)
+            px, py = np.divmod(informative, data.shape[1])
+            cell_x.append(px + (pose[0] - center[0]))
+            cell_y.append(py + (pose[1] - center[1]))
+            values.append(data.ravel()[informative])
+        return np.concatenate(cell_x), np.concatenate(cell_y), np.concatenate(values)
+
+    def log_odds_contributions(self, poses, headings, ranges, bw, bw_res, rng_max, rng_res):
+        """ return (cell_x, cell_y, increments) of a batch of readings in the fixed point
+            modes, one entry per touched cell holding the sum of its log-odds increments.
+            Log-odds add, so batches may be computed apart, e.g. in other processes, and
+            added with add_log_odds in any order
+        """
+        cell_x, cell_y, values = self.beam_contributions(poses, headings, ranges, bw, bw_res,
+                                                         rng_max, rng_res)
+        if len(values) == 0:
+            return cell_x, cell_y, np.empty(0, np.int32)
+        x_min, y_min = cell_x.min(), cell_y.min()
+        span = cell_y.max() - y_min + 1
+        keys, inverse = np.unique((cell_x - x_min)*span + (cell_y - y_min), return_inverse=True)
+        added = np.bincount(inverse, weights=self.fixed_point_increment(values))
+        cell_x, cell_y = np.divmod(keys, span)
+        return cell_x + x_min, cell_y + y_min, added.astype(np.int32)
+
+    def add_log_odds(self, cell_x, cell_y, increments):
+        """ add fixed point log-odds increments from log_odds_contributions to the map,
+            each cell listed at most once; cells off the map are dropped
+        """
+        inside = (cell_x >= 0) & (cell_x < self.log_odds_prob.shape[0])
+        inside &= (cell_y >= 0) & (cell_y < self.log_odds_prob.shape[1])
+        cell_x, cell_y = cell_x[inside], cell_y[inside]
+        if len(cell_x) == 0:
+            return
+        self.mark_changed(cell_x.min(), cell_y.min(), cell_x.max() + 1, cell_y.max() + 1)
+        flat = np.ravel_multi_index((cell_x, cell_y), self.log_odds_prob.shape)
+        grid = self.log_odds_prob.reshape(-1)
+        grid[flat] = np.clip(grid[flat] + increments[inside], self.fixed_min, self.fixed_max)
+
+    def fuse_contributions(self, grid, flat, values):
+        """ apply contributions listed in reading order to a flat view of map cells
+            flat = index of each contribution in grid, values = its patch value
+        """
+        if len(flat) == 0:
+            return
+        if self.fixed_point:
+            cells, inverse = np.unique(flat, return_inverse=True)
+            added = np.bincount(inverse, weights=self.fixed_point_increment(values))
+            grid[cells] = np.clip(grid[cells] + added.astype(np.int32), self.fixed_min, self.fixed_max)
+            return
+
+        # group the contributions by cell, a stable sort keeps reading order within each cell
+        sort = np.argsort(flat, kind='stable')
+        flat = flat[sort]
+        values = values[sort]
+        halve = (values == 0).astype(np.int32)
+        new_cell = np.r_[True, flat[1:] != flat[:-1]]
+        start = np.flatnonzero(new_cell)
+        cells = flat[start]
+        inverse = np.cumsum(new_cell) - 1
+
+        # free hits on each cell, and free hits after each contribution
+        total_halve = np.add.reduceat(halve, start)
+        halve_sum = np.cumsum(halve)
+        halve_before = halve_sum[start] - halve[start]
+        later_halve = total_halve[inverse] - (halve_sum - halve_before[inverse])
+
+        added = np.bincount(inverse, weights=values*np.ldexp(1.0, -later_halve), minlength=len(cells))
+        grid[cells] = np.ldexp(grid[cells], -total_halve) + added
+
+    def occupied(self, bounds, threshold=0.7):
+        """return a mask of the cells inside bounds whose occupancy probability is above threshold"""
+        cells = self.get_region(bounds)
+        if not self.fixed_point:
+            return cells > threshold
+        return cells > np.log(threshold/(1 - threshold))/self.log_odds_scale
+
+    def distance_field(self, threshold=0.7):
+        """ return (distance, x_min, y_min): the distance in cells from every cell to the
+            nearest occupied cell, capped at distance_limit, with distance[0, 0] at map cell
+            (x_min, y_min). A cell is occupied when its probability is above threshold.
+
+            The field is brought up to date from changes_since: a change can only move
+            distances within distance_limit of it, so each changed rectangle is recomputed
+            over a margin of distance_limit, reading obstacles from a margin of twice that.
+            distance_field_version counts the field updates.
+        """
+        bounds = self.bounds()
+        if self._distance_key != (threshold, bounds):
+            self._distance_field = np.full((bounds[2] - bounds[0], bounds[3] - bounds[1]),
+                                           self.distance_limit, dtype=np.float32)
+            self._distance_key = (threshold, bounds)
+            self._distance_version = -1
+        if self._distance_version != self.version:
+            version, changes = self.changes_since(self._distance_version)
+            if self._distance_version < 0:
+                changes = [bounds]
+            for rect in merge_rects(changes, margin=2*self.distance_limit):
+                self.update_distance_field(rect, threshold)
+            self._distance_version = version
+            self.distance_field_version += 1
+        return self._distance_field, bounds[0], bounds[1]
+
+    def update_distance_field(self, rect, threshold):
+        """recompute the distance field around a changed rectangle of map cells"""
+        x_min, y_min, x_max, y_max = self.bounds()
+        limit = self.distance_limit
+
+        def grow(margin):
+            return (max(rect[0] - margin, x_min), max(rect[1] - margin, y_min),
+                    min(rect[2] + margin, x_max), min(rect[3] + margin, y_max))
+
+        out, source = grow(limit), grow(2*limit)
+        if out[0] >= out[2] or out[1] >= out[3]:
+            return
+        occupied = self.occupied(source, threshold)
+        if occupied.any():
+            distance = np.minimum(ndimage.distance_transform_edt(~occupied), limit)
+        else:
+            distance = np.full(occupied.shape, limit)
+        self._distance_field[out[0] - x_min:out[2] - x_min, out[1] - y_min:out[3] - y_min] = \
+            distance[out[0] - source[0]:out[2] - source[0], out[1] - source[1]:out[3] - source[1]]
+
+    @property
+    def distance_field_stale(self):
+        """True when the map has been written since the distance field was last updated"""
+        return self._distance_key is None or self._distance_version != self.version
+
+    def invalidate_distance_field(self):
+        """force the next distance_field call to recompute the whole field"""
+        self._distance_key = None
+
+    def distance_at(self, x, y, threshold=0.7):
+        """return the distance in cells from map cells (x, y) to the nearest occupied cell"""
+        distance, x_min, y_min = self.distance_field(threshold)
+        x = np.asarray(x, dtype=int) - x_min
+        y = np.asarray(y, dtype=int) - y_min
+        inside = (x >= 0) & (x < distance.shape[0]) & (y >= 0) & (y < distance.shape[1])
+        return np.where(inside, distance[np.clip(x, 0, distance.shape[0] - 1),
+                                         np.clip(y, 0, distance.shape[1] - 1)], self.distance_limit)
+
+    def expected_range(self, x, y, hdg, rng_max, bw=0, bw_res=1.0, threshold=0.7):
+        """ return the range in meters a range-bearing sensor at map cells (x, y) pointing
+            at hdg degrees should read, rng_max where nothing is hit. x, y and hdg may be
+            arrays of queries. With bw > 0 rays are cast every bw_res degrees across the
+            beam, as in range_bearing_sample, and the shortest range is returned.
+
+            Rays are sphere traced over distance_field: each step advances by the distance
+            to the nearest occupied cell, so open space is crossed in a few steps.
+        """
+        x, y, hdg = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(y, dtype=float),
+                                        np.asarray(hdg, dtype=float))
+        shape = x.shape
+        offsets = np.arange(-bw/2, bw/2 + bw_res/2, bw_res) if bw > 0 else np.zeros(1)
+        angles = np.radians(hdg.reshape(-1, 1) + offsets).ravel()
+        ray_x = np.repeat(x.ravel(), len(offsets))
+        ray_y = np.repeat(y.ravel(), len(offsets))
+        ranges = self.cast_rays(ray_x, ray_y, np.cos(angles), np.sin(angles),
+                                rng_max/self.resolution, threshold)
+        return (ranges.reshape(-1, len(offsets)).min(axis=1)*self.resolution).reshape(shape)
+
+    def cast_rays(self, x, y, dir_x, dir_y, max_cells, threshold=0.7):
+        """return the distance in cells along each ray to the first occupied cell, max_cells if none"""
+        distance, x_min, y_min = self.distance_field(threshold)
+        ranges = np.full(len(x), float(max_cells))
+        travel = np.zeros(len(x))
+        active = np.arange(len(x))
+        while len(active):
+            cell_x = np.rint(x[active] + travel[active]*dir_x[active]).astype(int) - x_min
+            cell_y = np.rint(y[active] + travel[active]*dir_y[active]).astype(int) - y_min
+            inside = (cell_x >= 0) & (cell_x < distance.shape[0])
+            inside &= (cell_y >= 0) & (cell_y < distance.shape[1])
+            clearance = np.full(len(active), np.inf)
+            clearance[inside] = distance[cell_x[inside], cell_y[inside]]
+
+            hit = clearance == 0
+            ranges[active[hit]] = np.minimum(np.hypot(cell_x[hit] + x_min - x[active[hit]],
+                                                      cell_y[hit] + y_min - y[active[hit]]),
+                                             max_cells)
+            # rays leaving the map see nothing more
+            done = hit | ~inside
+            # the nearest occupied cell is at least clearance away, less one cell of rounding
+            travel[active] += np.maximum(clearance - 1, 1)
+            done |= travel[active] > max_cells
+            active = active[~done]
+        return ranges
 
     def plot_grid(self):
-        plt.imshow(self.log_odds_prob.T, aspect='equal', origin='lower', cmap='hot')
+        plt.imshow(self.get_map().T, aspect='equal', origin='lower', cmap='hot')
         plt.show()
     
 
@@ -132,6 +934,79 @@ class Occupancy_Grid():
             rng = range reading in meters
             bw_res = angular resolutioon in degress
             rng_res = range resolution in meters
+
+            The whole cone is evaluated in one pass: range and bearing are computed for
+            every cell of the beam bounding box and cells inside the cone are classified
+            as free (0), near the return (0.75), at the return (1.0) or beyond it (0.5).
+            The cone covers the same cells as the bw/bw_res rays of
+            range_bearing_sample_raycast, apart from ray ends that leave the bounding box,
+            which the rays fold onto its border.
+        """
+        deg2rad = np.pi/180
+
+        range_cells_max = floor(rng_max/rng_res)
+        range_cells = floor(rng/rng_res)
+        center_angle = hdg*deg2rad
+        half_bw = bw*deg2rad/2
+
+        # beam origin plus the left, center and right extents
+        extent_angles = np.array([center_angle + half_bw, center_angle, center_angle - half_bw])
+        beam_x = np.r_[0.0, range_cells_max*np.cos(extent_angles)]
+        beam_y = np.r_[0.0, range_cells_max*np.sin(extent_angles)]
+
+        num_x_pixels = int(np.ceil(beam_x.max() - beam_x.min()))
+        num_y_pixels = int(np.ceil(beam_y.max() - beam_y.min()))
+
+        # shift origin coords if the beam extents are less than zero
+        x_offset = int(np.abs(beam_x.min()))
+        y_offset = int(np.abs(beam_y.min()))
+        beam_origin = [x_offset, y_offset]
+
+        dx = (np.arange(num_x_pixels) - x_offset)[:, np.newaxis]
+        dy = (np.arange(num_y_pixels) - y_offset)[np.newaxis, :]
+
+        # the outermost rays, the last one is half a step short of the left beam extent
+        angles = np.arange(-bw/2*deg2rad, bw/2*deg2rad, deg2rad*bw_res) + center_angle
+        left_x, left_y = np.cos(angles[-1]), np.sin(angles[-1])
+        right_x, right_y = np.cos(angles[0]), np.sin(angles[0])
+        center_x, center_y = np.cos(center_angle), np.sin(center_angle)
+
+        # a ray marks the cell nearest to it in each column (shallow rays) or row (steep
+        # rays), so a cell is hit by an edge ray when its signed distance outside that
+        # ray is within half a cell measured along the column or row
+        left_tol = 0.5*max(abs(left_x), abs(left_y))
+        right_tol = 0.5*max(abs(right_x), abs(right_y))
+        in_cone = (left_x*dy - left_y*dx) <= left_tol
+        in_cone &= (right_y*dx - right_x*dy) <= right_tol
+        in_cone &= (center_x*dx + center_y*dy) >= 0
+        cone_x, cone_y = np.nonzero(in_cone)
+        cone_dx, cone_dy = cone_x - x_offset, cone_y - y_offset
+
+        # a ray runs on to the first cell at or past range_cells_max along its major axis,
+        # so it reaches major when range_cells_max*major/dist > major - 1; every ray starts
+        # at the origin
+        dist_sq = cone_dx**2 + cone_dy**2
+        major = np.maximum(np.abs(cone_dx), np.abs(cone_dy))
+        reached = (major - 1)**2*dist_sq < range_cells_max**2*major**2
+        reached |= major == 0
+        cone_x, cone_y, dist_sq = cone_x[reached], cone_y[reached], dist_sq[reached]
+
+        # classify by squared range, same bands as the ray traced model
+        band_cells = 36
+        cell = dist_sq - range_cells**2
+        occupancy = np.zeros(cell.shape)
+        occupancy[np.abs(cell) <= band_cells**2] = 0.75
+        occupancy[cell >= range_cells*2] = 0.5
+        occupancy[np.abs(cell) <= range_cells*2] = 1.0
+
+        sensor_reading = np.full((num_x_pixels, num_y_pixels), 0.5)
+        sensor_reading[cone_x, cone_y] = occupancy
+
+        return sensor_reading, beam_origin, hdg
+
+    def range_bearing_sample_raycast(self, hdg, bw, bw_res, rng, rng_max, rng_res):
+        """ reference ray traced version of range_bearing_sample
+            walks one bresenham line per beam angle, kept for parity checks and benchmarks
         """ 
         rad2deg = np.pi/180
         
@@ -184,29 +1059,29 @@ class Occupancy_Grid():
         if beam[:,1].min() < 0:
             beam_origin[1] = y_offset
 
-        for theta in angles:
-            beam_extent = [range_cells_max*np.cos(theta)+x_offset, range_cells_max*np.sin(theta)+y_offset]
-            edge = bresenham(beam_origin, beam_extent)
-            # print(beam_origin, beam_extent)
-            # shift bem pixel coords by center offset
-            #edge[0][:] += x_offset
-            #edge[1][:] += y_offset
-            # remove any out of range pixels
-            s = edge[0] >=num_x_pixels
-            edge[0][s] = num_x_pixels-1
-            s = edge[1] >=num_y_pixels
-            edge[1][s] = num_y_pixels-1
-            
-            sensor_reading[tuple(edge)] = 0
-            band = range_cells-36
-            for ind in range(0,edge.shape[1]):
-                cell = (edge[0,ind]-x_offset)**2+(edge[1,ind]-y_offset)**2 - (range_cells**2)
-                if abs(cell) <= (range_cells*2):
-                    # pixels at range have occupancy likelihood of 1
-                    sensor_reading[tuple(edge[:,ind])] = 1.0
-                elif cell >= (range_cells)*2:
-                    sensor_reading[tuple(edge[:,ind])] = 0.5
-                elif (abs(cell) <= ((range_cells-band)**2)) : #and (abs(cell) > ((range_cells)**2))
-                    sensor_reading[tuple(edge[:,ind])] = 0.75
+        beam_extent = np.stack([range_cells_max*np.cos(angles)+x_offset,
+                                range_cells_max*np.sin(angles)+y_offset], axis=1)
+        edges, offsets = bresenham_rays(np.tile(beam_origin, (len(angles), 1)), beam_extent)
+        ray = np.repeat(np.arange(len(angles)), np.diff(offsets))
+        # remove any out of range pixels
+        edges[0, edges[0] >= num_x_pixels] = num_x_pixels-1
+        edges[1, edges[1] >= num_y_pixels] = num_y_pixels-1
+
+        band = range_cells-36
+        cell = (edges[0]-x_offset)**2+(edges[1]-y_offset)**2 - (range_cells**2)
+        value = np.full(cell.shape, 0.0)
+        value[(abs(cell) <= ((range_cells-band)**2))] = 0.75
+        value[cell >= (range_cells)*2] = 0.5
+        # pixels at range have occupancy likelihood of 1
+        value[abs(cell) <= (range_cells*2)] = 1.0
+
+        # each ray clears its pixels before marking them, so a pixel keeps the value from
+        # the last ray through it: the last marked pixel of that ray, else free
+        index = np.ravel_multi_index(tuple(edges), sensor_reading.shape, mode='wrap')
+        last_ray = np.full(sensor_reading.size, -1)
+        np.maximum.at(last_ray, index, ray)
+        sensor_reading.ravel()[index] = 0
+        marked = (ray == last_ray[index]) & (value != 0)
+        sensor_reading.ravel()[index[marked]] = value[marked]
 
         return sensor_reading, beam_origin, hdg
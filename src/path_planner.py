@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# incremental path planning over the occupancy grid with D* Lite
+
+import heapq
+from array import array
+from math import inf
+import numpy as np
+
+SQRT2 = 2**0.5
+
+# 8-connected moves (dx, dy, step length)
+MOVES = [(1, 0, 1.0), (-1, 0, 1.0), (0, 1, 1.0), (0, -1, 1.0),
+         (1, 1, SQRT2), (1, -1, SQRT2), (-1, 1, SQRT2), (-1, -1, SQRT2)]
+
+
+def cell_costs(grid, bounds, threshold=0.65, cost_scale=10.0):
+    """ return the cost of crossing each map cell inside bounds = (x_min, y_min, x_max, y_max)
+
+        Free and unexplored cells cost 1, cells more likely occupied than not cost up to
+        1 + cost_scale/2 and cells with an occupancy probability above threshold are
+        blocked (inf).
+    """
+    cells = grid.get_region(bounds)
+    if grid.fixed_point:
+        probability = 1 - 1/(1 + np.exp(cells.astype(np.float32) * np.float32(grid.log_odds_scale)))
+    else:
+        probability = np.minimum(cells, 1.0)
+    costs = 1 + cost_scale*np.maximum(probability - 0.5, 0)
+    costs[probability > threshold] = inf
+    return costs
+
+
+def path_waypoints(path):
+    """return the cells of path where it changes direction, and its last cell"""
+    if len(path) < 2:
+        return list(path)
+    waypoints = []
+    for prev, cell, following in zip(path, path[1:], path[2:]):
+        if (cell[0] - prev[0], cell[1] - prev[1]) != (following[0] - cell[0], following[1] - cell[1]):
+            waypoints.append(cell)
+    waypoints.append(path[-1])
+    return waypoints
+
+
+class DStarLite:
+    """ D* Lite shortest paths to a fixed goal cell of an occupancy grid
+
+        The search runs backwards from the goal over the 8-connected map cells, an edge
+        costing its length times the mean cost of its two cells (cell_costs). Diagonal
+        moves may not cut the corner of a blocked cell. Each plan call moves the start to
+        the robot position and repairs the search only around the cells written since the
+        previous call, read from grid.changes_since, instead of planning from scratch.
+
+        The costs are held with a blocked border one cell wide so neighbours never need a
+        bounds check, cells are flat indices into that padded array. g and rhs only hold
+        the cells the search has touched; the open list is a heap with stale entries
+        skipped on pop.
+    """
+
+    def __init__(self, grid, goal, threshold=0.65, cost_scale=10.0):
+        self.grid = grid
+        self.goal = (int(goal[0]), int(goal[1]))
+        self.threshold = threshold
+        self.cost_scale = cost_scale
+        self.bounds = None
+        self.expanded = 0
+
+    def reset(self, start):
+        """start a new search over the current grid bounds"""
+        self.bounds = self.grid.bounds()
+        x_min, y_min, x_max, y_max = self.bounds
+        self.nx, self.ny = x_max - x_min, y_max - y_min
+        self.width = width = self.ny + 2
+        self.version = self.grid.version
+        padded = np.full((self.nx + 2, width), inf)
+        padded[1:-1, 1:-1] = cell_costs(self.grid, self.bounds, self.threshold, self.cost_scale)
+        # an array of doubles indexes to python floats quickly, the numpy view writes it
+        self.costs = array('d', padded.tobytes())
+        self.cost_view = np.frombuffer(self.costs, dtype=np.float64).reshape(padded.shape)
+        # (neighbour offset, offsets of the two cells beside a diagonal step, step length)
+        self.moves = [(dx*width + dy, dx*width, dy, length) for dx, dy, length in MOVES]
+        self.g = {}
+        self.rhs = {}
+        self.open = {}
+        self.heap = []
+        self.km = 0.0
+        self.set_start(start)
+        self.last = self.start
+        self.goal_index = self.index(self.goal)
+        self.rhs[self.goal_index] = 0.0
+        self.push(self.goal_index, self.key(self.goal_index))
+
+    def index(self, cell):
+        """return the flat index of map cell (x, y)"""
+        x, y = int(cell[0]) - self.bounds[0], int(cell[1]) - self.bounds[1]
+        if not (0 <= x < self.nx and 0 <= y < self.ny):
+            raise ValueError(f"cell {tuple(cell)} is outside the map {self.bounds}")
+        return (x + 1)*self.width + y + 1
+
+    def cell(self, u):
+        """return the map cell (x, y) of flat index u"""
+        x, y = divmod(u, self.width)
+        return (x - 1 + self.bounds[0], y - 1 + self.bounds[1])
+
+    def set_start(self, start):
+        self.start = self.index(start)
+        self.start_xy = divmod(self.start, self.width)
+
+    def heuristic(self, u):
+        """octile distance in cells from the start to u, a lower bound as cells cost >= 1"""
+        ux, uy = divmod(u, self.width)
+        dx, dy = abs(ux - self.start_xy[0]), abs(uy - self.start_xy[1])
+        return dx + dy + (SQRT2 - 2)*min(dx, dy)
+
+    def key(self, u):
+        g = min(self.g.get(u, inf), self.rhs.get(u, inf))
+        return (g + self.heuristic(u) + self.km, g)
+
+    def push(self, u, key):
+        self.open[u] = key
+        heapq.heappush(self.heap, (key[0], key[1], u))
+
+    def top(self):
+        """return (key, u) of the open cell with the smallest key, (inf, inf), None when empty"""
+        heap, open_keys = self.heap, self.open
+        while heap:
+            k1, k2, u = heap[0]
+            if open_keys.get(u) == (k1, k2):
+                return (k1, k2), u
+            heapq.heappop(heap)
+        return (inf, inf), None
+
+    def neighbours(self, u):
+        """return [(v, edge cost)] for the 8 neighbours of u, blocked edges cost inf"""
+        costs = self.costs
+        cost_u = costs[u]
+        if cost_u == inf:
+            return [(u + step, inf) for step, _, _, _ in self.moves]
+        edges = []
+        for step, side_x, side_y, length in self.moves:
+            cost_v = costs[u + step]
+            if costs[u + side_x] == inf or costs[u + side_y] == inf:
+                cost_v = inf
+            edges.append((u + step, length*(cost_u + cost_v)/2))
+        return edges
+
+    def update_vertex(self, u):
+        """recompute rhs(u) from its neighbours and fix its place in the open list"""
+        if u != self.goal_index:
+            if self.costs[u] == inf:
+                self.rhs[u] = inf
+            else:
+                g = self.g
+                self.rhs[u] = min(cost + g.get(v, inf) for v, cost in self.neighbours(u))
+        if self.g.get(u, inf) != self.rhs.get(u, inf):
+            self.push(u, self.key(u))
+        else:
+            self.open.pop(u, None)
+
+    def compute_shortest_path(self):
+        """expand cells until the start is consistent and no open key is below it"""
+        g, rhs, open_keys, heap = self.g, self.rhs, self.open, self.heap
+        costs, moves, width = self.costs, self.moves, self.width
+        start, goal = self.start, self.goal_index
+        sx, sy = self.start_xy
+        km, diagonal = self.km, SQRT2 - 2
+        push = heapq.heappush
+        while True:
+            top_key, u = self.top()
+            if u is None or (top_key >= self.key(start) and rhs.get(start, inf) == g.get(start, inf)):
+                return
+            new_key = self.key(u)
+            if top_key < new_key:
+                self.push(u, new_key)
+                continue
+            del open_keys[u]
+            self.expanded += 1
+            g_u, rhs_u = g.get(u, inf), rhs.get(u, inf)
+            if g_u > rhs_u:
+                g[u] = rhs_u
+                # g(u) dropped, a neighbour can only improve by stepping to u
+                cost_u = costs[u]
+                for step, side_x, side_y, length in moves:
+                    v = u + step
+                    cost_v = costs[v]
+                    if cost_v == inf or costs[u + side_x] == inf or costs[u + side_y] == inf:
+                        continue
+                    rhs_v = rhs_u + length*(cost_u + cost_v)/2
+                    if rhs_v >= rhs.get(v, inf) or v == goal:
+                        continue
+                    rhs[v] = rhs_v
+                    g_v = g.get(v, inf)
+                    if g_v == rhs_v:
+                        open_keys.pop(v, None)
+                        continue
+                    k2 = min(g_v, rhs_v)
+                    vx, vy = divmod(v, width)
+                    dx, dy = abs(vx - sx), abs(vy - sy)
+                    k1 = k2 + dx + dy + diagonal*min(dx, dy) + km
+                    open_keys[v] = (k1, k2)
+                    push(heap, (k1, k2, v))
+            else:
+                g[u] = inf
+                self.update_vertex(u)
+                # only the neighbours whose rhs came through u need recomputing
+                for v, cost in self.neighbours(u):
+                    if v in rhs and rhs[v] == cost + g_u:
+                        self.update_vertex(v)
+
+    def apply_changes(self):
+        """re-cost the cells written since the last plan and update the cells around them"""
+        version, changes = self.grid.changes_since(self.version)
+        self.version = version
+        x_min, y_min, x_max, y_max = self.bounds
+        changed = []
+        for x0, y0, x1, y1 in changes:
+            x0, y0, x1, y1 = max(x0, x_min), max(y0, y_min), min(x1, x_max), min(y1, y_max)
+            if x0 >= x1 or y0 >= y1:
+                continue
+            costs = cell_costs(self.grid, (x0, y0, x1, y1), self.threshold, self.cost_scale)
+            window = self.cost_view[x0 - x_min + 1:x1 - x_min + 1, y0 - y_min + 1:y1 - y_min + 1]
+            cx, cy = np.nonzero(costs != window)
+            window[cx, cy] = costs[cx, cy]
+            changed.append((cx + x0 - x_min + 1)*self.width + cy + y0 - y_min + 1)
+        if not changed:
+            return
+        # an edge cost depends on the cells at most one step from either end
+        cells = np.concatenate(changed)
+        affected = set()
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                affected.update((cells + dx*self.width + dy).tolist())
+        # a blocked cell is never given an rhs, but once freed it may border cells the
+        # search reached; only cells blocked now and never touched can be skipped
+        costs = self.costs
+        for u in affected:
+            if u in self.rhs or costs[u] != inf:
+                self.update_vertex(u)
+
+    def plan(self, start):
+        """ return the path of map cells from start to the goal, both included, or an
+            empty list when the goal cannot be reached
+        """
+        if self.bounds != self.grid.bounds():
+            self.reset(start)
+        else:
+            self.set_start(start)
+            self.km += self.heuristic(self.last)
+            self.last = self.start
+            self.apply_changes()
+        self.compute_shortest_path()
+        return self.extract_path()
+
+    def path_cost(self):
+        """return the cost of the planned path from the start, inf when there is none"""
+        return self.rhs.get(self.start, inf)
+
+    def extract_path(self):
+        """follow the cheapest neighbour from the start down to the goal"""
+        g = self.g
+        u = self.start
+        if self.rhs.get(u, inf) == inf:
+            return []
+        path = [self.cell(u)]
+        while u != self.goal_index and len(path) <= self.nx*self.ny:
+            cost, u = min((cost + g.get(v, inf), v) for v, cost in self.neighbours(u))
+            if cost == inf:
+                return []
+            path.append(self.cell(u))
+        return path
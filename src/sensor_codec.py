@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# compact binary sensor payloads, with JSON as the fallback format
+#
+# A binary payload starts with a header byte holding the codec version, a control
+# character that no JSON text can start with, so the first byte tells the two formats
+# apart on the same topic. Versions other than CODEC_VERSION are rejected.
+#
+#   header  <BBH   version, sensor kind, record count
+#   records fixed layout per kind, count of them back to back
+
+import json
+import struct
+from itertools import chain
+from math import isfinite
+
+CODEC_VERSION = 1
+
+# bytes below 0x20 other than these never start JSON text
+JSON_WHITESPACE = b"\t\n\r"
+
+HEADER = struct.Struct("<BBH")
+
+# sensor kind -> (kind id, record layout); fields follow the JSON lists
+RECORDS = {
+    "ultra": (1, struct.Struct("<dff")),   # [t, hdg, range in cm]
+    "hdg": (2, struct.Struct("<df")),      # [t, hdg]
+    "accel": (3, struct.Struct("<dfff")),  # [t, ax, ay, az]
+}
+
+KINDS = {kind_id: (kind, record) for kind, (kind_id, record) in RECORDS.items()}
+
+# sensor kind -> number of fields in a sample
+FIELDS = {kind: len(record.unpack(bytes(record.size))) for kind, (_, record) in RECORDS.items()}
+
+
+def is_binary(payload):
+    """True when payload starts with a binary codec header, of any version, rather than JSON"""
+    return len(payload) > 0 and payload[0] < 0x20 and payload[0] not in JSON_WHITESPACE
+
+
+def encode(kind, samples):
+    """return the binary payload for a list of samples of kind, each a list of the record fields"""
+    kind_id, record = RECORDS[kind]
+    payload = bytearray(HEADER.size + record.size*len(samples))
+    HEADER.pack_into(payload, 0, CODEC_VERSION, kind_id, len(samples))
+    for i, sample in enumerate(samples):
+        record.pack_into(payload, HEADER.size + i*record.size, *sample)
+    return bytes(payload)
+
+
+def encode_json(samples):
+    """return the JSON payload for a list of samples, a single sample is sent unbatched"""
+    return json.dumps(samples[0] if len(samples) == 1 else samples).encode("utf-8")
+
+
+def decode(payload, kind):
+    """ return the samples in a payload as a list of tuples of floats
+
+        Binary payloads are unpacked with their record layout, anything else is read as
+        JSON: either one sample [t, ...] or a batch [[t, ...], ...]. A payload of another
+        codec version, or holding a sample with fewer fields than the record of its kind
+        or a field that is not a finite number, raises ValueError: the whole message is
+        dropped as malformed
+    """
+    if not is_binary(payload):
+        samples = json.loads(payload.decode("utf-8"))
+        if not isinstance(samples, list):
+            raise ValueError(f"{kind} payload is not a JSON list")
+        if samples and not isinstance(samples[0], list):
+            samples = [samples]
+        fields = FIELDS[kind]
+        decoded = []
+        for sample in samples:
+            if not isinstance(sample, list) or len(sample) < fields:
+                raise ValueError(f"{kind} sample {sample!r} has fewer than {fields} fields")
+            try:
+                decoded.append(tuple(map(float, sample)))
+            except (TypeError, ValueError):
+                raise ValueError(f"{kind} sample {sample!r} holds a field that is not a number") from None
+    else:
+        if payload[0] != CODEC_VERSION:
+            raise ValueError("unsupported codec version")
+        if len(payload) < HEADER.size:
+            raise ValueError(f"payload of {len(payload)} bytes is shorter than the header")
+        _, kind_id, count = HEADER.unpack_from(payload)
+        payload_kind, record = KINDS.get(kind_id, (None, None))
+        if payload_kind != kind:
+            raise ValueError(f"payload holds sensor kind {kind_id}, expected {kind}")
+        if len(payload) != HEADER.size + count*record.size:
+            raise ValueError(f"payload of {len(payload)} bytes does not hold {count} {kind} records")
+        decoded = list(record.iter_unpack(memoryview(payload)[HEADER.size:]))
+    # nan and inf make the total non finite, only then look for the sample holding them
+    if not isfinite(sum(chain.from_iterable(decoded))):
+        for sample in decoded:
+            if not all(isfinite(field) for field in sample):
+                raise ValueError(f"{kind} sample {sample!r} holds a field that is not finite")
+    return decoded
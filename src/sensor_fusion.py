@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# time alignment of the ultrasonic range readings with the compass heading stream
+
+import time
+import numpy as np
+
+
+def interpolate_heading(times, hdg_times, hdg_values):
+    """ headings [deg] at times interpolated from the (hdg_times, hdg_values) samples,
+        taking the short way round between two headings either side of 0/360
+    """
+    unwrapped = np.unwrap(hdg_values, period=360)
+    return np.interp(times, hdg_times, unwrapped) % 360
+
+
+class HeadingAligner():
+    """ pair each range reading with the heading at its timestamp
+
+        Range readings wait in add() until the heading stream, a RingBuffer of (time,
+        heading) samples, has a sample at or after their timestamp; release() then
+        returns them with the heading interpolated at their timestamp. A reading is
+        released with the heading of its own message when the heading buffer does not
+        span its timestamp: when there are no headings at all, when it is older than the
+        buffered headings, or when no later heading arrived within max_wait seconds.
+        Readings with a field that is not a finite number are never queued, they are
+        counted in rejected.
+    """
+
+    def __init__(self, headings, max_wait=0.2):
+        self.headings = headings
+        self.max_wait = max_wait
+        self.times = []
+        self.own_headings = []
+        self.ranges = []
+        self.arrivals = []
+        self.aligned = 0
+        self.unaligned = 0
+        self.rejected = 0
+
+    def __len__(self):
+        return len(self.times)
+
+    def add(self, times, own_headings, ranges):
+        """queue range readings with their timestamps and the heading of their message"""
+        # None becomes nan here, a reading that is not a number raises before anything is queued
+        readings = np.array([times, own_headings, ranges], dtype=float)
+        valid = np.isfinite(readings).all(axis=0)
+        self.rejected += len(valid) - int(np.count_nonzero(valid))
+        times, own_headings, ranges = readings[:, valid].tolist()
+        self.times.extend(times)
+        self.own_headings.extend(own_headings)
+        self.ranges.extend(ranges)
+        self.arrivals.extend([time.monotonic()]*len(times))
+
+    def release(self, flush=False):
+        """ return (times, headings, ranges) arrays of the readings that can be aligned
+            now, in arrival order. With flush every queued reading is released
+        """
+        if not self.times:
+            return np.empty(0), np.empty(0), np.empty(0)
+        times = np.array(self.times)
+        headings = np.array(self.own_headings, dtype=float)
+        hdg_times, hdg_values = self.headings.last()
+        if len(hdg_times) == 0:
+            count = len(times)
+            covered = np.zeros(count, dtype=bool)
+        else:
+            covered = (times >= hdg_times[0]) & (times <= hdg_times[-1])
+            ready = covered | (times < hdg_times[0])
+            if not flush:
+                ready |= time.monotonic() - np.array(self.arrivals) > self.max_wait
+            # release in order, up to the first reading still waiting for its heading
+            count = len(times) if ready.all() or flush else int(np.argmin(ready))
+            times, headings, covered = times[:count], headings[:count], covered[:count]
+            if covered.any():
+                # only the heading samples around the released readings are interpolated
+                start = max(np.searchsorted(hdg_times, times[covered].min(), side="right") - 1, 0)
+                stop = np.searchsorted(hdg_times, times[covered].max(), side="left") + 1
+                headings[covered] = interpolate_heading(times[covered], hdg_times[start:stop],
+                                                        hdg_values[start:stop])
+        ranges = np.array(self.ranges[:count], dtype=float)
+        del self.times[:count], self.own_headings[:count], self.ranges[:count]
+        del self.arrivals[:count]
+        aligned = int(np.count_nonzero(covered))
+        self.aligned += aligned
+        self.unaligned += count - aligned
+        return times, headings, ranges
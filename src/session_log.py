@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# record MQTT sensor sessions to an append-only log and replay them
+#
+#  python session_log.py session.ev3log            replay at recorded speed
+#  python session_log.py session.ev3log --speed 10 replay 10x faster
+#  python session_log.py session.ev3log --speed 0  replay as fast as possible
+#
+# the log is a magic string followed by records of
+#   <dHI  receive time [s], topic length, payload length
+#   topic bytes, payload bytes
+
+import argparse
+import struct
+import threading
+import time
+
+SESSION_MAGIC = b"EV3SESS1"
+RECORD_HEADER = struct.Struct("<dHI")
+
+
+class SessionRecorder():
+    """append every received (topic, time, payload) to a session log file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(SESSION_MAGIC)
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def record(self, topic, payload, t=None):
+        topic = topic.encode("utf-8")
+        with self.lock:
+            self.file.write(RECORD_HEADER.pack(time.time() if t is None else t, len(topic),
+                                               len(payload)))
+            self.file.write(topic)
+            self.file.write(payload)
+            self.count += 1
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class ReplayMessage():
+    """the parts of a paho MQTTMessage the supervisor callbacks read"""
+    __slots__ = ("topic", "payload", "timestamp")
+
+    def __init__(self, topic, payload, timestamp):
+        self.topic = topic
+        self.payload = payload
+        self.timestamp = timestamp
+
+
+def read_session(path):
+    """yield the recorded messages of a session log as ReplayMessage in order"""
+    with open(path, "rb") as file:
+        data = file.read()
+    if not data.startswith(SESSION_MAGIC):
+        raise ValueError(f"{path} is not a session log")
+    offset = len(SESSION_MAGIC)
+    while offset + RECORD_HEADER.size <= len(data):
+        t, topic_len, payload_len = RECORD_HEADER.unpack_from(data, offset)
+        offset += RECORD_HEADER.size
+        if offset + topic_len + payload_len > len(data):
+            # a record cut short by a crash while recording
+            return
+        topic = data[offset:offset + topic_len].decode("utf-8")
+        offset += topic_len
+        yield ReplayMessage(topic, data[offset:offset + payload_len], t)
+        offset += payload_len
+
+
+def replay(path, robot, speed=1.0):
+    """ feed a session log through the robot message callbacks and return throughput stats
+
+        speed scales the recorded message spacing, 1 replays in real time and 0 or None
+        as fast as possible. Returns when the robot has applied every replayed sample.
+    """
+    messages = 0
+    readings = robot.ingest_stats()["applied"]
+    map_version = robot.map_grid.version
+    start = time.perf_counter()
+    first = None
+    for msg in read_session(path):
+        if speed:
+            first = msg.timestamp if first is None else first
+            delay = (msg.timestamp - first)/speed - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+        robot.dispatch_message(msg)
+        messages += 1
+    robot.map_worker.drain()
+    robot.release_ranges(flush=True)
+    elapsed = time.perf_counter() - start
+    readings = robot.ingest_stats()["applied"] - readings
+    map_writes = robot.map_grid.version - map_version
+    return {"messages": messages, "seconds": elapsed, "messages_per_sec": messages/elapsed,
+            "samples_per_sec": readings/elapsed, "map_updates_per_sec": map_writes/elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="replay a recorded EV3 sensor session")
+    parser.add_argument("path")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="replay speed factor, 0 for as fast as possible")
+    args = parser.parse_args()
+
+    import EV3_Controller
+    robot = EV3_Controller.EV3Supervisor()
+    stats = replay(args.path, robot, args.speed)
+    robot.close_comms()
+    print(f"{stats['messages']} messages in {stats['seconds']:.2f} s: "
+          f"{stats['messages_per_sec']:.0f} messages/s, {stats['samples_per_sec']:.0f} samples/s, "
+          f"{stats['map_updates_per_sec']:.0f} map updates/s")
+
+
+if __name__ == "__main__":
+    main()
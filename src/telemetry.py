@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# fixed size timestamped history of the robot sensor channels
+
+import numpy as np
+
+
+class RingBuffer():
+    """ the last capacity (time, value) samples of one channel in preallocated arrays
+
+        Every sample is written twice, at i and i + capacity of arrays twice the capacity
+        long, so the last n samples are always one contiguous slice and window() and
+        last() return views without copying. The views alias the buffer: copy them before
+        holding on to them across more than capacity new samples. Timestamps are expected
+        to be non decreasing.
+    """
+
+    def __init__(self, capacity, width=1):
+        self.capacity = capacity
+        self.width = width
+        self.times = np.zeros(2*capacity)
+        self.values = np.zeros((2*capacity, width)) if width > 1 else np.zeros(2*capacity)
+        self.count = 0
+        self.head = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, t, value):
+        """add one sample"""
+        head = self.head
+        self.times[head] = self.times[head + self.capacity] = t
+        self.values[head] = self.values[head + self.capacity] = value
+        self.head = (head + 1) % self.capacity
+        self.count += 1
+
+    def extend(self, times, values):
+        """add a batch of samples in time order"""
+        times = np.asarray(times, dtype=float)[-self.capacity:]
+        values = np.asarray(values, dtype=float)[-self.capacity:]
+        index = (self.head + np.arange(len(times))) % self.capacity
+        self.times[index] = self.times[index + self.capacity] = times
+        self.values[index] = self.values[index + self.capacity] = values
+        self.head = (self.head + len(times)) % self.capacity
+        self.count += len(times)
+
+    def last(self, n=None):
+        """return views (times, values) of the last n samples, oldest first, by default all"""
+        n = len(self) if n is None else min(n, len(self))
+        # the newest sample sits just before head in the second copy
+        stop = self.head + self.capacity
+        return self.times[stop - n:stop], self.values[stop - n:stop]
+
+    def window(self, seconds, now=None):
+        """ return views (times, values) of the samples in the last seconds up to now,
+            by default up to the newest sample
+        """
+        times, values = self.last()
+        if len(times) == 0:
+            return times, values
+        now = times[-1] if now is None else now
+        start = np.searchsorted(times, now - seconds, side="left")
+        stop = np.searchsorted(times, now, side="right")
+        return times[start:stop], values[start:stop]
+
+
+class TelemetryStore():
+    """ ring buffers of the heading [deg], range [m] and accel [x, y, z] channels
+
+        Each channel has its own RingBuffer so a channel may be written by one thread
+        while others are read; a reader may see a sample being written.
+    """
+
+    CHANNELS = {"hdg": 1, "range": 1, "accel": 3}
+
+    def __init__(self, capacity=4096):
+        self.channels = {name: RingBuffer(capacity, width) for name, width in self.CHANNELS.items()}
+
+    def record(self, channel, t, value):
+        self.channels[channel].append(t, value)
+
+    def last(self, channel, n=None):
+        return self.channels[channel].last(n)
+
+    def window(self, channel, seconds, now=None):
+        return self.channels[channel].window(seconds, now)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# occupancy grid that allocates fixed size tiles as the robot explores
+
+import numpy as np
+import occupancy_grid as og
+
+
+class Tiled_Occupancy_Grid(og.Occupancy_Grid):
+    """ occupancy grid with no fixed bounds
+
+        Cells live in square tiles of tile_size cells held in a dict keyed by tile
+        coordinates. A tile is only allocated the first time a beam writes information
+        into it, so memory grows with the explored area rather than its bounding box.
+        Map cell coordinates may be negative; cell (x, y) lives in tile
+        (x // tile_size, y // tile_size).
+    """
+
+    def __init__(self, resolution=0.1, tile_size=128, beam_cache=None, storage="float",
+                 log_odds_min=-2.0, log_odds_max=3.5):
+        super().__init__(0, 0, resolution, beam_cache, storage, log_odds_min, log_odds_max)
+        self.tile_size = tile_size
+        self.fill_value = 0 if self.fixed_point else 0.5
+        self.tiles = {}
+        self._probability_bounds = None
+
+    @property
+    def nbytes(self):
+        """memory held by the allocated tiles in bytes"""
+        return sum(tile.nbytes for tile in self.tiles.values())
+
+    def tile(self, tx, ty):
+        """return the tile at tile coordinates (tx, ty), allocating it on first use"""
+        tile = self.tiles.get((tx, ty))
+        if tile is None:
+            tile = np.full((self.tile_size, self.tile_size), self.fill_value,
+                           dtype=self.log_odds_prob.dtype, order='C')
+            self.tiles[(tx, ty)] = tile
+        return tile
+
+    def bounds(self):
+        """return (x_min, y_min, x_max, y_max) cells covered by the allocated tiles, max exclusive"""
+        if not self.tiles:
+            return (0, 0, 0, 0)
+        keys = np.array(list(self.tiles))
+        x_min, y_min = keys.min(axis=0) * self.tile_size
+        x_max, y_max = (keys.max(axis=0) + 1) * self.tile_size
+        return (int(x_min), int(y_min), int(x_max), int(y_max))
+
+    def get_region(self, bounds=None):
+        """ return a copy of the raw cells inside bounds = (x_min, y_min, x_max, y_max),
+            by default the bounding box of the allocated tiles
+        """
+        x_min, y_min, x_max, y_max = self.bounds() if bounds is None else bounds
+        region = np.full((x_max - x_min, y_max - y_min), self.fill_value,
+                         dtype=self.log_odds_prob.dtype)
+        size = self.tile_size
+        for (tx, ty), tile in self.tiles.items():
+            x_start, x_stop = max(x_min, tx*size), min(x_max, (tx + 1)*size)
+            y_start, y_stop = max(y_min, ty*size), min(y_max, (ty + 1)*size)
+            if x_start >= x_stop or y_start >= y_stop:
+                continue
+            region[x_start - x_min:x_stop - x_min, y_start - y_min:y_stop - y_min] = \
+                tile[x_start - tx*size:x_stop - tx*size, y_start - ty*size:y_stop - ty*size]
+        return region
+
+    def get_map(self, bounds=None):
+        """ return the map inside bounds = (x_min, y_min, x_max, y_max), by default the
+            bounding box of the allocated tiles; cell [0, 0] is map cell (x_min, y_min).
+            The tiles are not contiguous so this is a read only copy, kept until the map
+            or bounds change, rather than a view of the cells like Occupancy_Grid.get_map
+        """
+        bounds = self.bounds() if bounds is None else tuple(bounds)
+        if self._probability_version != self.version or self._probability_bounds != bounds:
+            if self.fixed_point:
+                self._probability = 1 - 1/(1 + np.exp(self.get_log_odds(bounds)))
+            else:
+                self._probability = self.get_region(bounds)
+            self._probability.setflags(write=False)
+            self._probability_version = self.version
+            self._probability_bounds = bounds
+        return self._probability
+
+    def get_log_odds(self, bounds=None):
+        """return the log-odds inside bounds as floats (the raw cells in float mode)"""
+        region = self.get_region(bounds)
+        if not self.fixed_point:
+            return region
+        return region.astype(np.float32) * np.float32(self.log_odds_scale)
+
+    def update_log_odds(self, x, y, value):
+        self.update_grid(np.array([[value]], dtype=float), int(x), int(y))
+
+    def update_grid(self, data, x, y, x_offset=0, y_offset=0):
+        """ fuse a sensor patch into the tiles it overlaps
+            cell (i, j) of data lands on map cell (x-x_offset+i, y-y_offset+j)
+        """
+        x0, y0 = x - x_offset, y - y_offset
+        size = self.tile_size
+        self.mark_changed(x0, y0, x0 + data.shape[0], y0 + data.shape[1])
+        for tx in range(x0 // size, (x0 + data.shape[0] - 1) // size + 1):
+            x_start, x_stop = max(x0, tx*size), min(x0 + data.shape[0], (tx + 1)*size)
+            for ty in range(y0 // size, (y0 + data.shape[1] - 1) // size + 1):
+                y_start, y_stop = max(y0, ty*size), min(y0 + data.shape[1], (ty + 1)*size)
+                patch = data[x_start - x0:x_stop - x0, y_start - y0:y_stop - y0]
+                # do not allocate a tile for a part of the patch with no information
+                if (tx, ty) not in self.tiles and np.all(patch == 0.5):
+                    continue
+                cells = self.tile(tx, ty)[x_start - tx*size:x_stop - tx*size,
+                                          y_start - ty*size:y_stop - ty*size]
+                self.fuse_patch(cells, patch)
+
+    def split_by_tile(self, cell_x, cell_y, values):
+        """ yield (tile, local flat cell indices, values) for each tile holding some of the
+            map cells (cell_x, cell_y), allocating the tiles; a stable sort on the tile keeps
+            the order of the cells within each tile
+        """
+        size = self.tile_size
+        tile_x, local_x = np.divmod(cell_x, size)
+        tile_y, local_y = np.divmod(cell_y, size)
+        keys, inverse = np.unique(np.stack([tile_x, tile_y], axis=1), axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        sort = np.argsort(inverse, kind='stable')
+        splits = np.cumsum(np.bincount(inverse, minlength=len(keys)))[:-1]
+        local_flat = (local_x*size + local_y)[sort]
+        for (tx, ty), flat, vals in zip(keys, np.split(local_flat, splits),
+                                        np.split(values[sort], splits)):
+            yield self.tile(int(tx), int(ty)), flat, vals
+
+    def sensor_readings(self, poses, headings, ranges, bw, bw_res, rng_max, rng_res):
+        """apply a batch of readings with one write per touched tile, see Occupancy_Grid"""
+        cell_x, cell_y, values = self.beam_contributions(poses, headings, ranges, bw, bw_res,
+                                                         rng_max, rng_res)
+        if len(values) == 0:
+            return
+        self.mark_changed(cell_x.min(), cell_y.min(), cell_x.max() + 1, cell_y.max() + 1)
+        for tile, flat, vals in self.split_by_tile(cell_x, cell_y, values):
+            self.fuse_contributions(tile.reshape(-1), flat, vals)
+
+    def add_log_odds(self, cell_x, cell_y, increments):
+        """ add fixed point log-odds increments from log_odds_contributions to the tiles,
+            each cell listed at most once; the map has no bounds so no cell is dropped
+        """
+        if len(cell_x) == 0:
+            return
+        self.mark_changed(cell_x.min(), cell_y.min(), cell_x.max() + 1, cell_y.max() + 1)
+        for tile, flat, added in self.split_by_tile(cell_x, cell_y, increments):
+            cells = tile.reshape(-1)
+            cells[flat] = np.clip(cells[flat] + added, self.fixed_min, self.fixed_max)
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# message transports for EV3Supervisor: a paho MQTT client or an in-process loopback, and
+# their asyncio variants for AsyncEV3Supervisor
+#
+# A transport has
+#   on_connect(client, userdata, flags, rc)  set by the user, called once connected
+#   connect()                                connect and start delivering messages
+#   disconnect()
+#   subscribe(topic, callback)               callback(client, userdata, msg) per message,
+#                                            msg has topic and payload (bytes)
+#   publish(topic, payload, qos=0)           qos is the MQTT quality of service, 0 or 1
+# and the asyncio transports also
+#   pause_reading(), resume_reading()        stop and restart delivering messages
+
+import asyncio
+import queue
+import threading
+import time
+from collections import deque
+import paho.mqtt.client as mqtt
+
+
+def topic_matches(pattern, topic):
+    """True when topic matches an MQTT subscription pattern with + and # wildcards"""
+    pattern_levels = pattern.split("/")
+    topic_levels = topic.split("/")
+    for i, level in enumerate(pattern_levels):
+        if level == "#":
+            return True
+        if i >= len(topic_levels) or (level != "+" and level != topic_levels[i]):
+            return False
+    return len(pattern_levels) == len(topic_levels)
+
+
+class PahoTransport():
+    """MQTT broker connection through a paho client with its network loop thread"""
+
+    def __init__(self, host="localhost", port=1883, keepalive=60):
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.on_connect = None
+        self.client = mqtt.Client()
+        self.client.on_connect = self.paho_connect
+
+    def paho_connect(self, client, userdata, flags, rc):
+        if self.on_connect is not None:
+            self.on_connect(self, userdata, flags, rc)
+
+    def connect(self):
+        self.client.connect(self.host, self.port, self.keepalive)
+        self.client.loop_start()
+
+    def disconnect(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def subscribe(self, topic, callback):
+        self.client.subscribe(topic, 0)
+        self.client.message_callback_add(topic, callback)
+
+    def publish(self, topic, payload, qos=0):
+        self.client.publish(topic, payload, qos)
+
+
+class LoopbackMessage():
+    """a message delivered by the loopback broker"""
+    __slots__ = ("topic", "payload", "timestamp")
+
+    def __init__(self, topic, payload, timestamp):
+        self.topic = topic
+        self.payload = payload
+        self.timestamp = timestamp
+
+
+class LoopbackTransport():
+    """ in-process broker, published messages are delivered to the matching subscriptions
+        in order on a delivery thread, as paho delivers on its network loop thread.
+        Nothing is delivered before connect; published messages wait until then.
+    """
+
+    def __init__(self):
+        self.on_connect = None
+        self.subscriptions = []
+        self.messages = queue.SimpleQueue()
+        self.thread = None
+        self.published = 0
+        self.delivered = 0
+
+    def connect(self):
+        self.thread = threading.Thread(target=self.deliver, name="loopback", daemon=True)
+        self.thread.start()
+        if self.on_connect is not None:
+            self.on_connect(self, None, {}, 0)
+
+    def disconnect(self):
+        if self.thread is not None:
+            self.messages.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def subscribe(self, topic, callback):
+        self.subscriptions.append((topic, callback))
+
+    def publish(self, topic, payload, qos=0):
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        self.published += 1
+        self.messages.put(LoopbackMessage(topic, bytes(payload), time.time()))
+
+    def deliver(self):
+        while True:
+            msg = self.messages.get()
+            if msg is None:
+                return
+            for pattern, callback in self.subscriptions:
+                if topic_matches(pattern, msg.topic):
+                    callback(self, None, msg)
+            self.delivered += 1
+
+
+class AsyncPahoTransport(PahoTransport):
+    """ paho MQTT client driven by an asyncio event loop instead of its network thread
+
+        The socket is watched with the loop's add_reader/add_writer, so messages are
+        delivered and callbacks run on the loop. pause_reading() stops reading the
+        socket, leaving unread messages to TCP flow control, until resume_reading().
+        connect() must be called with the event loop running; publish() may be called
+        from any thread.
+    """
+
+    def __init__(self, host="localhost", port=1883, keepalive=60):
+        super().__init__(host, port, keepalive)
+        self.loop = None
+        self.sock = None
+        self.paused = False
+        self.misc = None
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def connect(self):
+        self.loop = asyncio.get_running_loop()
+        self.client.connect(self.host, self.port, self.keepalive)
+        self.misc = self.loop.create_task(self.loop_misc())
+
+    def disconnect(self):
+        self.client.disconnect()
+        if self.misc is not None:
+            self.misc.cancel()
+            self.misc = None
+
+    def publish(self, topic, payload, qos=0):
+        """ publish on the loop: paho asks for the socket to be watched for writing from
+            inside publish and add_writer must run on the loop thread, so a publish from
+            another thread, e.g. an offloaded map update, is handed to the loop
+        """
+        if self.loop is not None and not self.on_loop():
+            self.loop.call_soon_threadsafe(self.client.publish, topic, payload, qos)
+            return
+        self.client.publish(topic, payload, qos)
+
+    def on_loop(self):
+        """return True when called on the thread running the transport's loop"""
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    async def loop_misc(self):
+        """keepalive pings and reconnect checks, paho's loop_misc once a second"""
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+    def on_socket_open(self, client, userdata, sock):
+        self.sock = sock
+        if not self.paused:
+            self.loop.add_reader(sock, self.client.loop_read)
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        self.sock = None
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, self.client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    def pause_reading(self):
+        self.paused = True
+        if self.sock is not None:
+            self.loop.remove_reader(self.sock)
+
+    def resume_reading(self):
+        self.paused = False
+        if self.sock is not None:
+            self.loop.add_reader(self.sock, self.client.loop_read)
+
+
+class AsyncLoopbackTransport(LoopbackTransport):
+    """ loopback broker delivering on an asyncio event loop, the test double of
+        AsyncPahoTransport. publish() may be called from any thread; while paused the
+        published messages wait in order for resume_reading()
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.loop = None
+        self.paused = False
+        self.pending = deque()
+
+    def connect(self):
+        self.loop = asyncio.get_running_loop()
+        if self.on_connect is not None:
+            self.on_connect(self, None, {}, 0)
+        self.loop.call_soon(self.deliver)
+
+    def disconnect(self):
+        self.loop = None
+
+    def publish(self, topic, payload, qos=0):
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        self.published += 1
+        self.messages.put(LoopbackMessage(topic, bytes(payload), time.time()))
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.deliver)
+
+    def deliver(self):
+        """deliver the published messages on the loop until paused"""
+        while True:
+            if not self.pending:
+                try:
+                    self.pending.append(self.messages.get_nowait())
+                except queue.Empty:
+                    return
+            if self.paused:
+                return
+            msg = self.pending.popleft()
+            for pattern, callback in self.subscriptions:
+                if topic_matches(pattern, msg.topic):
+                    callback(self, None, msg)
+            self.delivered += 1
+
+    def pause_reading(self):
+        self.paused = True
+
+    def resume_reading(self):
+        self.paused = False
+        if self.loop is not None:
+            self.loop.call_soon(self.deliver)